@@ -40,6 +40,19 @@ class BaseBuilder(PromptBuilder):
         
         return validated_args
 
+    @staticmethod
+    def session_prompt_tokens(session):
+        """会话维护的提示词 token 数（按消息缓存，不重新编码），用于 TPM 限流和模型路由。"""
+        try:
+            return session.calc_tokens()
+        except Exception:
+            return session.num_tokens_by_character(session.messages)
+
+    @staticmethod
+    def estimate_request_tokens(session, payload):
+        """预估一次 chat 请求消耗的 token 数（提示词 + max_tokens），用于 TPM 限流。"""
+        return BaseBuilder.session_prompt_tokens(session) + payload.get("max_tokens", 0)
+
     @property
     def current_plugin(self):
         return self.__current_plugin
@@ -3,8 +3,18 @@ from ...config.config_manager import config_manager
 from ...session_manager.session_manager import ChatGPTSession
 from ...session_manager.session_manager import SessionManager
 from ...session_manager.storage.global_storage import global_storage
+from ...util.cache.response_cache import ResponseCache
+from ...util.cache.semantic_cache import SemanticCache
+from ...util.endpoint_pool import EndpointPool, endpoint_pool as default_endpoint_pool
+from ...util.embedding_batcher import build_embedding_payload, count_embedding_tokens, fill_vectors, split_embedding_batches, vectors_to_numpy
 from ...util.http_client import http_client
+from ...util.model_router import ModelRouter
+from ...util.retry import Deadline
 from ...util.logger import logger
+from ...util.singleflight import SingleFlight
+from ...util.sse import iter_chat_deltas
+from ...util.token_estimator import token_estimator
+from concurrent.futures import ThreadPoolExecutor
 
 
 class LLM(BaseBuilder):
@@ -13,41 +23,105 @@ class LLM(BaseBuilder):
     def current_plugin(self):
         return self.__current_plugin
 
-    def __init__(self, model, session_storage=None, session_id=None, sessioncls = ChatGPTSession):
+    def __init__(self, model, session_storage=None, session_id=None, sessioncls = ChatGPTSession, response_cache: ResponseCache = None, semantic_cache: SemanticCache = None,
+                 endpoint_pool: EndpointPool = None, singleflight: SingleFlight = None, router: ModelRouter = None):
         """_summary_
 
         Args:
             session_id (_type_): 会话ID
             session_storage (_type_, optional): _description_. 会话存储器，默认为None，则为全局变量管理会话，目前还可以配置redis存储.
             sessioncls (_type_, optional): _description_. token管理器，目前只有GPT一种所以可以不传.
+            response_cache (ResponseCache, optional): 响应缓存，相同请求直接返回缓存结果，默认不开启.
+            semantic_cache (SemanticCache, optional): 语义缓存，最后一条用户消息语义相近时直接返回缓存结果，默认不开启.
+            endpoint_pool (EndpointPool, optional): 端点池（多端点故障转移），默认使用按 config_manager 配置的全局端点池.
+            singleflight (SingleFlight, optional): 请求合并，并发的相同请求只向上游发送一次，默认不开启.
+            router (ModelRouter, optional): 模型路由，按提示词长度、价格和延迟为每次请求选择模型，超时或上下文超长时降级，默认不开启.
+                开启时 model 决定会话保留的上下文长度，建议使用候选模型中上下文最长的一个.
         """
         if not config_manager.get_model_config(model):
             raise Exception("没有此模型配置")
         self.session_manager = SessionManager(sessioncls, session_storage if session_storage else global_storage, model)
         super().__init__(session_id=session_id, session_manager=self.session_manager)
         self.__current_plugin = None
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.endpoint_pool = endpoint_pool or default_endpoint_pool
+        self.singleflight = singleflight
+        self.router = router
     
     @staticmethod
-    def embedding(input):
-        """向OpenAI发送请求，获取文本的embedding"""
+    def embedding(input, model=None, dimensions=None, estimated_tokens=0, endpoint_pool: EndpointPool = None, singleflight: SingleFlight = None):
+        """向OpenAI发送请求，获取文本的embedding
+
+        Args:
+            input (str | list): 文本或文本列表。
+            model (str, optional): embedding 模型，默认使用 config_manager.embedding_model。
+            dimensions (int, optional): 输出向量维度，默认使用 config_manager.embedding_dimensions。
+            estimated_tokens (int, optional): 输入的 token 数，用于 TPM 限流。
+            endpoint_pool (EndpointPool, optional): 端点池，默认使用全局端点池。
+            singleflight (SingleFlight, optional): 请求合并，并发的相同请求只发送一次。
+        """
+        # Authorization 由端点池按选中的端点填充
         headers = {
-            'Authorization': f"Bearer {config_manager.apikey}",
             'Content-Type': 'application/json'
         }
         
         # 准备请求数据
-        payload = {
-            "input": input,
-            "model": "text-embedding-ada-002"
-        }
+        payload = build_embedding_payload(input, model, dimensions)
         
-        logger.info(f"[gpts-builder] Sending embedding request with payload: {payload} and headers: {headers}")
+        logger.info(f"[gpts-builder] Sending embedding request model: {payload['model']} inputs: {len(input) if isinstance(input, list) else 1}")
+
+        def send():
+            # 所有重试和端点故障转移共享同一个截止时间
+            deadline = Deadline(60)
+            return (endpoint_pool or default_endpoint_pool).call(
+                "/v1/embeddings",
+                lambda url, headers: http_client.post(url, json=payload, headers=headers, model=payload["model"], estimated_tokens=estimated_tokens, deadline=deadline),
+                headers, deadline=deadline)
 
-        response = http_client.post(config_manager.base_url + "/v1/embeddings", json=payload, headers=headers)
-        # 记录响应
-        logger.info(f"[gpts-builder] Received embedding response: {response}")
+        response = singleflight.do(singleflight.key(payload, "embedding"), send) if singleflight is not None else send()
+        # 记录响应（不打印向量本身）
+        logger.info(f"[gpts-builder] Received embedding response usage: {response.get('usage') if isinstance(response, dict) else None}")
 
         return response
+
+    @staticmethod
+    def embeddings(texts, model=None, dimensions=None, max_batch_items=512, max_batch_tokens=100000, concurrency=4, as_numpy=False,
+                   endpoint_pool: EndpointPool = None, singleflight: SingleFlight = None):
+        """批量获取文本的embedding：按条数和 token 数拆分请求并发发送，按输入顺序返回向量。
+
+        Args:
+            texts (list): 文本列表。
+            model (str, optional): embedding 模型，默认使用 config_manager.embedding_model。
+            dimensions (int, optional): 输出向量维度，默认使用 config_manager.embedding_dimensions。
+            max_batch_items (int): 每个请求最多包含的文本条数。
+            max_batch_tokens (int): 每个请求最多包含的 token 数。
+            concurrency (int): 同时进行的请求数。
+            as_numpy (bool): 是否返回 (n, d) 的 float32 数组。
+            endpoint_pool (EndpointPool, optional): 端点池，默认使用全局端点池。
+            singleflight (SingleFlight, optional): 请求合并，并发的相同批次只发送一次。
+
+        Returns:
+            list | numpy.ndarray: 与输入顺序一致的向量，请求失败的位置为 None（数组中为 NaN）。
+        """
+        texts = list(texts)
+        vectors = [None] * len(texts)
+        if texts:
+            model = model or config_manager.embedding_model
+            token_counts = count_embedding_tokens(texts, model)
+            batches = split_embedding_batches(texts, model, max_batch_items, max_batch_tokens, token_counts)
+
+            def request(indices):
+                try:
+                    return indices, LLM.embedding([texts[i] for i in indices], model, dimensions, sum(token_counts[i] for i in indices), endpoint_pool, singleflight)
+                except Exception as e:
+                    logger.error(f"[gpts-builder] embedding batch failed: {e}")
+                    return indices, None
+
+            with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(batches)))) as executor:
+                for indices, response in executor.map(request, batches):
+                    fill_vectors(vectors, indices, response)
+        return vectors_to_numpy(vectors) if as_numpy else vectors
     
     def chat_completions(self, ** args) -> ChatGPTSession:
         """大模型chat请求
@@ -57,9 +131,8 @@ class LLM(BaseBuilder):
             valid_args = self.validate_chat_args(args, self.session_manager.model)
         except ValueError as e:
             raise Exception(f"[gpts-builder] Invalid argument: {e}")
-        # 1. 准备请求头
+        # 1. 准备请求头（Authorization 由端点池按选中的端点填充）
         headers = {
-            'Authorization': f"Bearer {config_manager.apikey}",
             'Content-Type': 'application/json'
         }
         # 2. 准备请求数据
@@ -69,26 +142,70 @@ class LLM(BaseBuilder):
             }
         if args:
             payload.update(valid_args)
+        if self.response_cache is not None:
+            cached = self.response_cache.get(payload)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions response cache hit")
+                return cached
+        semantic_entry = None
+        if self.semantic_cache is not None:
+            cached, semantic_entry = self.semantic_cache.lookup(payload, LLM.embeddings)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions semantic cache hit")
+                return cached
         logger.info(f"[gpts-builder] Sending  chat completions request payload: {payload} headers {headers}")
 
-        response = http_client.post(config_manager.base_url + "/v1/chat/completions", json=payload, headers=headers, timeout=60, max_retries=3)
-        # 记录响应
-        logger.info(f"[gpts-builder] Received chat completions response: {response}")
+        prompt_tokens = self.session_prompt_tokens(self.session)
+        estimated_tokens = prompt_tokens + payload.get("max_tokens", 0)
 
-        return response
+        def post(body):
+            # 所有重试和端点故障转移共享同一个截止时间，按模型降级时重新计时
+            deadline = Deadline(60)
+            response = self.endpoint_pool.call(
+                "/v1/chat/completions",
+                lambda url, headers: http_client.post(url, json=body, headers=headers, timeout=60, max_retries=3,
+                                                      model=body["model"], estimated_tokens=estimated_tokens, deadline=deadline),
+                headers, deadline=deadline)
+            # 用上游统计的 prompt_tokens 校准会话的 token 估算
+            if isinstance(response, dict) and "tools" not in body and "functions" not in body:
+                token_estimator.observe_usage(body["model"], body["messages"], response.get("usage"))
+            return response
+
+        def send():
+            if self.router is None:
+                response = post(payload)
+            else:
+                response = self.router.route(payload["messages"], lambda model: post(dict(payload, model=model)), payload.get("max_tokens", 0),
+                                             prompt_tokens)
+            # 记录响应
+            logger.info(f"[gpts-builder] Received chat completions response: {response}")
+
+            if self.response_cache is not None:
+                self.response_cache.set(payload, response)
+            if self.semantic_cache is not None:
+                self.semantic_cache.store(semantic_entry, response)
+            return response
+
+        if self.singleflight is not None:
+            return self.singleflight.do(self.singleflight.key(payload), send)
+        return send()
     
 
-    def chat_completions_stream(self, **args):
-        """大模型chat请求，流式返回一个异步生成器"""
+    def chat_completions_stream(self, parse_deltas=False, **args):
+        """大模型chat请求，流式返回一个生成器
+
+        Args:
+            parse_deltas (bool): 为 True 时返回解析好的 ChatDelta（content、tool_calls 片段、finish_reason、usage），
+                否则返回原始的 SSE 文本片段。
+        """
         try:
             # 校验传入的参数
             valid_args = self.validate_chat_args(args, self.session_manager.model)
         except ValueError as e:
             raise Exception(f"[gpts-builder] Invalid argument: {e}")
         
-        # 准备请求头
+        # 准备请求头（Authorization 由端点池按选中的端点填充）
         headers = {
-            'Authorization': f"Bearer {config_manager.apikey}",
             'Content-Type': 'application/json'
         }
         
@@ -100,11 +217,54 @@ class LLM(BaseBuilder):
         }
         if args:
             payload.update(valid_args)
+        stream = self._open_stream(payload, headers, decode=not parse_deltas)
+        return iter_chat_deltas(stream) if parse_deltas else stream
+
+    def _open_stream(self, payload, headers, decode=True):
+        """依次查询响应缓存、语义缓存，未命中时发起流式请求；返回 SSE 片段（开启缓存时始终为文本）。"""
+        if self.response_cache is not None:
+            cached = self.response_cache.get(payload)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions response cache hit, replaying as stream")
+                return self.response_cache.replay_stream(cached)
+        semantic_entry = None
+        if self.semantic_cache is not None:
+            cached, semantic_entry = self.semantic_cache.lookup(payload, LLM.embeddings)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions semantic cache hit, replaying as stream")
+                return self.semantic_cache.replay_stream(cached)
+
+        # 缓存和请求合并需要文本片段，开启时不使用原始字节
+        decode = decode or self.response_cache is not None or self.semantic_cache is not None or self.singleflight is not None
+        prompt_tokens = self.session_prompt_tokens(self.session)
+        estimated_tokens = prompt_tokens + payload.get("max_tokens", 0)
+
+        def open_stream(body):
+            # 所有重试和端点故障转移共享同一个截止时间，按模型降级时重新计时
+            deadline = Deadline(60)
+
+            def open_endpoint(url, headers):
+                curl_command = BaseBuilder.generate_curl_command(url, body, headers)
+                logger.info(f"[gpts-builder] {curl_command}")
+                return http_client.post_stream(url=url, json=body, headers=headers, timeout=60, decode=decode,
+                                               model=body["model"], estimated_tokens=estimated_tokens, deadline=deadline)
+            return self.endpoint_pool.stream("/v1/chat/completions", open_endpoint, headers, deadline=deadline)
+
+        def upstream():
+            if self.router is None:
+                stream = open_stream(payload)
+            else:
+                stream = self.router.route_stream(payload["messages"], lambda model: open_stream(dict(payload, model=model)), payload.get("max_tokens", 0),
+                                                  prompt_tokens)
+            if self.response_cache is not None:
+                stream = self.response_cache.record_stream(payload, stream)
+            if self.semantic_cache is not None:
+                stream = self.semantic_cache.record_stream(semantic_entry, stream)
+            return stream
 
-        url = config_manager.base_url + "/v1/chat/completions"        
-        curl_command = BaseBuilder.generate_curl_command(url, payload, headers) 
-        logger.info(f"[gpts-builder] {curl_command}")
-        return http_client.post_stream(url=url, json=payload, headers=headers, timeout=60)    
+        if self.singleflight is not None:
+            return self.singleflight.stream(self.singleflight.key(payload, "chat_stream"), upstream)
+        return upstream()
     
     def clear_session(self):
         """清除会话"""
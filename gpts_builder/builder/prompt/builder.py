@@ -1,10 +1,16 @@
+import random
+import time
+
 from ...prompt_base_builder import BaseBuilder
 from ...prompt_template import KB_REFERENCE_TEMPLATE
 from ...util.logger import logger
-from ...session_manager import SessionManager
+from ...session_manager import SessionConflict, SessionManager
 
 class PromptBuilder(BaseBuilder):
 
+    # 保存会话时发现并发修改后，重新加载会话并重放任务的最多次数
+    max_conflict_retries = 5
+
     @property
     def session(self):
         return self._session
@@ -32,7 +38,7 @@ class PromptBuilder(BaseBuilder):
         self._set_template(system_template)
         self._render_template(**kwargs)
         self._content = self.content
-        self._session = self.session_manager.build_session(self.session_id, self._content)
+        self._session.update_system_prompt(self._content)
         logger.info(f"set_system res {self._session.messages}")
 
     def set_prompt(self, prompt_template, **kwargs):
@@ -43,7 +49,7 @@ class PromptBuilder(BaseBuilder):
         self._set_template(prompt_template)
         self._render_template(**kwargs)
         self._content = self.content
-        self._session = self.session_manager.session_query(self.session_id, self._content)
+        self._session.add_query(self._content)
         logger.info(f"set_prompt res {self._session.messages}")
 
     def set_kb_reference(self, **kwargs):
@@ -55,14 +61,28 @@ class PromptBuilder(BaseBuilder):
         self._set_template(kb_reference_template)
         self._render_template(**kwargs)
         self._content = self.content
-        self._session = self.session_manager.session_query(self.session_id, self._content)
+        self._session.add_query(self._content)
         logger.info(f"set_kb_reference res {self._session.messages}")
 
     def build(self):
-        """执行所有任务"""
-        for task in self._tasks:
-            task()
-        return self
+        """
+        执行所有任务：读取一次会话，在内存中依次应用所有修改，裁剪一次后写回一次。
+
+        写回时发现会话已被并发修改（同一会话的另一轮对话），重新读取会话并重放任务。
+        """
+        for attempt in range(1, self.max_conflict_retries + 1):
+            self._session, version = self.session_manager.load_session(self.session_id)
+            for task in self._tasks:
+                task()
+            try:
+                self.session_manager.save_session(self._session, version)
+                return self
+            except SessionConflict as e:
+                if attempt == self.max_conflict_retries:
+                    raise
+                logger.info(f"{e}, reloading and replaying {len(self._tasks)} tasks")
+                # 随机退避，避免同时冲突的几轮对话再次同时写入
+                time.sleep(random.uniform(0, 0.01 * attempt))
 
 
     
@@ -1,22 +1,30 @@
 from ..llm.llm_builder import LLM
+from ...util.cache.embedding_cache import EmbeddingCache
 from ...util.db.postgres_vector import PostgresVector
+from ...util.db.ingest import IngestStats, batch_texts, iter_batches, pair_vectors
+from ...util.db.top_k import merge_top_k
+from ...util.db.vector_codec import VectorParam, cosine_similarities
 from ...util.db.schema import EmbbedingSchame, DatasetSchema, KB_TABLE_NAME, ANSWER_TABLE_NAME, QUESTION_TABLE_NAME
 from ...util.id_generator import generate_common_id
 from ...util.logger import logger
-import json, re
-from scipy.spatial.distance import cosine
+from psycopg2.extras import execute_values
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import re
 
 
 class DatasetBuilder:        
 
-    def __init__(self, db_driver: PostgresVector):
+    def __init__(self, db_driver: PostgresVector, embedding_cache: EmbeddingCache = None):
         """初始化知识库插件构建器。
 
         Args:
-            connection_params (dict): 数据库连接参数。
+            db_driver (PostgresVector): 向量数据库驱动。
+            embedding_cache (EmbeddingCache, optional): embedding 缓存，导入和查询共用，不传则每次都请求接口。
         """
         super().__init__()
         self.db_driver = db_driver
+        self.embedding_cache = embedding_cache
         self.db = self.db_driver.db
         self.answer_schema = EmbbedingSchame(ANSWER_TABLE_NAME)
         self.question_schema = EmbbedingSchame(QUESTION_TABLE_NAME)
@@ -83,43 +91,114 @@ class DatasetBuilder:
         if not id:
             logger.info("未成功生产知识库实例")
             return
+        # 先在事务外完成向量化（答案和问题合并为一次请求），不在网络请求期间占用事务
+        rows, skipped = pair_vectors([(index_text, output_list)], self.generate_vectors([index_text] + list(output_list)))
+        if skipped:
+            return
         try:
-            # 开启事务
-            cursor = self.db.cursor()
-            
-            # 插入索引并获取ID
-            sql_query = self.db_driver.get_insert_into_str(ANSWER_TABLE_NAME, [self.answer_schema.text, self.answer_schema.vector, self.answer_schema.kb_id]) + f" RETURNING {self.answer_schema.id}"
-            index_vector = self.generate_vector(index_text).get("embedding")
-            if not index_vector:
-                logger.info(f"{index_text} 未成功向量化")
-                return
-            cursor.execute(sql_query, (index_text, index_vector, id))
-            index_id = cursor.fetchone()[0]
-            logger.info(f"index_id {index_id}")
-            
-            # 批量插入问题
-            question_entries = []
-            for question_text in output_list:
-                question_vector = self.generate_vector(question_text).get("embedding")
-                if question_vector:
-                    question_entries.append((index_id, question_text, question_vector))
-                else:
-                    logger.info(f"{question_text} 未成功向量化")
-            
-            if question_entries:
-                sql_query = self.db_driver.get_insert_into_str(QUESTION_TABLE_NAME, [self.answer_schema.id, self.question_schema.text, self.question_schema.vector]) + f" RETURNING {self.question_schema.id}"
-                cursor.executemany(sql_query, question_entries)
-            
+            with self.db.cursor() as cursor:
+                index_ids = self._write_rows(cursor, id, rows)
             self.db.commit()  # 提交事务
-            cursor.close()  # 关闭游标
+            logger.info(f"index_id {index_ids[0]}")
             return True
         except Exception as e:
             logger.error(f"数据库操作失败: {e}")
             self.db.rollback()  # 回滚事务
-            cursor.close()  # 关闭游标
             return False
-            
 
+    def create_datas_bulk(self, id, records, batch_size=64, concurrency=4, max_pending=None):
+        """
+        批量导入问答数据：按批向量化（多个批次并发请求），每批在一个短事务中写入。
+
+        Args:
+            id (int): 知识库ID。
+            records (iterable): (答案, 问题列表) 的可迭代对象，可以是生成器，按需读取。
+            batch_size (int): 每批包含的答案条数，同一批的答案和问题合并为一次向量化请求。
+            concurrency (int): 同时进行的向量化请求数。
+            max_pending (int, optional): 已读取但未写入的最大批次数，达到后暂停读取 records（背压），默认 concurrency * 2。
+
+        Returns:
+            dict: 导入统计，包括成功/失败条数、耗时和吞吐量。
+        """
+        if not id:
+            logger.info("未成功生产知识库实例")
+            return
+        stats = IngestStats()
+        max_pending = max_pending or concurrency * 2
+        pending = deque()
+        # 向量化在线程池中并发进行，写库只在当前线程按顺序进行（psycopg2 连接不能跨线程并发使用）
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for batch in iter_batches(records, batch_size):
+                pending.append((batch, executor.submit(self.generate_vectors, batch_texts(batch))))
+                if len(pending) >= max_pending:
+                    self._write_batch(id, *pending.popleft(), stats)
+            while pending:
+                self._write_batch(id, *pending.popleft(), stats)
+        report = stats.report()
+        logger.info(f"[gpts-builder] 批量导入完成: {report}")
+        return report
+
+    def _write_batch(self, id, batch, future, stats):
+        """等待一批的向量化结果并在一个事务中写入。"""
+        try:
+            rows, skipped = pair_vectors(batch, future.result())
+        except Exception as e:
+            logger.error(f"批量向量化失败: {e}")
+            stats.add_failed(len(batch))
+            return
+        stats.add_failed(skipped)
+        if not rows:
+            return
+        try:
+            with self.db.cursor() as cursor:
+                self._write_rows(cursor, id, rows)
+            self.db.commit()
+            stats.add(len(rows), sum(len(questions) for _, _, questions in rows))
+        except Exception as e:
+            logger.error(f"数据库操作失败: {e}")
+            self.db.rollback()
+            stats.add_failed(len(rows))
+
+    def _write_rows(self, cursor, id, rows):
+        """
+        写入一批 (答案, 答案向量, [(问题, 问题向量), ...])，不提交事务。
+
+        先从序列一次性取出答案ID，再用多行 VALUES 一次写入答案和问题，每批只需三次往返。
+
+        Returns:
+            list: 按顺序对应的答案ID。
+        """
+        cursor.execute(f"SELECT nextval(pg_get_serial_sequence('{ANSWER_TABLE_NAME}', '{self.answer_schema.id}')) FROM generate_series(1, %s)", (len(rows),))
+        answer_ids = [row[0] for row in cursor.fetchall()]
+        execute_values(
+            cursor,
+            f"INSERT INTO {ANSWER_TABLE_NAME} ({self.answer_schema.id}, {self.answer_schema.text}, {self.answer_schema.vector}, {self.answer_schema.kb_id}) VALUES %s",
+            [(answer_id, answer_text, VectorParam(answer_vector), id)
+             for answer_id, (answer_text, answer_vector, _) in zip(answer_ids, rows)]
+        )
+        question_entries = [(answer_id, question_text, VectorParam(question_vector))
+                            for answer_id, (_, _, questions) in zip(answer_ids, rows)
+                            for question_text, question_vector in questions]
+        if question_entries:
+            execute_values(
+                cursor,
+                f"INSERT INTO {QUESTION_TABLE_NAME} ({self.answer_schema.id}, {self.question_schema.text}, {self.question_schema.vector}) VALUES %s",
+                question_entries
+            )
+        return answer_ids
+
+    def generate_vectors(self, texts):
+        """批量生成文本的向量表示，按条数和 token 数自动拆分请求。
+
+        Args:
+            texts (list): 输入文本列表。
+
+        Returns:
+            list: 与输入顺序一致的向量列表，未成功向量化的位置为 None。
+        """
+        if self.embedding_cache is not None:
+            return self.embedding_cache.get_or_embed(texts, LLM.embeddings)
+        return LLM.embeddings(texts)
 
     def generate_vector(self, text):
         """生成文本的向量表示，使用spaCy库。
@@ -135,15 +214,22 @@ class DatasetBuilder:
             return {}
         return response.get("data",{}).get("data", [])[0] if response.get("data") else {}
 
-    def query_similarity(self, text, dataset_ids=[], similarity=-1, search_all=False):
+    def query_similarity(self, text, dataset_ids=[], similarity=-1, search_all=False, top_k=None, ef_search=None, probes=None, global_top_k=None):
         """
         计算输入文本与数据库中内容的余弦相似度，并返回包括索引信息和相关内容信息的数据结构。
 
+        所有知识库在一条 SQL 中完成检索，结果通过有界堆合并。
+
         Args:
             dataset_ids (list): 知识库ID列表。
             text (str): 查询的文本。
             similarity (float): 用于过滤的相似度阈值。
             search_all (bool): 是否计算加权平均相似度。
+            top_k (int, optional): 每个知识库最多返回的条数。传入时使用服务端检索模式，
+                由 pgvector 的距离运算符完成排序、阈值过滤和截断；不传则拉取全部数据在本地计算。
+            ef_search (int, optional): 本次查询的 HNSW ef_search，默认使用驱动的索引配置。
+            probes (int, optional): 本次查询的 IVFFlat probes，默认使用驱动的索引配置。
+            global_top_k (int, optional): 所有知识库合计最多返回的条数。
 
         Returns:
             dict: 以知识库ID为键，每个键包含相关内容的列表。
@@ -154,57 +240,110 @@ class DatasetBuilder:
             logger.info("未成功获取知识库实例")
             return None
 
-        input_vector = self.generate_vector(text).get("embedding")
-        if not input_vector:
+        input_vector = self.generate_vectors([text])[0]
+        if input_vector is None:
             logger.info("输入文本未成功向量化")
             return None
 
-        kb_content_map = {}
-
-        for kb_id in dataset_ids:
-            try:
-                # 查询每个kb_id对应的答案和问题数据
-                sql = f"""
-                    SELECT a.{self.answer_schema.vector}, a.{self.answer_schema.text}, a.{self.answer_schema.id},
-                        q.{self.question_schema.vector}, q.{self.question_schema.text}
-                    FROM {ANSWER_TABLE_NAME} AS a
-                    JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
-                    WHERE a.{self.answer_schema.kb_id} = %s"""
-                logger.info(f"[gpt_builder] SQL:{sql}")
-                cursor.execute(sql, (kb_id,))
-                data_list = cursor.fetchall()
-
-                content_list = []
-                for answer_vector, answer_text, answer_id, question_vector, question_text in data_list:
-                    answer_vector_data = json.loads(answer_vector)
-                    question_vector_data = json.loads(question_vector)
-                    answer_similarity = 1 - cosine(input_vector, answer_vector_data)
-                    question_similarity = 1 - cosine(input_vector, question_vector_data)
-                    total_similarity = (answer_similarity + question_similarity) / 2 if search_all else question_similarity
-
-                    if total_similarity < similarity:
-                        continue
-
-                    content_list.append({
-                        "index_id": answer_id,
-                        "related_questions": question_text,
-                        "answer_text": answer_text,
-                        "similarity": total_similarity,
-                        "search_all": search_all
-                    })
-
-                if content_list:
-                    content_list.sort(key=lambda x: x['similarity'], reverse=True)
-                    kb_content_map[kb_id] = content_list
-
-            except Exception as e:
-                logger.error(f"处理知识库 {kb_id} 时出错: {e}")
+        if top_k:
+            rows = self._query_similarity_server(cursor, input_vector, dataset_ids, similarity, search_all, top_k, ef_search, probes)
+        else:
+            rows = self._query_similarity_local(cursor, input_vector, dataset_ids, similarity, search_all)
+        return merge_top_k(rows, dataset_ids, per_kb_top_k=top_k, global_top_k=global_top_k)
+
+    def _query_similarity_local(self, cursor, input_vector, dataset_ids, similarity, search_all):
+        """本地计算模式：一次拉取所有知识库的数据，在本地整批计算相似度。"""
+        sql = f"""
+            SELECT a.{self.answer_schema.kb_id}, a.{self.answer_schema.vector}, a.{self.answer_schema.text}, a.{self.answer_schema.id},
+                q.{self.question_schema.vector}, q.{self.question_schema.text}
+            FROM {ANSWER_TABLE_NAME} AS a
+            JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
+            WHERE a.{self.answer_schema.kb_id} = ANY(%s)"""
+        logger.info(f"[gpt_builder] SQL:{sql}")
+        try:
+            cursor.execute(sql, (list(dataset_ids),))
+            data_list = cursor.fetchall()
+            self.db.commit()
+        except Exception as e:
+            logger.error(f"处理知识库 {dataset_ids} 时出错: {e}")
+            self.db.rollback()
+            return []
+        if not data_list:
+            return []
+
+        # 向量已由驱动解码为 float32 数组，整批做矩阵运算
+        question_similarity = cosine_similarities(input_vector, [row[4] for row in data_list])
+        if search_all:
+            answer_similarity = cosine_similarities(input_vector, [row[1] for row in data_list])
+            total_similarity = (answer_similarity + question_similarity) / 2
+        else:
+            total_similarity = question_similarity
+        rows = []
+        for (kb_id, _, answer_text, answer_id, _, question_text), row_similarity in zip(data_list, total_similarity.tolist()):
+            if row_similarity < similarity:
+                continue
+            rows.append((kb_id, {
+                "index_id": answer_id,
+                "related_questions": question_text,
+                "answer_text": answer_text,
+                "similarity": row_similarity,
+                "search_all": search_all
+            }))
+        return rows
+
+    def _similarity_sql(self, search_all, with_threshold):
+        """
+        生成服务端检索的 SQL。`<=>` 为 pgvector 的余弦距离运算符，相似度 = 1 - 距离。
 
-        return kb_content_map
+        通过 LATERAL 子查询在一条语句中对每个知识库分别做 ORDER BY ... LIMIT，每个子查询都能命中向量索引。
+        只按问题向量检索时直接以列上的距离排序，便于命中向量索引；
+        search_all 时按答案与问题距离的平均值排序，结果与本地模式的加权平均相似度一致。
+        """
+        question_distance = f"(q.{self.question_schema.vector} <=> %(vector)s::vector)"
+        if search_all:
+            answer_distance = f"(a.{self.answer_schema.vector} <=> %(vector)s::vector)"
+            distance = f"({answer_distance} + {question_distance}) / 2"
+        else:
+            distance = question_distance
+        threshold = f" AND 1 - {distance} >= %(similarity)s" if with_threshold else ""
+        return f"""
+            SELECT k.kb_id, t.* FROM unnest(%(kb_ids)s::int[]) AS k(kb_id)
+            CROSS JOIN LATERAL (
+                SELECT a.{self.answer_schema.text}, a.{self.answer_schema.id}, q.{self.question_schema.text},
+                    1 - {distance} AS similarity
+                FROM {ANSWER_TABLE_NAME} AS a
+                JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
+                WHERE a.{self.answer_schema.kb_id} = k.kb_id{threshold}
+                ORDER BY {distance}
+                LIMIT %(top_k)s
+            ) AS t"""
+
+    def _query_similarity_server(self, cursor, input_vector, dataset_ids, similarity, search_all, top_k, ef_search=None, probes=None):
+        """服务端检索模式：在 pgvector 中完成排序和截断，只返回每个知识库的 top_k 条数据。"""
+        # 阈值小于等于 -1 时不会过滤任何数据，省掉这个条件
+        sql = self._similarity_sql(search_all, with_threshold=similarity > -1)
+        logger.info(f"[gpt_builder] SQL:{sql}")
+        try:
+            # SET LOCAL 只在当前事务内生效，查询结束后提交事务即恢复
+            self.db_driver.apply_search_params(cursor, ef_search, probes, dataset_ids)
+            cursor.execute(sql, {"vector": VectorParam(input_vector), "kb_ids": list(dataset_ids), "similarity": similarity, "top_k": top_k})
+            data_list = cursor.fetchall()
+            self.db.commit()
+        except Exception as e:
+            logger.error(f"处理知识库 {dataset_ids} 时出错: {e}")
+            self.db.rollback()
+            return []
+        return [(kb_id, {
+            "index_id": answer_id,
+            "related_questions": question_text,
+            "answer_text": answer_text,
+            "similarity": float(total_similarity),
+            "search_all": search_all
+        }) for kb_id, answer_text, answer_id, question_text, total_similarity in data_list]
 
     def query_regex(self, regex, dataset_ids=[]):
         """
-        根据正则表达式查询数据库中的内容。
+        根据正则表达式查询数据库中的内容，所有知识库在一条 SQL 中完成匹配。
 
         Args:
             regex (str): 查询的正则表达式。
@@ -228,32 +367,32 @@ class DatasetBuilder:
         # 最外层字典，以kb_id为键
         kb_content_map = {}
 
-        for kb_id in dataset_ids:
-            try:
-                # 使用连表查询每个kb_id对应的答案和问题数据
-                sql = f"""
-                    SELECT a.{self.answer_schema.id} AS answer_id, a.{self.answer_schema.text} AS answer_text, q.{self.question_schema.id} AS question_id, q.{self.question_schema.text} AS question_text
-                    FROM {ANSWER_TABLE_NAME} AS a
-                    JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
-                    WHERE a.{self.answer_schema.kb_id} = %s AND q.{self.question_schema.text} ~ %s"""
-                logger.info(f"[gpt_builder] SQL:{sql} param {kb_id, regex}")
-                cursor.execute(sql, (kb_id, regex))
-                data_list = cursor.fetchall()
-
-                for answer_id, answer_text, question_id, question_text in data_list:
-                    if kb_id not in kb_content_map:
-                        kb_content_map[kb_id] = []
-
-                    # 添加到列表
-                    kb_content_map[kb_id].append({
-                        "answer_id": answer_id,
-                        "answer_text": answer_text,
-                        "question_id": question_id,
-                        "related_questions": question_text
-                    })
-
-            except Exception as e:
-                logger.error(f"处理知识库 {kb_id} 时出错: {e}")
+        try:
+            # 使用连表查询所有kb_id对应的答案和问题数据
+            sql = f"""
+                SELECT a.{self.answer_schema.kb_id}, a.{self.answer_schema.id} AS answer_id, a.{self.answer_schema.text} AS answer_text, q.{self.question_schema.id} AS question_id, q.{self.question_schema.text} AS question_text
+                FROM {ANSWER_TABLE_NAME} AS a
+                JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
+                WHERE a.{self.answer_schema.kb_id} = ANY(%s) AND q.{self.question_schema.text} ~ %s"""
+            logger.info(f"[gpt_builder] SQL:{sql} param {dataset_ids, regex}")
+            cursor.execute(sql, (list(dataset_ids), regex))
+            data_list = cursor.fetchall()
+            self.db.commit()
+
+            for kb_id, answer_id, answer_text, question_id, question_text in data_list:
+                if kb_id not in kb_content_map:
+                    kb_content_map[kb_id] = []
+
+                # 添加到列表
+                kb_content_map[kb_id].append({
+                    "answer_id": answer_id,
+                    "answer_text": answer_text,
+                    "question_id": question_id,
+                    "related_questions": question_text
+                })
+
+        except Exception as e:
+            logger.error(f"处理知识库 {dataset_ids} 时出错: {e}")
+            self.db.rollback()
 
         return kb_content_map
-        
\ No newline at end of file
@@ -4,11 +4,24 @@ from ...session_manager.session_manager import ChatGPTSession
 from ...session_manager.session_manager_async import SessionManagerAsync
 from ...session_manager.storage.redis_storage_async import RedisStorageAsync
 
+from ...util.endpoint_pool import EndpointPool, endpoint_pool as default_endpoint_pool
+from ...util.embedding_batcher import build_embedding_payload, count_embedding_tokens, fill_vectors, split_embedding_batches, vectors_to_numpy
+from ...util.cache.response_cache import ResponseCacheAsync
+from ...util.cache.semantic_cache import SemanticCacheAsync
+from ...util.hedging import HedgePolicy, hedged_call, hedged_stream
 from ...util.http_client import http_client
+from ...util.model_router import ModelRouter
+from ...util.retry import Deadline
 from ...util.logger import logger
+from ...util.singleflight import SingleFlightAsync
+from ...util.sse import aiter_chat_deltas
+from ...util.token_estimator import token_estimator
 
+import asyncio
 import json
 
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+
 
 class LLMAsync(BaseBuilder):
 
@@ -16,44 +29,109 @@ class LLMAsync(BaseBuilder):
     def current_plugin(self):
         return self.__current_plugin
 
-    def __init__(self, model, session_storage: RedisStorageAsync, session_id=None, sessioncls = ChatGPTSession):
+    def __init__(self, model, session_storage: RedisStorageAsync, session_id=None, sessioncls = ChatGPTSession, response_cache: ResponseCacheAsync = None, semantic_cache: SemanticCacheAsync = None,
+                 endpoint_pool: EndpointPool = None, singleflight: SingleFlightAsync = None, hedge: HedgePolicy = None,
+                 router: ModelRouter = None):
         """_summary_
 
         Args:
             session_id (_type_): 会话ID，如果为空，会自动生成一个
             session_storage (_type_, optional): _description_. 会话存储器，异步模式必须配置redis存储.
             sessioncls (_type_, optional): _description_. token管理器，目前只有GPT一种所以可以不传.
+            response_cache (ResponseCacheAsync, optional): 响应缓存，相同请求直接返回缓存结果，默认不开启.
+            semantic_cache (SemanticCacheAsync, optional): 语义缓存，最后一条用户消息语义相近时直接返回缓存结果，默认不开启.
+            endpoint_pool (EndpointPool, optional): 端点池（多端点故障转移），默认使用按 config_manager 配置的全局端点池.
+            singleflight (SingleFlightAsync, optional): 请求合并，并发的相同请求只向上游发送一次，传入 RedisSingleFlightAsync 时跨进程合并，默认不开启.
+            hedge (HedgePolicy, optional): 对冲请求，响应慢于最近延迟的分位数时再发送一个请求，先返回的胜出，默认不开启.
+            router (ModelRouter, optional): 模型路由，按提示词长度、价格和延迟为每次请求选择模型，超时或上下文超长时降级，默认不开启.
+                开启时 model 决定会话保留的上下文长度，建议使用候选模型中上下文最长的一个.
         """
         if not config_manager.get_model_config(model):
             raise Exception("没有此模型配置")
         self.session_manager = SessionManagerAsync(sessioncls, session_storage, model)
         super().__init__(session_id=session_id, session_manager=self.session_manager)
         self.__current_plugin = None
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+        self.endpoint_pool = endpoint_pool or default_endpoint_pool
+        self.singleflight = singleflight
+        self.hedge = hedge
+        self.router = router
 
 
     @staticmethod
-    async def embedding(input):
-        """向OpenAI发送请求，获取文本的embedding"""
+    async def embedding(input, model=None, dimensions=None, estimated_tokens=0, endpoint_pool: EndpointPool = None, singleflight: SingleFlightAsync = None):
+        """向OpenAI发送请求，获取文本的embedding
+
+        Args:
+            input (str | list): 文本或文本列表。
+            model (str, optional): embedding 模型，默认使用 config_manager.embedding_model。
+            dimensions (int, optional): 输出向量维度，默认使用 config_manager.embedding_dimensions。
+            estimated_tokens (int, optional): 输入的 token 数，用于 TPM 限流。
+            endpoint_pool (EndpointPool, optional): 端点池，默认使用全局端点池。
+            singleflight (SingleFlightAsync, optional): 请求合并，并发的相同请求只发送一次。
+        """
+        # Authorization 由端点池按选中的端点填充
         headers = {
-            'Authorization': f"Bearer {config_manager.apikey}",
             'Content-Type': 'application/json'
         }
         
         # 准备请求数据
-        payload = {
-            "input": input,
-            "model": "text-embedding-ada-002"
-        }
-        url = config_manager.base_url + "/v1/embeddings"
+        payload = build_embedding_payload(input, model, dimensions)
 
-        curl_command = BaseBuilder.generate_curl_command(url, payload, headers) 
-        logger.info(f"[gpts-builder] {curl_command}")
+        logger.info(f"[gpts-builder] Sending embedding request model: {payload['model']} inputs: {len(input) if isinstance(input, list) else 1}")
 
-        response = await http_client.post_async(url=url, json=payload, headers=headers)
-        # 记录响应
-        logger.info(f"[gpts-builder] Received embedding response: {response}")
+        def send():
+            # 所有重试和端点故障转移共享同一个截止时间
+            deadline = Deadline(60)
+            return (endpoint_pool or default_endpoint_pool).call_async(
+                "/v1/embeddings",
+                lambda url, headers: http_client.post_async(url=url, json=payload, headers=headers, model=payload["model"], estimated_tokens=estimated_tokens, deadline=deadline),
+                headers, deadline=deadline)
+
+        response = await (singleflight.do(singleflight.key(payload, "embedding"), send) if singleflight is not None else send())
+        # 记录响应（不打印向量本身）
+        logger.info(f"[gpts-builder] Received embedding response usage: {response.get('usage') if isinstance(response, dict) else None}")
 
         return response
+
+    @staticmethod
+    async def embeddings(texts, model=None, dimensions=None, max_batch_items=512, max_batch_tokens=100000, concurrency=4, as_numpy=False,
+                         endpoint_pool: EndpointPool = None, singleflight: SingleFlightAsync = None):
+        """批量获取文本的embedding：按条数和 token 数拆分请求并发发送，按输入顺序返回向量。
+
+        Args:
+            texts (list): 文本列表。
+            model (str, optional): embedding 模型，默认使用 config_manager.embedding_model。
+            dimensions (int, optional): 输出向量维度，默认使用 config_manager.embedding_dimensions。
+            max_batch_items (int): 每个请求最多包含的文本条数。
+            max_batch_tokens (int): 每个请求最多包含的 token 数。
+            concurrency (int): 同时进行的请求数。
+            as_numpy (bool): 是否返回 (n, d) 的 float32 数组。
+            endpoint_pool (EndpointPool, optional): 端点池，默认使用全局端点池。
+            singleflight (SingleFlightAsync, optional): 请求合并，并发的相同批次只发送一次。
+
+        Returns:
+            list | numpy.ndarray: 与输入顺序一致的向量，请求失败的位置为 None（数组中为 NaN）。
+        """
+        texts = list(texts)
+        vectors = [None] * len(texts)
+        if texts:
+            model = model or config_manager.embedding_model
+            token_counts = count_embedding_tokens(texts, model)
+            semaphore = asyncio.Semaphore(max(1, concurrency))
+
+            async def request(indices):
+                async with semaphore:
+                    try:
+                        response = await LLMAsync.embedding([texts[i] for i in indices], model, dimensions, sum(token_counts[i] for i in indices),
+                                                            endpoint_pool, singleflight)
+                        fill_vectors(vectors, indices, response)
+                    except Exception as e:
+                        logger.error(f"[gpts-builder] embedding batch failed: {e}")
+
+            await asyncio.gather(*[request(indices) for indices in split_embedding_batches(texts, model, max_batch_items, max_batch_tokens, token_counts)])
+        return vectors_to_numpy(vectors) if as_numpy else vectors
     
     async def chat_completions(self, ** args) -> ChatGPTSession:
         """大模型chat请求，非流式返回
@@ -63,9 +141,8 @@ class LLMAsync(BaseBuilder):
             valid_args = self.validate_chat_args(args, self.session_manager.model)
         except ValueError as e:
             raise Exception(f"Invalid argument: {e}")
-        # 1. 准备请求头
+        # 1. 准备请求头（Authorization 由端点池按选中的端点填充）
         headers = {
-            'Authorization': f"Bearer {config_manager.apikey}",
             'Content-Type': 'application/json'
         }
         # 2. 准备请求数据
@@ -75,24 +152,81 @@ class LLMAsync(BaseBuilder):
             }
         if args:
             payload.update(valid_args)
-        url = config_manager.base_url + "/v1/chat/completions"
 
-        curl_command = BaseBuilder.generate_curl_command(url, payload, headers) 
-        logger.info(f"[gpts-builder] {curl_command}")
+        if self.response_cache is not None:
+            cached = await self.response_cache.get(payload)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions response cache hit")
+                return cached
+        semantic_entry = None
+        if self.semantic_cache is not None:
+            cached, semantic_entry = await self.semantic_cache.lookup(payload, LLMAsync.embeddings)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions semantic cache hit")
+                return cached
 
-        return await http_client.post_async(url=url, json=payload, headers=headers, timeout=60, max_retries=3)
+        prompt_tokens = self.session_prompt_tokens(self.session)
+        estimated_tokens = prompt_tokens + payload.get("max_tokens", 0)
+
+        def sender(body, urls, deadline):
+            """发送 body 的函数，urls 记录选中的端点地址（对冲请求据此避开主请求的端点）。"""
+            def send(url, headers):
+                urls.append(url)
+                curl_command = BaseBuilder.generate_curl_command(url, body, headers)
+                logger.info(f"[gpts-builder] {curl_command}")
+                return http_client.post_async(url=url, json=body, headers=headers, timeout=60, max_retries=3,
+                                              model=body["model"], estimated_tokens=estimated_tokens, deadline=deadline)
+            return send
+
+        async def post(body):
+            # 所有重试、端点故障转移和对冲请求共享同一个截止时间，按模型降级时重新计时
+            deadline = Deadline(60)
+            if self.hedge is None:
+                response = await self.endpoint_pool.call_async(CHAT_COMPLETIONS_PATH, sender(body, [], deadline), headers, deadline=deadline)
+            else:
+                urls = []
+                response = await hedged_call(
+                    self.hedge, "chat",
+                    lambda: self.endpoint_pool.call_async(CHAT_COMPLETIONS_PATH, sender(body, urls, deadline), headers, deadline=deadline),
+                    lambda: self.endpoint_pool.call_async(CHAT_COMPLETIONS_PATH, sender(self._hedge_payload(body), [], deadline), headers,
+                                                          self._hedge_avoid(urls), deadline))
+            # 用上游统计的 prompt_tokens 校准会话的 token 估算；对冲请求可能换了模型，不知道响应来自哪个模型时跳过
+            hedge_model = self.hedge.hedge_model if self.hedge is not None else None
+            if isinstance(response, dict) and "tools" not in body and "functions" not in body and hedge_model in (None, body["model"]):
+                token_estimator.observe_usage(body["model"], body["messages"], response.get("usage"))
+            return response
+
+        async def request():
+            if self.router is None:
+                response = await post(payload)
+            else:
+                response = await self.router.route_async(payload["messages"], lambda model: post(dict(payload, model=model)), payload.get("max_tokens", 0),
+                                                         prompt_tokens)
+            if self.response_cache is not None:
+                await self.response_cache.set(payload, response)
+            if self.semantic_cache is not None:
+                await self.semantic_cache.store(semantic_entry, response)
+            return response
+
+        if self.singleflight is not None:
+            return await self.singleflight.do(self.singleflight.key(payload), request)
+        return await request()
     
-    async def chat_completions_stream(self, **args):
-        """大模型chat请求，流式返回一个异步生成器"""
+    async def chat_completions_stream(self, parse_deltas=False, **args):
+        """大模型chat请求，流式返回一个异步生成器
+
+        Args:
+            parse_deltas (bool): 为 True 时返回解析好的 ChatDelta（content、tool_calls 片段、finish_reason、usage），
+                否则返回原始的 SSE 文本片段。
+        """
         try:
             # 校验传入的参数
             valid_args = self.validate_chat_args(args, self.session_manager.model)
         except ValueError as e:
             raise Exception(f"[gpts-builder] Invalid argument: {e}")
         
-        # 准备请求头
+        # 准备请求头（Authorization 由端点池按选中的端点填充）
         headers = {
-            'Authorization': f"Bearer {config_manager.apikey}",
             'Content-Type': 'application/json'
         }
         
@@ -104,14 +238,86 @@ class LLMAsync(BaseBuilder):
         }
         if args:
             payload.update(valid_args)
+        stream = self._open_stream(payload, headers, decode=not parse_deltas)
+        if parse_deltas:
+            stream = aiter_chat_deltas(stream)
+        async for item in stream:
+            yield item
 
-        url = config_manager.base_url + "/v1/chat/completions"        
-        curl_command = BaseBuilder.generate_curl_command(url, payload, headers) 
-        logger.info(f"[gpts-builder] {curl_command}")
+    async def _open_stream(self, payload, headers, decode=True):
+        """依次查询响应缓存、语义缓存，未命中时发起流式请求；返回 SSE 片段（开启缓存时始终为文本）。"""
+        if self.response_cache is not None:
+            cached = await self.response_cache.get(payload)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions response cache hit, replaying as stream")
+                for line in self.response_cache.replay_stream(cached):
+                    yield line
+                return
+        semantic_entry = None
+        if self.semantic_cache is not None:
+            cached, semantic_entry = await self.semantic_cache.lookup(payload, LLMAsync.embeddings)
+            if cached is not None:
+                logger.info("[gpts-builder] Chat completions semantic cache hit, replaying as stream")
+                for line in self.semantic_cache.replay_stream(cached):
+                    yield line
+                return
 
-        async for line in http_client.post_stream_async(url=url, json=payload, headers=headers, timeout=60):
+        # 缓存和请求合并需要文本片段，开启时不使用原始字节
+        decode = decode or self.response_cache is not None or self.semantic_cache is not None or self.singleflight is not None
+        prompt_tokens = self.session_prompt_tokens(self.session)
+        estimated_tokens = prompt_tokens + payload.get("max_tokens", 0)
+
+        def opener(body, urls, deadline):
+            """打开 body 的流式请求的函数，urls 记录选中的端点地址。"""
+            def open_stream(url, headers):
+                urls.append(url)
+                curl_command = BaseBuilder.generate_curl_command(url, body, headers)
+                logger.info(f"[gpts-builder] {curl_command}")
+                return http_client.post_stream_async(url=url, json=body, headers=headers, timeout=60, decode=decode,
+                                                     model=body["model"], estimated_tokens=estimated_tokens, deadline=deadline)
+            return open_stream
+
+        def open_stream(body):
+            # 所有重试、端点故障转移和对冲请求共享同一个截止时间，按模型降级时重新计时
+            deadline = Deadline(60)
+            if self.hedge is None:
+                return self.endpoint_pool.stream_async(CHAT_COMPLETIONS_PATH, opener(body, [], deadline), headers, deadline=deadline)
+            # 以首个片段的到达时间决定是否对冲
+            urls = []
+            return hedged_stream(
+                self.hedge, "chat_stream",
+                lambda: self.endpoint_pool.stream_async(CHAT_COMPLETIONS_PATH, opener(body, urls, deadline), headers, deadline=deadline),
+                lambda: self.endpoint_pool.stream_async(CHAT_COMPLETIONS_PATH, opener(self._hedge_payload(body), [], deadline), headers,
+                                                        self._hedge_avoid(urls), deadline))
+
+        def upstream():
+            if self.router is None:
+                stream = open_stream(payload)
+            else:
+                stream = self.router.route_stream_async(payload["messages"], lambda model: open_stream(dict(payload, model=model)),
+                                                        payload.get("max_tokens", 0), prompt_tokens)
+            if self.response_cache is not None:
+                stream = self.response_cache.record_stream(payload, stream)
+            if self.semantic_cache is not None:
+                stream = self.semantic_cache.record_stream(semantic_entry, stream)
+            return stream
+
+        if self.singleflight is not None:
+            stream = self.singleflight.stream(self.singleflight.key(payload, "chat_stream"), upstream)
+        else:
+            stream = upstream()
+        async for line in stream:
             yield line 
                         
+    def _hedge_payload(self, payload):
+        """对冲请求的请求体，配置了备用模型时替换模型。"""
+        return dict(payload, model=self.hedge.hedge_model) if self.hedge.hedge_model else payload
+
+    @staticmethod
+    def _hedge_avoid(urls):
+        """主请求已经使用的端点 base_url。"""
+        return [url[:-len(CHAT_COMPLETIONS_PATH)] for url in urls]
+
     async def clear_session(self):
         """清除会话"""
         try:
@@ -1,11 +1,17 @@
+import asyncio
+import random
+
 from ...prompt_base_builder import BaseBuilder
 from ...prompt_template import KB_REFERENCE_TEMPLATE
 from ...util import logger
-from ...session_manager import SessionManagerAsync
+from ...session_manager import SessionConflict, SessionManagerAsync
 
 
 class PromptBuilderAsync(BaseBuilder):
 
+    # 保存会话时发现并发修改后，重新加载会话并重放任务的最多次数
+    max_conflict_retries = 5
+
     @property
     def session(self):
         return self._session
@@ -31,7 +37,7 @@ class PromptBuilderAsync(BaseBuilder):
         self._set_template(system_template)
         self._render_template(**kwargs)
         logger.info(f"set_system content: {self.content}")
-        self._session = await self.session_manager.build_session(self.session_id, self.content)
+        self._session.update_system_prompt(self.content)
         logger.info(f"set_system session: {self._session.messages}")
 
     def set_prompt(self, prompt_template, **kwargs):
@@ -42,7 +48,7 @@ class PromptBuilderAsync(BaseBuilder):
         self._set_template(prompt_template)
         self._render_template(**kwargs)
         logger.info(f"set_prompt content: {self.content}")
-        self._session = await self.session_manager.session_query(self.session_id, self.content)
+        self._session.add_query(self.content)
         logger.info(f"set_prompt session: {self._session.messages}")
 
     def set_kb_reference(self, **kwargs):
@@ -53,14 +59,28 @@ class PromptBuilderAsync(BaseBuilder):
         self._set_template(kb_reference_template)
         self._render_template(**kwargs)
         logger.info(f"set_kb_reference content: {self.content}")
-        self._session = await self.session_manager.session_query(self.session_id, self.content)
+        self._session.add_query(self.content)
         logger.info(f"set_kb_reference session: {self._session.messages}")
 
     async def build(self):
-        """等待所有异步任务完成"""
-        for task, template, kwargs in self._tasks:
-            await task(template, **kwargs)
-        return self
+        """
+        等待所有异步任务完成：读取一次会话，在内存中依次应用所有修改，裁剪一次后写回一次。
+
+        写回时发现会话已被并发修改（同一会话的另一轮对话），重新读取会话并重放任务。
+        """
+        for attempt in range(1, self.max_conflict_retries + 1):
+            self._session, version = await self.session_manager.load_session(self.session_id)
+            for task, template, kwargs in self._tasks:
+                await task(template, **kwargs)
+            try:
+                await self.session_manager.save_session(self._session, version)
+                return self
+            except SessionConflict as e:
+                if attempt == self.max_conflict_retries:
+                    raise
+                logger.info(f"{e}, reloading and replaying {len(self._tasks)} tasks")
+                # 随机退避，避免同时冲突的几轮对话再次同时写入
+                await asyncio.sleep(random.uniform(0, 0.01 * attempt))
 
     
 
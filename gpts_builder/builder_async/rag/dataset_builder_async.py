@@ -1,17 +1,26 @@
 from ..llm.llm_async_builder import LLMAsync
+from ...util.cache.embedding_cache import EmbeddingCacheAsync
 from ...util.db.postgres_vector_async import PostgresVectorAsync
 from ...util.db.schema import EmbbedingSchame, DatasetSchema, KB_TABLE_NAME, ANSWER_TABLE_NAME, QUESTION_TABLE_NAME
 from ...util.id_generator import generate_common_id
+from ...util.db.ingest import IngestStats, aiter_batches, batch_texts, pair_vectors
+from ...util.db.top_k import merge_top_k
+from ...util.db.vector_codec import cosine_similarities
 from ...util.logger import logger
-import json
-from scipy.spatial.distance import cosine
+import asyncio
 
 class DatasetBuilderAsync:     
 
-    def __init__(self, db_driver: PostgresVectorAsync):
-        """初始化知识库插件构建器。"""
+    def __init__(self, db_driver: PostgresVectorAsync, embedding_cache: EmbeddingCacheAsync = None):
+        """初始化知识库插件构建器。
+
+        Args:
+            db_driver (PostgresVectorAsync): 向量数据库驱动。
+            embedding_cache (EmbeddingCacheAsync, optional): embedding 缓存，导入和查询共用，不传则每次都请求接口。
+        """
         super().__init__()
         self.db_driver = db_driver
+        self.embedding_cache = embedding_cache
         self._connection = None
         self.answer_schema = EmbbedingSchame(ANSWER_TABLE_NAME)
         self.question_schema = EmbbedingSchame(QUESTION_TABLE_NAME)
@@ -65,40 +74,160 @@ class DatasetBuilderAsync:
         if not id:
             logger.info("未成功生产知识库实例")
             return
-        async with (await self.db_driver.pool).acquire() as connection:
-            async with connection.transaction():
+        # 先在事务外完成向量化（答案和问题合并为一次请求），不在网络请求期间占用连接
+        rows, skipped = pair_vectors([(index_text, questions_list)], await self.generate_vectors([index_text] + list(questions_list)))
+        if skipped:
+            return
+        try:
+            index_ids = await self._write_rows(id, rows)
+            logger.info(f"index_id {index_ids[0]}")
+        except Exception as e:
+            logger.error(f"数据库操作失败: {e}")
+            # 事务回滚是自动的，但仍可以记录或处理异常
+            raise
+
+    async def create_datas_bulk(self, id, records, batch_size=64, concurrency=4, write_concurrency=2, queue_size=None):
+        """
+        批量导入问答数据：读取、向量化、写库三段流水线并发执行，每批在一个短事务中用 COPY 写入。
+
+        Args:
+            id (int): 知识库ID。
+            records (iterable | async iterable): (答案, 问题列表) 的可迭代对象或异步可迭代对象，按需读取。
+            batch_size (int): 每批包含的答案条数，同一批的答案和问题合并为一次向量化请求。
+            concurrency (int): 同时进行的向量化请求数。
+            write_concurrency (int): 同时写库的连接数。
+            queue_size (int, optional): 流水线各段之间队列的容量，队列满时暂停读取 records（背压），默认 concurrency * 2。
+
+        Returns:
+            dict: 导入统计，包括成功/失败条数、耗时和吞吐量。
+        """
+        if not id:
+            logger.info("未成功生产知识库实例")
+            return
+        stats = IngestStats()
+        queue_size = queue_size or concurrency * 2
+        embed_queue = asyncio.Queue(maxsize=queue_size)
+        write_queue = asyncio.Queue(maxsize=queue_size)
+
+        async def produce():
+            async for batch in aiter_batches(records, batch_size):
+                await embed_queue.put(batch)
+            for _ in range(concurrency):
+                await embed_queue.put(None)
+
+        async def embed():
+            while True:
+                batch = await embed_queue.get()
+                if batch is None:
+                    return
                 try:
-                    # 插入索引并获取ID
-                    sql_query = self.db_driver.get_insert_into_str(ANSWER_TABLE_NAME, [self.answer_schema.text, self.answer_schema.vector, self.answer_schema.kb_id]) + f" RETURNING {self.answer_schema.id}"
-                    logger.info(f"sql_query {sql_query}")
-                    index_vector = await self.generate_vector(index_text)
-                    if not index_vector:
-                        logger.info(f"{index_text} 未成功向量化")
-                        return
-                    index_vector = json.dumps(index_vector)
-                    index_id = await connection.fetchval(
-                        sql_query,
-                        index_text, index_vector, id
-                    )
-                    logger.info(f"index_id {index_id}")
-                    # 批量插入问题
-                    question_entries = []
-                    for question_text in questions_list:
-                        question_vector = await self.generate_vector(question_text)
-                        if question_vector:
-                            question_vector = json.dumps(question_vector)
-                            question_entries.append((index_id, question_text, question_vector))
-                        else:
-                            logger.info(f"{question_text} 未成功向量化")
-                        
-                    if question_entries:
-                        sql_query = self.db_driver.get_insert_into_str(QUESTION_TABLE_NAME, [self.answer_schema.id, self.question_schema.text, self.question_schema.vector]) + f" RETURNING {self.question_schema.id}"
-                        await connection.executemany(sql_query,question_entries)
+                    vectors = await self.generate_vectors(batch_texts(batch))
+                except Exception as e:
+                    logger.error(f"批量向量化失败: {e}")
+                    stats.add_failed(len(batch))
+                    continue
+                await write_queue.put((batch, vectors))
+
+        async def write():
+            while True:
+                item = await write_queue.get()
+                if item is None:
+                    return
+                batch, vectors = item
+                try:
+                    rows, skipped = pair_vectors(batch, vectors)
+                except Exception as e:
+                    logger.error(f"批量向量化失败: {e}")
+                    stats.add_failed(len(batch))
+                    continue
+                stats.add_failed(skipped)
+                if not rows:
+                    continue
+                try:
+                    await self._write_rows(id, rows)
+                    stats.add(len(rows), sum(len(questions) for _, _, questions in rows))
                 except Exception as e:
                     logger.error(f"数据库操作失败: {e}")
-                    # 事务回滚是自动的，但仍可以记录或处理异常
-                    raise
+                    stats.add_failed(len(rows))
+
+        async def close_writers():
+            for _ in range(write_concurrency):
+                await write_queue.put(None)
+
+        tasks = []
 
+        async def wait_all(stage):
+            """等待 stage 中的任务全部结束；任何一段的任务失败时立即抛出它的异常，不会卡在已满的队列上。"""
+            while True:
+                for task in tasks:
+                    if task.done() and not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+                if all(task.done() for task in stage):
+                    return
+                await asyncio.wait([task for task in tasks if not task.done()], return_when=asyncio.FIRST_COMPLETED)
+
+        producer = asyncio.create_task(produce())
+        embedders = [asyncio.create_task(embed()) for _ in range(concurrency)]
+        writers = [asyncio.create_task(write()) for _ in range(write_concurrency)]
+        tasks.extend([producer, *embedders, *writers])
+        try:
+            await wait_all([producer, *embedders])
+            closing = asyncio.create_task(close_writers())
+            tasks.append(closing)
+            await wait_all([closing, *writers])
+        finally:
+            # 出错或调用方取消时取消其余各段，已完成的任务不受影响
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        report = stats.report()
+        logger.info(f"[gpts-builder] 批量导入完成: {report}")
+        return report
+
+    async def _write_rows(self, id, rows):
+        """
+        在一个短事务中写入一批 (答案, 答案向量, [(问题, 问题向量), ...])。
+
+        先从序列一次性取出答案ID，再用二进制 COPY 写入答案和问题。
+
+        Returns:
+            list: 按顺序对应的答案ID。
+        """
+        async with (await self.db_driver.pool).acquire() as connection:
+            async with connection.transaction():
+                answer_ids = [row[0] for row in await connection.fetch(
+                    f"SELECT nextval(pg_get_serial_sequence('{ANSWER_TABLE_NAME}', '{self.answer_schema.id}')) FROM generate_series(1, $1)",
+                    len(rows)
+                )]
+                await connection.copy_records_to_table(
+                    ANSWER_TABLE_NAME,
+                    records=[(answer_id, answer_text, answer_vector, id)
+                             for answer_id, (answer_text, answer_vector, _) in zip(answer_ids, rows)],
+                    columns=[self.answer_schema.id, self.answer_schema.text, self.answer_schema.vector, self.answer_schema.kb_id]
+                )
+                question_entries = [(answer_id, question_text, question_vector)
+                                    for answer_id, (_, _, questions) in zip(answer_ids, rows)
+                                    for question_text, question_vector in questions]
+                if question_entries:
+                    await connection.copy_records_to_table(
+                        QUESTION_TABLE_NAME,
+                        records=question_entries,
+                        columns=[self.answer_schema.id, self.question_schema.text, self.question_schema.vector]
+                    )
+        return answer_ids
+
+    async def generate_vectors(self, texts):
+        """批量生成文本的向量表示，按条数和 token 数自动拆分请求。
+
+        Args:
+            texts (list): 输入文本列表。
+
+        Returns:
+            list: 与输入顺序一致的向量列表，未成功向量化的位置为 None。
+        """
+        if self.embedding_cache is not None:
+            return await self.embedding_cache.get_or_embed(texts, LLMAsync.embeddings)
+        return await LLMAsync.embeddings(texts)
 
     async def generate_vector(self, text):
         """生成文本的向量表示，使用spaCy库。
@@ -117,15 +246,22 @@ class DatasetBuilderAsync:
             return
         return embedding.get("embedding")
 
-    async def query_similarity(self, text, dataset_ids=[], similarity=-1, search_all=False):
+    async def query_similarity(self, text, dataset_ids=[], similarity=-1, search_all=False, top_k=None, ef_search=None, probes=None, global_top_k=None):
         """
         使用联合查询来计算输入文本与数据库中内容的余弦相似度，并返回相关信息。
 
+        所有知识库在一条 SQL 中完成检索，结果通过有界堆合并。
+
         Args:
             dataset_ids (list): 知识库ID列表。
             text (str): 查询的文本。
             similarity (float): 用于过滤的相似度阈值。
             search_all (bool): 是否计算加权平均相似度。
+            top_k (int, optional): 每个知识库最多返回的条数。传入时使用服务端检索模式，
+                由 pgvector 的距离运算符完成排序、阈值过滤和截断；不传则拉取全部数据在本地计算。
+            ef_search (int, optional): 本次查询的 HNSW ef_search，默认使用驱动的索引配置。
+            probes (int, optional): 本次查询的 IVFFlat probes，默认使用驱动的索引配置。
+            global_top_k (int, optional): 所有知识库合计最多返回的条数。
 
         Returns:
             dict: 以知识库ID为键，每个键包含相关内容的列表。
@@ -134,51 +270,102 @@ class DatasetBuilderAsync:
             logger.info("未成功获取知识库实例")
             return None
 
-        input_vector = await self.generate_vector(text)
-        if not input_vector:
+        input_vector = (await self.generate_vectors([text]))[0]
+        if input_vector is None:
             logger.info("输入文本未成功向量化")
             return None
 
-        kb_content_map = {}
+        if top_k:
+            rows = await self._query_similarity_server(input_vector, dataset_ids, similarity, search_all, top_k, ef_search, probes)
+        else:
+            rows = await self._query_similarity_local(input_vector, dataset_ids, similarity, search_all)
+        return merge_top_k(rows, dataset_ids, per_kb_top_k=top_k, global_top_k=global_top_k)
+
+    async def _query_similarity_local(self, input_vector, dataset_ids, similarity, search_all):
+        """本地计算模式：一次拉取所有知识库的数据，在本地整批计算相似度。"""
+        sql = f"""
+            SELECT a.{self.answer_schema.kb_id}, a.{self.answer_schema.vector}, a.{self.answer_schema.text}, a.{self.answer_schema.id},
+                q.{self.question_schema.vector}, q.{self.question_schema.text}
+            FROM {ANSWER_TABLE_NAME} AS a
+            JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
+            WHERE a.{self.answer_schema.kb_id} = ANY($1::int[])"""
+        logger.info(f"[gpt_builder] SQL:{sql}")
+        async with (await self.db_driver.pool).acquire() as connection:
+            data_list = await connection.fetch(sql, list(dataset_ids))
+        if not data_list:
+            return []
+
+        # 向量已由连接上注册的编解码器解码为 float32 数组，整批做矩阵运算
+        question_similarity = cosine_similarities(input_vector, [row[4] for row in data_list])
+        if search_all:
+            answer_similarity = cosine_similarities(input_vector, [row[1] for row in data_list])
+            total_similarity = (answer_similarity + question_similarity) / 2
+        else:
+            total_similarity = question_similarity
+        rows = []
+        for (kb_id, _, answer_text, answer_id, _, question_text), row_similarity in zip(data_list, total_similarity.tolist()):
+            if row_similarity < similarity:
+                continue
+            rows.append((kb_id, {
+                "index_id": answer_id,
+                "related_questions": question_text,
+                "answer_text": answer_text,
+                "similarity": row_similarity,
+                "search_all": search_all
+            }))
+        return rows
+
+    def _similarity_sql(self, search_all, with_threshold):
+        """
+        生成服务端检索的 SQL。`<=>` 为 pgvector 的余弦距离运算符，相似度 = 1 - 距离。
+
+        通过 LATERAL 子查询在一条语句中对每个知识库分别做 ORDER BY ... LIMIT，每个子查询都能命中向量索引。
+        参数: $1 查询向量, $2 知识库ID列表, $3 返回条数, $4 相似度阈值（with_threshold 时）。
+        """
+        question_distance = f"(q.{self.question_schema.vector} <=> $1::vector)"
+        if search_all:
+            answer_distance = f"(a.{self.answer_schema.vector} <=> $1::vector)"
+            distance = f"({answer_distance} + {question_distance}) / 2"
+        else:
+            distance = question_distance
+        threshold = f" AND 1 - {distance} >= $4" if with_threshold else ""
+        return f"""
+            SELECT k.kb_id, t.* FROM unnest($2::int[]) AS k(kb_id)
+            CROSS JOIN LATERAL (
+                SELECT a.{self.answer_schema.text}, a.{self.answer_schema.id}, q.{self.question_schema.text},
+                    1 - {distance} AS similarity
+                FROM {ANSWER_TABLE_NAME} AS a
+                JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
+                WHERE a.{self.answer_schema.kb_id} = k.kb_id{threshold}
+                ORDER BY {distance}
+                LIMIT $3
+            ) AS t"""
+
+    async def _query_similarity_server(self, input_vector, dataset_ids, similarity, search_all, top_k, ef_search=None, probes=None):
+        """服务端检索模式：在 pgvector 中完成排序和截断，只返回每个知识库的 top_k 条数据。"""
+        # 阈值小于等于 -1 时不会过滤任何数据，省掉这个条件
+        with_threshold = similarity > -1
+        sql = self._similarity_sql(search_all, with_threshold)
+        logger.info(f"[gpt_builder] SQL:{sql}")
+        params = [input_vector, list(dataset_ids), top_k]
+        if with_threshold:
+            params.append(similarity)
         async with (await self.db_driver.pool).acquire() as connection:
+            # SET LOCAL 只在当前事务内生效
             async with connection.transaction():
-                for dataset_id in dataset_ids:
-                    sql = f"""
-                        SELECT a.{self.answer_schema.vector}, a.{self.answer_schema.text}, a.{self.answer_schema.id},
-                            q.{self.question_schema.vector}, q.{self.question_schema.text}
-                        FROM {ANSWER_TABLE_NAME} AS a
-                        JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
-                        WHERE a.{self.answer_schema.kb_id} = $1"""
-                    logger.info(f"[gpt_builder] SQL:{sql}")
-                    data_list = await connection.fetch(sql, dataset_id)
-
-                    content_list = []
-                    for answer_vector, answer_text, answer_id, question_vector, question_text in data_list:
-                        answer_vector_data = json.loads(answer_vector)
-                        question_vector_data = json.loads(question_vector)
-                        answer_similarity = 1 - cosine(input_vector, answer_vector_data)
-                        question_similarity = 1 - cosine(input_vector, question_vector_data)
-                        total_similarity = (answer_similarity + question_similarity) / 2 if search_all else question_similarity
-
-                        if total_similarity < similarity:
-                            continue
-
-                        content_list.append({
-                            "index_id": answer_id,
-                            "related_questions": question_text,
-                            "answer_text": answer_text,
-                            "similarity": total_similarity,
-                            "search_all": search_all
-                        })
-
-                    if content_list:
-                        content_list.sort(key=lambda x: x['similarity'], reverse=True)
-                        kb_content_map[dataset_id] = content_list
-        return kb_content_map
+                await self.db_driver.apply_search_params(connection, ef_search, probes, dataset_ids)
+                data_list = await connection.fetch(sql, *params)
+        return [(kb_id, {
+            "index_id": answer_id,
+            "related_questions": question_text,
+            "answer_text": answer_text,
+            "similarity": float(total_similarity),
+            "search_all": search_all
+        }) for kb_id, answer_text, answer_id, question_text, total_similarity in data_list]
     
     async def query_regex(self, regex, dataset_ids=[]):
         """
-        根据正则表达式查询数据库中符合条件的答案索引。
+        根据正则表达式查询数据库中符合条件的答案索引，所有知识库在一条 SQL 中完成匹配。
 
         Args:
             regex (str): 查询的正则表达式。
@@ -194,31 +381,26 @@ class DatasetBuilderAsync:
 
         # 最外层字典，以kb_id为键
         kb_content_map = {}
+        # 使用连表查询所有kb_id对应的答案和问题数据
+        sql = f"""
+            SELECT a.{self.answer_schema.kb_id}, a.{self.answer_schema.id} AS answer_id, a.{self.answer_schema.text} AS answer_text,
+                q.{self.question_schema.id} AS question_id, q.{self.question_schema.text} AS question_text
+            FROM {ANSWER_TABLE_NAME} AS a
+            JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
+            WHERE a.{self.answer_schema.kb_id} = ANY($1::int[]) AND q.{self.question_schema.text} ~ $2"""
         async with (await self.db_driver.pool).acquire() as connection:
-            async with connection.transaction():
-                for kb_id in dataset_ids:
-                    # 使用连表查询每个kb_id对应的答案和问题数据
-                    sql = f"""
-                        SELECT a.{self.answer_schema.id} AS answer_id, a.{self.answer_schema.text} AS answer_text,
-                            q.{self.question_schema.id} AS question_id, q.{self.question_schema.text} AS question_text
-                        FROM {ANSWER_TABLE_NAME} AS a
-                        JOIN {QUESTION_TABLE_NAME} AS q ON a.{self.answer_schema.id} = q.{self.answer_schema.id}
-                        WHERE a.{self.answer_schema.kb_id} = %s AND q.{self.question_schema.text} ~ %s"""
-                    data_list = await connection.fetch(sql, kb_id, regex)
-
-                    for question_text, question_id, answer_id, answer_text in data_list:
-                        if kb_id not in kb_content_map:
-                            kb_content_map[kb_id] = []
-
-                        # 添加到列表
-                        kb_content_map[kb_id].append({
-                            "answer_id": answer_id,
-                            "related_answer": answer_text,
-                            "question_id": question_id,
-                            "questions_text": question_text
-                        })
-
-        return kb_content_map
+            data_list = await connection.fetch(sql, list(dataset_ids), regex)
 
+        for kb_id, answer_id, answer_text, question_id, question_text in data_list:
+            if kb_id not in kb_content_map:
+                kb_content_map[kb_id] = []
 
+            # 添加到列表
+            kb_content_map[kb_id].append({
+                "answer_id": answer_id,
+                "related_answer": answer_text,
+                "question_id": question_id,
+                "questions_text": question_text
+            })
 
+        return kb_content_map
@@ -1,5 +1,5 @@
 from ..util.logger import logger
-from .config_template import MODEL_SETTINGS, TOKEN_SETTINGS, BASE_URL, API_KEY
+from .config_template import MODEL_SETTINGS, TOKEN_SETTINGS, BASE_URL, API_KEY, ENDPOINTS, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, TIKTOKEN_CACHE_DIR
 import json
 
 
@@ -26,12 +26,20 @@ class ConfigManager:
             self.token_settings = config.get('TOKEN_SETTINGS', TOKEN_SETTINGS)
             self.base_url = config.get('BASE_URL', BASE_URL if BASE_URL else "https://www.lazygpt.cn/api")
             self.apikey = config.get('API_KEY', API_KEY if API_KEY else "XXX")
+            self.endpoints = config.get('ENDPOINTS', ENDPOINTS)
+            self.embedding_model = config.get('EMBEDDING_MODEL', EMBEDDING_MODEL)
+            self.embedding_dimensions = config.get('EMBEDDING_DIMENSIONS', EMBEDDING_DIMENSIONS)
+            self.tiktoken_cache_dir = config.get('TIKTOKEN_CACHE_DIR', TIKTOKEN_CACHE_DIR)
         else:
             # 使用默认配置
             self.model_settings = MODEL_SETTINGS
             self.token_settings = TOKEN_SETTINGS
             self.base_url = BASE_URL if BASE_URL else "https://www.lazygpt.cn/api"
             self.apikey = API_KEY if API_KEY else "XXX"
+            self.endpoints = list(ENDPOINTS)
+            self.embedding_model = EMBEDDING_MODEL
+            self.embedding_dimensions = EMBEDDING_DIMENSIONS
+            self.tiktoken_cache_dir = TIKTOKEN_CACHE_DIR
 
 
     def get_model_config(self, model_name):
@@ -47,14 +55,18 @@ class ConfigManager:
         config_dict = {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
         return json.dumps(config_dict, indent=4)
 
-    def set_model_config(self, model_name, max_tokens, token_setting="gpt-3.5-turbo"):
-        """设置或更新模型的最大令牌数，可选更新令牌设置名称。如果模型不存在，则添加新的配置项。"""
+    def set_model_config(self, model_name, max_tokens, token_setting="gpt-3.5-turbo", rpm=None, tpm=None):
+        """设置或更新模型的最大令牌数，可选更新令牌设置名称以及每分钟请求数（rpm）、每分钟 token 数（tpm）限额。如果模型不存在，则添加新的配置项。"""
         found = False
         for config in self.model_settings:
             if config['model'] == model_name:
                 config['max_tokens'] = max_tokens
                 if token_setting is not None:
                     config['token_setting'] = token_setting
+                if rpm is not None:
+                    config['rpm'] = rpm
+                if tpm is not None:
+                    config['tpm'] = tpm
                 found = True
                 break
         if not found:
@@ -64,6 +76,10 @@ class ConfigManager:
             }
             if token_setting:
                 new_config['token_setting'] = token_setting
+            if rpm is not None:
+                new_config['rpm'] = rpm
+            if tpm is not None:
+                new_config['tpm'] = tpm
             self.model_settings.append(new_config)
 
 
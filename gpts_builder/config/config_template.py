@@ -1,5 +1,14 @@
 BASE_URL = "https://www.lazygpt.cn/api"
 API_KEY = ""
+# 多端点配置（故障转移），例如 [{"base_url": "https://api.openai.com", "api_key": "sk-xxx", "weight": 2}]，为空时只使用 BASE_URL / API_KEY
+ENDPOINTS = []
+EMBEDDING_MODEL = "text-embedding-ada-002"
+# 输出向量维度，None 表示使用模型默认维度（只有 text-embedding-3 系列支持指定）
+EMBEDDING_DIMENSIONS = None
+# tiktoken BPE 文件目录（可以直接放 cl100k_base.tiktoken 等文件），None 时使用 TIKTOKEN_CACHE_DIR 环境变量或 tiktoken 默认的下载缓存
+TIKTOKEN_CACHE_DIR = None
+# 模型配置，可选的 rpm / tpm 字段为客户端限流的每分钟请求数和每分钟 token 数（按 API key 分别计算），不配置则不限流
+# 可选的 input_cost / output_cost 字段为每 1000 个输入 / 输出 token 的价格，供模型路由（ModelRouter）参考
 MODEL_SETTINGS = [
         {
             "model": "gpt-3.5-turbo",
@@ -1,6 +1,8 @@
 from .chatgpt_session import ChatGPTSession
-from .session_manager import SessionManager
+from .session_manager import SessionConflict, SessionManager
 from .session_manager_async import SessionManagerAsync
 from .storage.global_storage import global_storage
 from .storage.redis_storage import RedisStorage
-from .storage.redis_storage_async import RedisStorageAsync
\ No newline at end of file
+from .storage.redis_storage_async import RedisStorageAsync
+from .storage.redis_session_storage import RedisSessionStorage
+from .storage.redis_session_storage_async import RedisSessionStorageAsync
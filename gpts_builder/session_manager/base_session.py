@@ -1,8 +1,7 @@
 from ..config.config_manager import config_manager
+from ..util import json_codec
 from ..util.logger import logger
-
-import tiktoken
-import json
+from ..util.tokenizer import encoder_registry
 
 
 class Session(object):
@@ -11,43 +10,132 @@ class Session(object):
     def __init__(self, session_id, system_prompt):
         self.session_id = session_id
         self.messages = []
+        # 与 messages 一一对应的 token 数，随会话一起保存，重新加载时不必再次编码
+        self.message_tokens = []
+        # message_tokens 中前 estimated_messages 条是估算值，其余是精确计数
+        self.estimated_messages = 0
         self.system_prompt = system_prompt
-        
+        self._total_tokens = 0
+        # 已经写入存储的消息条数，为 None 时下次保存需要整体重写
+        self._saved = None
+
+    def to_dict(self):
+        """交给存储后端的会话数据，由存储统一编码一次；下划线开头的内部状态不保存。"""
+        return {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+
     def to_json(self):
-        return json.dumps(self.__dict__)
+        return json_codec.dumps(self.to_dict())
 
     @classmethod
     def from_json(cls, json_str, model):
-        session_dict = json.loads(json_str)
+        """json_str 可以是 JSON 字符串或字节，也可以是存储后端已经解码好的 dict。"""
+        # 旧版本把 to_json 的结果再编码一次存储，读出来仍是字符串
+        session_dict = json_str if isinstance(json_str, dict) else json_codec.loads(json_str)
         session = cls(session_dict['session_id'], system_prompt=session_dict.get('system_prompt', None), model=model)
         session.messages = session_dict.get('messages', [])
+        message_tokens = session_dict.get('message_tokens')
+        if isinstance(message_tokens, list) and len(message_tokens) == len(session.messages):
+            session.message_tokens = list(message_tokens)
+            session._total_tokens = sum(message_tokens)
+            session.estimated_messages = min(session_dict.get('estimated_messages', 0), len(message_tokens))
+        else:
+            # 旧版本保存的会话没有 token 数，加载时计算一次
+            session._sync_tokens()
+        session._saved = len(session.messages)
         return session
 
+    def pending_messages(self):
+        """上次保存之后追加的消息；会话被重置过（需要整体重写）时返回 None。"""
+        if self._saved is None or len(self.messages) < self._saved:
+            return None
+        return self.messages[self._saved:]
+
+    def mark_saved(self, trimmed=0):
+        """保存完成，存储端从头部裁剪了 trimmed 条消息（不含系统消息）时同步到内存中的会话。"""
+        self.discard_oldest(trimmed)
+        self._saved = len(self.messages)
+
+    def count_message_tokens(self, message):
+        """单条消息的 token 数，子类按模型的编码计算，默认按字符数估算。"""
+        return len(message.get("content") or "")
+
+    def estimate_message_tokens(self, message):
+        """离上下文上限足够远时返回单条消息的估算 token 数，否则返回 None（需要精确计数），默认不估算。"""
+        return None
+
+    def _append(self, message):
+        tokens = None
+        # 估算值只能出现在 message_tokens 的开头，一旦有消息精确计数，之后的消息都精确计数
+        if self.estimated_messages == len(self.messages):
+            tokens = self.estimate_message_tokens(message)
+        if tokens is None:
+            tokens = self.count_message_tokens(message)
+        else:
+            self.estimated_messages += 1
+        self.messages.append(message)
+        self.message_tokens.append(tokens)
+        self._total_tokens += tokens
+
+    def _sync_tokens(self):
+        """messages 被直接修改过（条数与 token 数对不上）时重新计数。"""
+        if len(self.message_tokens) != len(self.messages):
+            self.message_tokens = [self.count_message_tokens(message) for message in self.messages]
+            self._total_tokens = sum(self.message_tokens)
+            self.estimated_messages = 0
+
+    def discard_oldest(self, count):
+        """删除系统消息之后最早的 count 条消息。"""
+        if count <= 0:
+            return
+        self._sync_tokens()
+        self._total_tokens -= sum(self.message_tokens[1:1 + count])
+        del self.messages[1:1 + count]
+        del self.message_tokens[1:1 + count]
+        if self.estimated_messages > 1:
+            self.estimated_messages = 1 + max(0, self.estimated_messages - 1 - count)
+
     # 重置会话
     def reset(self):
         system_item = {"role": "system", "content": self.system_prompt}
-        self.messages = [system_item]
+        self.messages = []
+        self.message_tokens = []
+        self.estimated_messages = 0
+        self._total_tokens = 0
+        self._append(system_item)
+        self._saved = None
 
     def set_system_prompt(self, system_prompt):
         self.system_prompt = system_prompt
         self.reset()
 
+    def update_system_prompt(self, system_prompt):
+        """系统提示词变化时才重置会话，每轮传入相同的提示词时保留历史消息。"""
+        if system_prompt != self.system_prompt or not self.messages:
+            self.set_system_prompt(system_prompt)
+
     def add_query(self, query):
         user_item = {"role": "user", "content": query}
-        self.messages.append(user_item)
+        self._append(user_item)
 
     def add_reply(self, reply):
         assistant_item = {"role": "assistant", "content": reply}
-        self.messages.append(assistant_item)
+        self._append(assistant_item)
 
     
     def discard_exceeding(self):
         raise NotImplementedError
 
     def calc_tokens(self):
-        raise NotImplementedError
+        """会话的 token 总数：各条消息的 token 数之和加上回复前缀的 3 个 token。"""
+        self._sync_tokens()
+        return self._total_tokens + 3
+
+    def refine_tokens(self):
+        """需要时把估算的 token 数换成精确计数，返回会话的 token 总数；默认没有估算值。"""
+        return self.calc_tokens()
     
     # refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    @staticmethod
     def num_tokens_from_messages(messages, model):
         """Returns the number of tokens used by a list of messages based on dynamically loaded model settings."""
         model_config = config_manager.get_model_config(model)
@@ -61,12 +149,8 @@ class Session(object):
         tokens_per_message = token_setting.get('tokens_per_message', 3)  # Default value if not specified
         tokens_per_name = token_setting.get('tokens_per_name', 1)       # Default value if not specified
 
-        # Get encoding using tiktoken
-        try:
-            encoding = tiktoken.encoding_for_model(model_config['token_setting'])
-        except KeyError:
-            logger.debug("Warning: model not found. Using cl100k_base encoding.")
-            encoding = tiktoken.get_encoding("cl100k_base")
+        # 编码器在进程内只加载一次，加载失败时抛出 TokenizerUnavailable
+        encoding = encoder_registry.get(model_config['token_setting'])
 
         num_tokens = 0
         for message in messages:
@@ -80,6 +164,16 @@ class Session(object):
         num_tokens += 3  # Assuming every reply is primed with "assistant"
         return num_tokens
     
+    @classmethod
+    def num_tokens_from_message(cls, message, model):
+        """单条消息占用的 token 数（不含回复前缀的 3 个 token），tiktoken 不可用时按字符数估算。"""
+        try:
+            return max(0, cls.num_tokens_from_messages([message], model) - 3)
+        except Exception as e:
+            logger.debug(f"Exception when counting tokens precisely for message: {e}")
+            return len(message.get("content") or "")
+
+    @staticmethod
     def num_tokens_by_character(messages):
         """Returns the number of tokens used by a list of messages."""
         tokens = 0
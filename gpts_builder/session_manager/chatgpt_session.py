@@ -1,6 +1,10 @@
+from bisect import bisect_left
+from itertools import accumulate
+
 from .base_session import Session
 from ..config.config_manager import config_manager
 from ..util.logger import logger
+from ..util.token_estimator import token_estimator
 
 
 """
@@ -20,7 +24,54 @@ class ChatGPTSession(Session):
         self.model = model
         self.reset()
 
+    def max_tokens(self):
+        return (config_manager.get_model_config(self.model) or {}).get('max_tokens', 80000)
+
+    def count_message_tokens(self, message):
+        try:
+            tokens = max(0, self.num_tokens_from_messages([message], self.model) - 3)
+        except Exception as e:
+            logger.debug(f"Exception when counting tokens precisely for message: {e}")
+            return len(message.get("content") or "")
+        if tokens:
+            # 每次精确计数都用来校准估算系数
+            token_estimator.observe_message(self.model, message, tokens)
+        return tokens
+
+    def estimate_message_tokens(self, message):
+        tokens = token_estimator.estimate_message(self.model, message)
+        if token_estimator.is_safe(self.model, self._total_tokens + tokens + 3, self.max_tokens()):
+            return tokens
+        return None
+
+    def refine_tokens(self):
+        """
+        估算的 token 总数（加上误差上界）接近 max_tokens 时，把估算的消息重新精确计数一次。
+
+        精确计数之后 token 数与存储中的不一致，下次保存会整体重写会话。
+        """
+        total_tokens = self.calc_tokens()
+        if not self.estimated_messages or token_estimator.is_safe(self.model, total_tokens, self.max_tokens()):
+            return total_tokens
+        for i in range(self.estimated_messages):
+            tokens = self.count_message_tokens(self.messages[i])
+            self._total_tokens += tokens - self.message_tokens[i]
+            self.message_tokens[i] = tokens
+        logger.debug(f"session tokens near max_tokens, recounted {self.estimated_messages} estimated messages")
+        self.estimated_messages = 0
+        self._saved = None
+        return self.calc_tokens()
+
     def discard_exceeding(self, cur_tokens=None):
+        """
+        删除最早的消息直到不超过模型的 max_tokens，返回剩余的 token 数。
+
+        每条消息的 token 数在加入会话时已经算好，按前缀和二分查找需要删除的条数，不再重复编码。
+        离上限较远时 token 数是估算值，接近上限时先换成精确计数再裁剪。
+
+        Args:
+            cur_tokens (int, optional): 上游返回的 token 数，仅用于日志；会话自己维护 token 数。
+        """
         model_config = config_manager.get_model_config(self.model)
         
         if not model_config:
@@ -29,37 +80,22 @@ class ChatGPTSession(Session):
 
         # Get the token settings for the specified model
         max_tokens = model_config.get('max_tokens', 80000)
-        precise = True
-        try:
-            cur_tokens = self.calc_tokens()
-        except Exception as e:
-            precise = False
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
-            if cur_tokens is None:
-                raise e
-        while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = cur_tokens - max_tokens
-                break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
-                logger.warning(f"user message exceed max_tokens. total_tokens={cur_tokens}")
-                break
+        total_tokens = self.refine_tokens()
+        if cur_tokens is not None:
+            logger.debug(f"session tokens={total_tokens}, reported tokens={cur_tokens}")
+        if total_tokens <= max_tokens:
+            return total_tokens
+        # 系统消息和最后一条消息之外的消息可以删除：找到前缀和第一次不小于超出量的位置
+        removable = list(accumulate(self.message_tokens[1:-1]))
+        count = min(bisect_left(removable, total_tokens - max_tokens) + 1, len(removable))
+        self.discard_oldest(count)
+        total_tokens = self.calc_tokens()
+        if total_tokens > max_tokens and len(self.messages) == 2:
+            if self.messages[1]["role"] == "assistant":
+                self.discard_oldest(1)
+                total_tokens = self.calc_tokens()
             else:
-                logger.debug(f"max_tokens={max_tokens}, total_tokens={cur_tokens}, len(messages)={self.messages}")
-                break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
-        return cur_tokens
-
-    def calc_tokens(self):
-        return self.num_tokens_from_messages(self.messages, self.model)
-
-
+                logger.warning(f"user message exceed max_tokens. total_tokens={total_tokens}")
+        elif total_tokens > max_tokens:
+            logger.debug(f"max_tokens={max_tokens}, total_tokens={total_tokens}, len(messages)={len(self.messages)}")
+        return total_tokens
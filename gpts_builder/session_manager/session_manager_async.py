@@ -1,6 +1,10 @@
 # chatGPT的session管理器,用来存放进程中的一些全局变量，比如上下文回话
+import asyncio
+import random
+from ..config.config_manager import config_manager
 from ..util.logger import logger
 from .chatgpt_session import ChatGPTSession
+from .session_manager import SessionConflict
 
 from .storage.redis_storage_async import RedisStorageAsync
 from typing import Type, Optional
@@ -9,6 +13,8 @@ from typing import Type, Optional
 class SessionManagerAsync(object):
     """这里主要是更新真实的上下文缓存"""
 
+    max_conflict_retries = 5
+
     def __init__(self, sessioncls: Type[ChatGPTSession], session_storage: RedisStorageAsync, model):
         self.session_storage = session_storage
         self.sessioncls = sessioncls
@@ -22,36 +28,96 @@ class SessionManagerAsync(object):
         session_json = await self.session_storage.get(session_id)
         if session_json is None:
             session = self.sessioncls(session_id, system_prompt, self.model)
-            await self.session_storage.set(session_id, session.to_json())
+            await self.session_storage.set(session_id, session.to_dict())
         else:
             session = self.sessioncls.from_json(session_json, self.model)
             if system_prompt is not None:
-                self.sessioncls.set_system_prompt(system_prompt)
-            await self.session_storage.set(session_id, session.to_json(), self.expires_in_seconds)
+                session.update_system_prompt(system_prompt)
+            await self.session_storage.set(session_id, session.to_dict(), self.expires_in_seconds)
         
         return session
 
-    async def session_query(self, session_id, query):
-        session = await self.build_session(session_id)
-        session.add_query(query)
-        await self.session_storage.set(session_id, session.to_json(), self.expires_in_seconds)
-        try:
-            total_tokens = session.discard_exceeding()
-            logger.debug("prompt tokens used={}".format(total_tokens))
-        except Exception as e:
-            logger.debug("Exception when counting tokens precisely for prompt: {}".format(str(e)))
-        return session
+    async def load_session(self, session_id):
+        """
+        读取会话及其版本号，会话不存在时新建（写入由 save_session 完成）。
 
-    async def session_reply(self, session_id, reply, total_tokens=None):
-        session = await self.build_session(session_id)
-        session.add_reply(reply)
-        await self.session_storage.set(session_id, session.to_json(), self.expires_in_seconds)    
+        Returns:
+            tuple: (会话, 版本号)，session_id 为 None 时版本号为 None，会话不会被保存。
+        """
+        if session_id is None:
+            return self.sessioncls(session_id, None, self.model), None
+        session_json, version = await self.session_storage.get_versioned(session_id)
+        if not session_json:
+            return self.sessioncls(session_id, None, self.model), version
+        return self.sessioncls.from_json(session_json, self.model), version
+
+    async def save_session(self, session, version, total_tokens=None):
+        """
+        裁剪超出上下文的消息后写回会话，一次往返完成。
+
+        Raises:
+            SessionConflict: 会话在 load_session 之后被其他请求修改过。
+        """
+        if getattr(self.session_storage, "append_only", False):
+            return await self._save_appended(session, version)
         try:
             tokens_cnt = session.discard_exceeding(total_tokens)
-            logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
+            logger.debug("session tokens={}".format(tokens_cnt))
         except Exception as e:
             logger.debug("Exception when counting tokens precisely for session: {}".format(str(e)))
+        if version is None:
+            return session
+        if not await self.session_storage.set_versioned(session.session_id, session.to_dict(), version, self.expires_in_seconds):
+            raise SessionConflict(f"[gpts-builder] session {session.session_id} was modified concurrently (version {version})")
+        session.mark_saved()
         return session
 
+    async def _save_appended(self, session, version):
+        """追加写入：只发送上次保存之后新增的消息，超出上下文的最早消息由存储端按每条消息的 token 数裁剪。"""
+        if version is None:
+            return session
+        # 接近上限时先把估算的 token 数换成精确计数（会话随之需要整体重写），存储端才能按准确的 token 数裁剪
+        session.refine_tokens()
+        pending = session.pending_messages()
+        replace = pending is None
+        messages = session.messages[1:] if replace else pending
+        # 每条消息的 token 数在加入会话时已经算好
+        tokens = session.message_tokens[len(session.messages) - len(messages):]
+        system_tokens = session.message_tokens[0] + 3 if replace else 0
+        max_tokens = (config_manager.get_model_config(self.model) or {}).get("max_tokens", 0)
+        result = await self.session_storage.save_messages(session.session_id, messages, tokens, version, session.system_prompt,
+                                                          system_tokens, max_tokens, replace, self.expires_in_seconds,
+                                                          session.estimated_messages)
+        if result is None:
+            raise SessionConflict(f"[gpts-builder] session {session.session_id} was modified concurrently (version {version})")
+        trimmed, total_tokens = result
+        session.mark_saved(trimmed)
+        logger.debug("appended {} messages, trimmed {}, session tokens={}".format(len(messages), trimmed, total_tokens))
+        return session
+
+    async def session_query(self, session_id, query):
+        return await self._append(session_id, "add_query", query)
+
+    async def session_reply(self, session_id, reply, total_tokens=None):
+        return await self._append(session_id, "add_reply", reply, total_tokens)
+
+    async def _append(self, session_id, method, content, total_tokens=None):
+        """
+        读取一次会话、追加一条消息后经 save_session 写回：追加写入的存储只发送这一条消息，其他存储按版本号整体写入一次。
+
+        写回时发现会话已被并发修改，重新读取会话再追加。
+        """
+        for attempt in range(1, self.max_conflict_retries + 1):
+            session, version = await self.load_session(session_id)
+            getattr(session, method)(content)
+            try:
+                return await self.save_session(session, version, total_tokens)
+            except SessionConflict as e:
+                if attempt == self.max_conflict_retries:
+                    raise
+                logger.info(f"{e}, reloading and retrying {method}")
+                # 随机退避，避免同时冲突的几轮对话再次同时写入
+                await asyncio.sleep(random.uniform(0, 0.01 * attempt))
+
     async def clear_session(self, session_id):
         await self.session_storage.delete(session_id)
@@ -1,7 +1,8 @@
 """用户进程内部通讯的的公共变量"""
 from ...util.singleton import SingletonMetaThreadSafe as SingletonMetaclass
+from ...util import json_codec
 from ...util.logger import logger
-import json
+from threading import Lock
 
 """
     e.g.  [
@@ -20,18 +21,46 @@ class GlobalStorage(metaclass=SingletonMetaclass):
 
     def __init__(self):
         self.global_map = {}
+        self.versions = {}
+        self._lock = Lock()
     
     def set(self, key, data, expired=24 * 60 * 60) -> bool:
+        """写入数据（不检查版本号），版本号同样加 1，之前 get_versioned 读到的版本随之失效。"""
         if not key:
             raise Exception("找不到key")
-        self.global_map[key] = json.dumps(data)
+        encoded = json_codec.dumps_bytes(data)
+        with self._lock:
+            self.global_map[key] = encoded
+            self.versions[key] = self.versions.get(key, 0) + 1
+        return True
     
     def get(self, key) -> dict:
         if not key:
             raise Exception("找不到key")
         data = self.global_map.get(key)
-        return json.loads(data) if data else None
+        return json_codec.loads(data) if data else None
     
+    def get_versioned(self, key):
+        """读取数据及其版本号，数据不存在时为 (None, 版本号)。"""
+        if not key:
+            raise Exception("找不到key")
+        with self._lock:
+            data = self.global_map.get(key)
+            version = self.versions.get(key, 0)
+        return (json_codec.loads(data) if data else None), version
+
+    def set_versioned(self, key, data, version, expired=None) -> bool:
+        """版本号与 get_versioned 读到的一致时写入并把版本号加 1，否则不写入并返回 False。"""
+        if not key:
+            raise Exception("找不到key")
+        encoded = json_codec.dumps_bytes(data)
+        with self._lock:
+            if self.versions.get(key, 0) != version:
+                return False
+            self.global_map[key] = encoded
+            self.versions[key] = version + 1
+        return True
+
     def delete(self, key) -> bool:
         if not key:
             raise Exception("找不到key")
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+追加写入的 Redis 会话存储：每个会话拆成三个键
+
+    {session_id}:meta      哈希：session_id、system_prompt、版本号、系统消息的 token 数、其余消息的 token 总数、估算 token 数的消息条数
+    {session_id}:messages  列表：除系统消息外的消息（JSON）
+    {session_id}:tokens    列表：与 messages 一一对应的 token 数
+
+每轮对话只 RPUSH 新增的消息，超出上下文的最早消息由服务端脚本按保存的 token 数从列表头部弹出，
+写入量与历史长度无关。键名带 {} 哈希标签，集群模式下三个键落在同一个槽。
+"""
+from ...util import json_codec
+from ...util.singleton import SingletonMetaThreadSafe
+import redis
+
+# 版本号一致（或 ARGV[1] 为 -1 时不检查）时写入消息并裁剪，返回 {裁剪的消息数, 会话 token 总数}，版本冲突时返回 {-1, 0}
+# KEYS: meta, messages, tokens
+# ARGV: 版本号, 是否整体重写(0/1), 过期秒数(0 不过期), 上下文 token 上限(0 不裁剪), 系统消息 token 数, system_prompt, session_id,
+#       开头估算 token 数的消息条数（含系统消息）, 消息数 n, n 条消息, n 个 token 数
+SAVE_SESSION_SCRIPT = """
+local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+local expected = tonumber(ARGV[1])
+if expected >= 0 and version ~= expected then
+    return {-1, 0}
+end
+local estimated = tonumber(ARGV[8])
+local n = tonumber(ARGV[9])
+local total = 0
+if ARGV[2] == '1' then
+    redis.call('DEL', KEYS[2], KEYS[3])
+    redis.call('HSET', KEYS[1], 'session_id', ARGV[7], 'system_prompt', ARGV[6], 'base', ARGV[5])
+else
+    total = tonumber(redis.call('HGET', KEYS[1], 'total') or '0')
+end
+if n > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(ARGV, 10, 9 + n))
+    redis.call('RPUSH', KEYS[3], unpack(ARGV, 10 + n, 9 + 2 * n))
+    for i = 10 + n, 9 + 2 * n do
+        total = total + tonumber(ARGV[i])
+    end
+end
+local base = tonumber(redis.call('HGET', KEYS[1], 'base') or '0')
+local max_tokens = tonumber(ARGV[4])
+local trimmed = 0
+-- 与 ChatGPTSession.discard_exceeding 一致：至少保留最后一条消息
+if max_tokens > 0 then
+    while base + total > max_tokens and redis.call('LLEN', KEYS[2]) > 1 do
+        redis.call('LPOP', KEYS[2])
+        total = total - tonumber(redis.call('LPOP', KEYS[3]) or '0')
+        trimmed = trimmed + 1
+    end
+end
+-- 与 Session.discard_oldest 一致：被裁剪的估算消息不再计入
+if estimated > 1 then
+    estimated = 1 + math.max(0, estimated - 1 - trimmed)
+end
+redis.call('HSET', KEYS[1], 'version', version + 1, 'total', total, 'estimated', estimated)
+local ttl = tonumber(ARGV[3])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    redis.call('EXPIRE', KEYS[2], ttl)
+    redis.call('EXPIRE', KEYS[3], ttl)
+end
+return {trimmed, base + total}
+"""
+
+
+def session_keys(key):
+    return f"{{{key}}}:meta", f"{{{key}}}:messages", f"{{{key}}}:tokens"
+
+
+def decode_session(meta, messages, tokens):
+    """把 meta 哈希、消息列表和 token 数列表还原成会话 dict（系统消息放回第一条），会话不存在时返回 (None, 0)。"""
+    if not meta:
+        return None, 0
+    system_prompt = json_codec.loads(meta["system_prompt"])
+    session = {
+        "session_id": meta["session_id"],
+        "system_prompt": system_prompt,
+        "messages": [{"role": "system", "content": system_prompt}] + [json_codec.loads(message) for message in messages],
+        # meta 中的 base 包含回复前缀的 3 个 token
+        "message_tokens": [max(0, int(meta.get("base", 0)) - 3)] + [int(count) for count in tokens],
+        "estimated_messages": int(meta.get("estimated", 0)),
+    }
+    return session, int(meta.get("version", 0))
+
+
+def save_session_args(session_id, messages, tokens, version, system_prompt, system_tokens, max_tokens, replace, expired, estimated=0):
+    if len(messages) != len(tokens):
+        raise ValueError("messages 与 tokens 的长度不一致")
+    return [version, 1 if replace else 0, expired or 0, max_tokens or 0, system_tokens, json_codec.dumps(system_prompt), session_id,
+            estimated, len(messages)] \
+        + [json_codec.dumps(message) for message in messages] + list(tokens)
+
+
+def split_session(data):
+    """set 整体写入时把会话 dict 拆成系统提示词、其余消息、各自的 token 数和估算的消息条数，没有 token 数时按字符数估算。"""
+    messages = list(data.get("messages", []))
+    tokens = data.get("message_tokens")
+    estimated = data.get("estimated_messages", 0)
+    if not isinstance(tokens, list) or len(tokens) != len(messages):
+        tokens = [len(message.get("content") or "") for message in messages]
+        estimated = 0
+    system_tokens = 3
+    if messages and messages[0].get("role") == "system":
+        system_tokens += tokens[0]
+        messages, tokens = messages[1:], tokens[1:]
+    return data.get("system_prompt"), messages, tokens, system_tokens, estimated
+
+
+class RedisSessionStorage(metaclass=SingletonMetaThreadSafe):
+    """
+    追加写入的会话存储，SessionManager 保存会话时只发送新增的消息。
+
+    Args:
+        url (str): Redis 连接地址。
+    """
+
+    append_only = True
+
+    def __init__(self, url) -> None:
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._save = self._redis.register_script(SAVE_SESSION_SCRIPT)
+
+    def get_versioned(self, key):
+        """在一个事务中读取 meta、消息列表和 token 数列表，返回 (会话 dict, 版本号)。"""
+        if not key:
+            raise Exception("找不到key")
+        meta_key, messages_key, tokens_key = session_keys(key)
+        pipeline = self._redis.pipeline(transaction=True)
+        pipeline.hgetall(meta_key)
+        pipeline.lrange(messages_key, 0, -1)
+        pipeline.lrange(tokens_key, 0, -1)
+        meta, messages, tokens = pipeline.execute()
+        return decode_session(meta, messages, tokens)
+
+    def save_messages(self, key, messages, tokens, version, system_prompt=None, system_tokens=0, max_tokens=0, replace=False, expired=None,
+                      estimated=0):
+        """
+        追加消息（replace 为 True 时整体重写）并按 token 数裁剪最早的消息。
+
+        Args:
+            messages (list): 新增的消息（不含系统消息）。
+            tokens (list): 每条消息的 token 数。
+            version (int): get_versioned 读到的版本号，为 -1 时不检查。
+            system_prompt (str, optional): 整体重写时保存的系统提示词。
+            system_tokens (int): 整体重写时系统消息和回复前缀的 token 数。
+            max_tokens (int): 上下文 token 上限，为 0 时不裁剪。
+            estimated (int): 会话开头 token 数是估算值的消息条数（含系统消息）。
+
+        Returns:
+            tuple | None: (裁剪的消息数, 会话 token 总数)，版本冲突时返回 None。
+        """
+        if not key:
+            raise Exception("找不到key")
+        trimmed, total = self._save(keys=session_keys(key),
+                                    args=save_session_args(key, messages, tokens, version, system_prompt, system_tokens, max_tokens, replace, expired,
+                                                           estimated))
+        return None if trimmed < 0 else (trimmed, total)
+
+    def get(self, key) -> dict:
+        return self.get_versioned(key)[0]
+
+    def set(self, key, data, expired=7200) -> bool:
+        """整体写入会话 dict（不检查版本号）。"""
+        system_prompt, messages, tokens, system_tokens, estimated = split_session(data)
+        return self.save_messages(key, messages, tokens, -1, system_prompt, system_tokens, replace=True, expired=expired,
+                                  estimated=estimated) is not None
+
+    def check(self, key, expired=24 * 60 * 60) -> bool:
+        """刷新会话三个键的过期时间，返回会话是否存在（只有系统消息的会话没有消息和 token 数列表，以 meta 为准）。"""
+        if not key:
+            raise Exception("找不到key")
+        pipeline = self._redis.pipeline(transaction=False)
+        for name in session_keys(key):
+            pipeline.expire(name, expired)
+        return bool(pipeline.execute()[0])
+
+    def delete(self, key) -> None:
+        if not key:
+            raise Exception("找不到key")
+        self._redis.delete(*session_keys(key))
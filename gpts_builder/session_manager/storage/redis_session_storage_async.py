@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from ...util.singleton import SingletonMetaThreadSafe
+from .redis_session_storage import SAVE_SESSION_SCRIPT, decode_session, save_session_args, session_keys, split_session
+
+
+class RedisSessionStorageAsync(metaclass=SingletonMetaThreadSafe):
+    """
+    RedisSessionStorage 的异步版本：消息保存在 Redis 列表中，每轮对话只追加新增的消息。
+
+    Args:
+        url (str): Redis 连接地址。
+    """
+
+    append_only = True
+
+    def __init__(self, url) -> None:
+        # 用到时才导入，见 RedisStorageAsync.__init__
+        import aioredis
+        self._redis_async = aioredis.from_url(url, encoding="utf-8", decode_responses=True)
+        self._save = self._redis_async.register_script(SAVE_SESSION_SCRIPT)
+
+    async def get_versioned(self, key):
+        """在一个事务中读取 meta、消息列表和 token 数列表，返回 (会话 dict, 版本号)。"""
+        if not key:
+            raise Exception("找不到key")
+        meta_key, messages_key, tokens_key = session_keys(key)
+        pipeline = self._redis_async.pipeline(transaction=True)
+        pipeline.hgetall(meta_key)
+        pipeline.lrange(messages_key, 0, -1)
+        pipeline.lrange(tokens_key, 0, -1)
+        meta, messages, tokens = await pipeline.execute()
+        return decode_session(meta, messages, tokens)
+
+    async def save_messages(self, key, messages, tokens, version, system_prompt=None, system_tokens=0, max_tokens=0, replace=False, expired=None,
+                            estimated=0):
+        """追加消息（replace 为 True 时整体重写）并按 token 数裁剪最早的消息，参数同 RedisSessionStorage.save_messages。"""
+        if not key:
+            raise Exception("找不到key")
+        trimmed, total = await self._save(keys=session_keys(key),
+                                          args=save_session_args(key, messages, tokens, version, system_prompt, system_tokens, max_tokens, replace,
+                                                                 expired, estimated))
+        return None if trimmed < 0 else (trimmed, total)
+
+    async def get(self, key) -> dict:
+        return (await self.get_versioned(key))[0]
+
+    async def set(self, key, data, expired=7200) -> bool:
+        """整体写入会话 dict（不检查版本号）。"""
+        system_prompt, messages, tokens, system_tokens, estimated = split_session(data)
+        return await self.save_messages(key, messages, tokens, -1, system_prompt, system_tokens, replace=True, expired=expired,
+                                        estimated=estimated) is not None
+
+    async def check(self, key, expired=24 * 60 * 60) -> bool:
+        """刷新会话三个键的过期时间，返回会话是否存在（以 meta 为准）。"""
+        if not key:
+            raise Exception("找不到key")
+        pipeline = self._redis_async.pipeline(transaction=False)
+        for name in session_keys(key):
+            pipeline.expire(name, expired)
+        return bool((await pipeline.execute())[0])
+
+    async def delete(self, key) -> None:
+        if not key:
+            raise Exception("找不到key")
+        await self._redis_async.delete(*session_keys(key))
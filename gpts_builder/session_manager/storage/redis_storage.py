@@ -1,18 +1,68 @@
 # -*- coding: utf-8 -*-
+from ...util import json_codec
 from ...util.singleton import SingletonMetaThreadSafe
 import redis
-import json
+import uuid
+
+# 版本号一致（或 ARGV[1] 为 -1 时不检查）时写入会话数据并把版本号加 1，两个键的过期时间一起设置
+# KEYS: 数据键, 版本号键; ARGV: 读取时的版本号, 数据, 过期秒数（0 表示不过期）
+SET_IF_VERSION_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+local expected = tonumber(ARGV[1])
+if expected >= 0 and current ~= expected then
+    return 0
+end
+local ttl = tonumber(ARGV[3])
+if ttl > 0 then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ttl)
+    redis.call('SET', KEYS[2], current + 1, 'EX', ttl)
+else
+    redis.call('SET', KEYS[1], ARGV[2])
+    redis.call('SET', KEYS[2], current + 1)
+end
+return 1
+"""
+
+
+# 锁的值是持有者的随机令牌，令牌一致时才删除或续期：锁过期后被其他进程拿到时，原持有者不会误删或续期别人的锁
+# KEYS: 锁; ARGV: 令牌
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# KEYS: 锁; ARGV: 令牌, 过期秒数
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def lock_token():
+    return uuid.uuid4().hex
+
+
+def version_key(key):
+    return f"{key}:version"
 
 
 class RedisStorage(metaclass=SingletonMetaThreadSafe):
 
     def __init__(self, url) -> None:
-        self._redis = redis.Redis(url=url)
+        self._redis = redis.Redis.from_url(url)
+        self._set_if_version = self._redis.register_script(SET_IF_VERSION_SCRIPT)
+        self._release_lock = self._redis.register_script(RELEASE_LOCK_SCRIPT)
+        self._extend_lock = self._redis.register_script(EXTEND_LOCK_SCRIPT)
 
     def set(self, key, data, expired=7200) -> bool:
+        """写入数据（不检查版本号），版本号同样加 1，之前 get_versioned 读到的版本随之失效。"""
         if not key:
             raise Exception("找不到key")
-        return self._redis.setex(key, expired, json.dumps(data))
+        return bool(self._set_if_version(keys=[key, version_key(key)], args=[-1, json_codec.dumps_bytes(data), expired or 0]))
 
     def get(self, key) -> dict:
         if not key:
@@ -20,7 +70,20 @@ class RedisStorage(metaclass=SingletonMetaThreadSafe):
         data = self._redis.get(key)
         if not data:
             return {}
-        return json.loads(data)
+        return json_codec.loads(data)
+
+    def get_versioned(self, key):
+        """一次往返读取数据及其版本号，数据不存在时为 (None, 版本号)。"""
+        if not key:
+            raise Exception("找不到key")
+        data, version = self._redis.mget([key, version_key(key)])
+        return (json_codec.loads(data) if data else None), int(version or 0)
+
+    def set_versioned(self, key, data, version, expired=7200) -> bool:
+        """版本号与 get_versioned 读到的一致时写入（SET+EXPIRE 在一个脚本中原子执行）并把版本号加 1，否则返回 False。"""
+        if not key:
+            raise Exception("找不到key")
+        return bool(self._set_if_version(keys=[key, version_key(key)], args=[version, json_codec.dumps_bytes(data), expired or 0]))
 
     def check(self, key, expired=24 * 60 * 60) -> bool:
         if not key:
@@ -34,21 +97,46 @@ class RedisStorage(metaclass=SingletonMetaThreadSafe):
     
     def enqueue_message(self, message) -> None:
         """将消息添加到队列中"""
-        self._redis.lpush(self.COMMENT_QUEUE_KEY, json.dumps(message))
+        self._redis.lpush(self.COMMENT_QUEUE_KEY, json_codec.dumps_bytes(message))
     
     def dequeue_message(self, timeout=0) -> dict:
         """从队列中移除并返回一条消息"""
         message = self._redis.brpop(self.COMMENT_QUEUE_KEY, timeout=timeout)
         if message:
-            return json.loads(message[1])
+            return json_codec.loads(message[1])
         return None
 
+    def mget_bytes(self, keys) -> list:
+        """批量读取原始字节值（不做 json 解码），不存在的键为 None。"""
+        if not keys:
+            return []
+        return self._redis.mget(keys)
+
+    def mset_bytes(self, mapping, expired=None) -> None:
+        """批量写入原始字节值，通过 pipeline 一次往返完成。"""
+        if not mapping:
+            return
+        pipeline = self._redis.pipeline(transaction=False)
+        for key, value in mapping.items():
+            if expired is None:
+                pipeline.set(key, value)
+            else:
+                pipeline.setex(key, expired, value)
+        pipeline.execute()
+
     def acquire_lock(self, lock_name, lock_timeout=60):
-        """尝试获取锁，成功则返回 True，否则返回 False。"""
-        result = self._redis.set(lock_name, 1, ex=lock_timeout, nx=True)
-        return result is not None
+        """尝试获取锁，成功则返回锁的令牌（传给 release_lock / extend_lock），否则返回 None。"""
+        token = lock_token()
+        result = self._redis.set(lock_name, token, ex=lock_timeout, nx=True)
+        return token if result else None
+
+    def release_lock(self, lock_name, token=None):
+        """释放锁；传入 token 时只释放自己持有的锁，返回是否释放。"""
+        if token is None:
+            return self._redis.delete(lock_name) > 0
+        return bool(self._release_lock(keys=[lock_name], args=[token]))
 
-    def release_lock(self, lock_name):
-        """释放锁。"""
-        self._redis.delete(lock_name)
+    def extend_lock(self, lock_name, token, lock_timeout=60):
+        """锁仍由 token 持有时续期，返回是否续期成功（为 False 时锁已过期或被其他进程持有）。"""
+        return bool(self._extend_lock(keys=[lock_name], args=[token, max(1, int(lock_timeout))]))
 
@@ -1,47 +1,111 @@
 # -*- coding: utf-8 -*-
+from ...util import json_codec
 from ...util.singleton import SingletonMetaThreadSafe
-import aioredis
-import json
+from .redis_storage import EXTEND_LOCK_SCRIPT, RELEASE_LOCK_SCRIPT, SET_IF_VERSION_SCRIPT, lock_token, version_key
 
 
 class RedisStorageAsync(metaclass=SingletonMetaThreadSafe):
 
     def __init__(self, url) -> None:
+        # 用到时才导入：aioredis 2.x 在 Python 3.11 上无法导入，不应影响只用同步存储或会话类的代码
+        import aioredis
         self._redis_async = aioredis.from_url(
                 url,
                 encoding="utf-8",
                 decode_responses=True
             )
+        # 读写原始字节（如向量）使用不做解码的客户端
+        self._redis_async_bytes = aioredis.from_url(url)
+        self._set_if_version = self._redis_async.register_script(SET_IF_VERSION_SCRIPT)
+        self._release_lock = self._redis_async.register_script(RELEASE_LOCK_SCRIPT)
+        self._extend_lock = self._redis_async.register_script(EXTEND_LOCK_SCRIPT)
     
     async def acquire_lock(self, lock_name, lock_timeout=60):
+        """尝试获取锁，成功则返回锁的令牌（传给 release_lock / extend_lock），否则返回 None。"""
+        token = lock_token()
         if lock_timeout == -1:
             # 当不希望键过期时，省略 EX 参数
-            result = await self._redis_async.set(lock_name, 1, nx=True)
+            result = await self._redis_async.set(lock_name, token, nx=True)
         else:
             # 确保过期时间是一个正整数
-            result = await self._redis_async.set(lock_name, 1, ex=max(1, int(lock_timeout)), nx=True)
-        return result is not None
+            result = await self._redis_async.set(lock_name, token, ex=max(1, int(lock_timeout)), nx=True)
+        return token if result else None
 
 
-    async def release_lock(self, lock_name):
-        """释放锁。"""
-        await self._redis_async.delete(lock_name)
+    async def release_lock(self, lock_name, token=None):
+        """释放锁；传入 token 时只释放自己持有的锁，返回是否释放。"""
+        if token is None:
+            return await self._redis_async.delete(lock_name) > 0
+        return bool(await self._release_lock(keys=[lock_name], args=[token]))
+
+    async def extend_lock(self, lock_name, token, lock_timeout=60):
+        """锁仍由 token 持有时续期，返回是否续期成功（为 False 时锁已过期或被其他进程持有）。"""
+        return bool(await self._extend_lock(keys=[lock_name], args=[token, max(1, int(lock_timeout))]))
     
     async def set(self, key, data, expired=None) -> bool:
+        """写入数据（不检查版本号），版本号同样加 1，之前 get_versioned 读到的版本随之失效。"""
         if not key:
             raise Exception("找不到key")
-        if expired is None:
-            # 没有过期时间，使用set命令
-            return await self._redis_async.set(key, json.dumps(data))
-        else:
-            # 有过期时间，使用setex命令
-            return await self._redis_async.setex(key, expired, json.dumps(data))
+        return bool(await self._set_if_version(keys=[key, version_key(key)], args=[-1, json_codec.dumps_bytes(data), expired or 0]))
 
     async def get(self, key):
         if not key:
             raise Exception("找不到key")
         data = await self._redis_async.get(key)
-        return json.loads(data) if data else None
+        return json_codec.loads(data) if data else None
+
+    async def get_versioned(self, key):
+        """一次往返读取数据及其版本号，数据不存在时为 (None, 版本号)。"""
+        if not key:
+            raise Exception("找不到key")
+        data, version = await self._redis_async.mget([key, version_key(key)])
+        return (json_codec.loads(data) if data else None), int(version or 0)
+
+    async def set_versioned(self, key, data, version, expired=None) -> bool:
+        """版本号与 get_versioned 读到的一致时写入（SET+EXPIRE 在一个脚本中原子执行）并把版本号加 1，否则返回 False。"""
+        if not key:
+            raise Exception("找不到key")
+        return bool(await self._set_if_version(keys=[key, version_key(key)], args=[version, json_codec.dumps_bytes(data), expired or 0]))
+
+    async def mget_bytes(self, keys) -> list:
+        """批量读取原始字节值（不做 json 解码），不存在的键为 None。"""
+        if not keys:
+            return []
+        return await self._redis_async_bytes.mget(keys)
+
+    async def mset_bytes(self, mapping, expired=None) -> None:
+        """批量写入原始字节值，通过 pipeline 一次往返完成。"""
+        if not mapping:
+            return
+        pipeline = self._redis_async_bytes.pipeline(transaction=False)
+        for key, value in mapping.items():
+            if expired is None:
+                pipeline.set(key, value)
+            else:
+                pipeline.setex(key, expired, value)
+        await pipeline.execute()
+
+    async def exists(self, key) -> bool:
+        if not key:
+            raise Exception("找不到key")
+        return await self._redis_async.exists(key) > 0
+
+    async def append_stream(self, key, fields, expired=None) -> None:
+        """向 Redis Stream 追加一条消息，同时刷新整个 Stream 的过期时间。"""
+        if not key:
+            raise Exception("找不到key")
+        pipeline = self._redis_async.pipeline(transaction=False)
+        pipeline.xadd(key, fields)
+        if expired is not None:
+            pipeline.expire(key, expired)
+        await pipeline.execute()
+
+    async def read_stream(self, key, last_id="0", block=None) -> list:
+        """读取 Redis Stream 中 last_id 之后的消息，返回 [(id, fields)]；block 为最长阻塞毫秒数，为 None 时不阻塞。"""
+        if not key:
+            raise Exception("找不到key")
+        result = await self._redis_async.xread({key: last_id}, block=block)
+        return result[0][1] if result else []
 
     async def check(self, key, expired=24 * 60 * 60) -> bool:
         if not key:
@@ -60,13 +124,13 @@ class RedisStorageAsync(metaclass=SingletonMetaThreadSafe):
     
     async def enqueue_message(self, queue_name, message) -> None:
         """异步将消息添加到队列中"""
-        await self._redis_async.lpush(queue_name, json.dumps(message))
+        await self._redis_async.lpush(queue_name, json_codec.dumps_bytes(message))
 
     async def dequeue_message(self, queue_name, timeout=0) -> dict:
         """异步从队列中移除并返回一条消息"""
         message = await self._redis_async.brpop(queue_name, timeout=timeout)
         if message:
-            return json.loads(message[1])
+            return json_codec.loads(message[1])
         return None
 
     async def get_queue_length(self, queue_name):
@@ -5,4 +5,5 @@ from .singleton import SingletonMetaThreadSafe
 from .sys_env import get_env
 
 from .db.postgres_vector import PostgresVector
-from .db.postgres_vector_async import PostgresVectorAsync
\ No newline at end of file
+from .db.postgres_vector_async import PostgresVectorAsync
+from .db.vector_index import VectorIndexConfig
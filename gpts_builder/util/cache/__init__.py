@@ -0,0 +1,4 @@
+from .lru_cache import LRUCache
+from .embedding_cache import EmbeddingCache, EmbeddingCacheAsync
+from .response_cache import ResponseCache, ResponseCacheAsync
+from .semantic_cache import SemanticCache, SemanticCacheAsync, LocalVectorIndex, PgVectorSemanticIndex, PgVectorSemanticIndexAsync
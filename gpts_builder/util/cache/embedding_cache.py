@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+embedding 缓存：以 (模型, 维度, 规范化文本哈希) 为键，进程内 LRU 为一级缓存，可选 Redis 为二级缓存。
+
+向量统一以 float32 保存，Redis 中存放原始字节（每维 4 字节），不经过 json。
+"""
+from threading import Lock
+import hashlib
+import unicodedata
+
+import numpy as np
+
+from ...config.config_manager import config_manager
+from .lru_cache import LRUCache
+
+
+def normalize_text(text):
+    """规范化文本：NFKC 归一化并合并空白，使只有空白或全半角差异的文本命中同一条缓存。"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def encode_vector(vector) -> bytes:
+    return np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def decode_vector(data) -> np.ndarray:
+    return np.frombuffer(data, dtype=np.float32)
+
+
+class EmbeddingCache:
+    """
+    同步 embedding 缓存。
+
+    Args:
+        maxsize (int): 进程内 LRU 的最大条数。
+        storage (RedisStorage, optional): Redis 二级缓存，不传则只使用进程内缓存。
+        expired (int): Redis 中缓存的过期时间（秒）。
+        namespace (str): Redis 键前缀。
+    """
+
+    def __init__(self, maxsize=10000, storage=None, expired=7 * 24 * 3600, namespace="gpts_builder:embedding"):
+        self.local = LRUCache(maxsize)
+        self.storage = storage
+        self.expired = expired
+        self.namespace = namespace
+        self._stats_lock = Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def make_key(self, text, model=None, dimensions=None):
+        model = model or config_manager.embedding_model
+        dimensions = dimensions or config_manager.embedding_dimensions or 0
+        digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{model}:{dimensions}:{digest}"
+
+    def stats(self):
+        """缓存命中统计。"""
+        total = self.local_hits + self.redis_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.local_hits + self.redis_hits) / total, 4) if total else 0.0,
+            "local_size": len(self.local),
+        }
+
+    def _count(self, local_hits=0, redis_hits=0, misses=0):
+        with self._stats_lock:
+            self.local_hits += local_hits
+            self.redis_hits += redis_hits
+            self.misses += misses
+
+    def _lookup_local(self, texts, model, dimensions):
+        """
+        查询进程内缓存。
+
+        Returns:
+            tuple: (keys, vectors, missing)。missing 为未命中的键到文本的映射（同一文本只出现一次）。
+        """
+        keys = [self.make_key(text, model, dimensions) for text in texts]
+        vectors = [self.local.get(key) for key in keys]
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+        return keys, vectors, missing
+
+    def _store(self, found, keys, vectors):
+        """把找到的向量写入进程内缓存并回填到结果中。"""
+        for key, vector in found.items():
+            self.local.set(key, vector)
+        for position, key in enumerate(keys):
+            if vectors[position] is None:
+                vectors[position] = found.get(key)
+        return vectors
+
+    @staticmethod
+    def _decode_hits(missing_keys, raw_values):
+        return {key: decode_vector(raw) for key, raw in zip(missing_keys, raw_values) if raw}
+
+    @staticmethod
+    def _collect_embedded(missing_keys, embedded):
+        """整理新计算出的向量，返回 (键到 float32 数组的映射, 需要写入 Redis 的字节映射)。"""
+        found, to_store = {}, {}
+        for key, vector in zip(missing_keys, embedded):
+            if vector is None:
+                continue
+            array = np.asarray(vector, dtype=np.float32)
+            found[key] = array
+            to_store[key] = array.tobytes()
+        return found, to_store
+
+    def get_or_embed(self, texts, embed, model=None, dimensions=None):
+        """
+        按输入顺序返回向量，未命中缓存的文本（去重后）一次性交给 embed 计算并写回缓存。
+
+        Args:
+            texts (list): 文本列表。
+            embed (callable): 接收文本列表、返回同顺序向量列表的函数，如 LLM.embeddings。
+
+        Returns:
+            list: float32 数组列表，计算失败的位置为 None。
+        """
+        texts = list(texts)
+        keys, vectors, missing = self._lookup_local(texts, model, dimensions)
+        local_hits = len(texts) - sum(1 for vector in vectors if vector is None)
+        found = {}
+        if missing and self.storage is not None:
+            missing_keys = list(missing)
+            found = self._decode_hits(missing_keys, self.storage.mget_bytes(missing_keys))
+            for key in found:
+                missing.pop(key)
+        redis_hits = len(found)
+        if missing:
+            missing_keys = list(missing)
+            embedded, to_store = self._collect_embedded(missing_keys, embed([missing[key] for key in missing_keys]))
+            found.update(embedded)
+            if self.storage is not None and to_store:
+                self.storage.mset_bytes(to_store, self.expired)
+        self._count(local_hits, redis_hits, len(missing))
+        return self._store(found, keys, vectors)
+
+
+class EmbeddingCacheAsync(EmbeddingCache):
+    """
+    异步 embedding 缓存，Redis 二级缓存使用 RedisStorageAsync。
+    """
+
+    async def get_or_embed(self, texts, embed, model=None, dimensions=None):
+        """
+        按输入顺序返回向量，未命中缓存的文本（去重后）一次性交给 embed 计算并写回缓存。
+
+        Args:
+            texts (list): 文本列表。
+            embed (callable): 接收文本列表、返回同顺序向量列表的协程函数，如 LLMAsync.embeddings。
+
+        Returns:
+            list: float32 数组列表，计算失败的位置为 None。
+        """
+        texts = list(texts)
+        keys, vectors, missing = self._lookup_local(texts, model, dimensions)
+        local_hits = len(texts) - sum(1 for vector in vectors if vector is None)
+        found = {}
+        if missing and self.storage is not None:
+            missing_keys = list(missing)
+            found = self._decode_hits(missing_keys, await self.storage.mget_bytes(missing_keys))
+            for key in found:
+                missing.pop(key)
+        redis_hits = len(found)
+        if missing:
+            missing_keys = list(missing)
+            embedded, to_store = self._collect_embedded(missing_keys, await embed([missing[key] for key in missing_keys]))
+            found.update(embedded)
+            if self.storage is not None and to_store:
+                await self.storage.mset_bytes(to_store, self.expired)
+        self._count(local_hits, redis_hits, len(missing))
+        return self._store(found, keys, vectors)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+chat completions 的精确匹配响应缓存：以请求体（messages、model、temperature、tools、seed 等）的规范化哈希为键。
+
+默认使用进程内 LRU（带 TTL），也可以传入 RedisStorage / RedisStorageAsync 作为后端在多进程间共享。
+流式请求的结果会被组装成非流式的响应保存，命中时再按 SSE 格式回放。
+"""
+from threading import Lock
+import hashlib
+import json
+import time
+
+from .lru_cache import LRUCache
+from ..sse import SSEParser
+
+# 只影响传输方式、不影响生成结果的字段，不参与缓存键计算
+TRANSPORT_FIELDS = ("stream", "stream_options")
+
+
+def payload_cache_key(payload, namespace):
+    """请求体的规范化哈希：去掉传输相关字段后按键排序序列化，流式和非流式请求共用同一条缓存。"""
+    canonical = {key: value for key, value in payload.items() if key not in TRANSPORT_FIELDS}
+    data = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return f"{namespace}:{hashlib.sha256(data.encode('utf-8')).hexdigest()}"
+
+
+def assemble_stream(text):
+    """
+    把流式返回的 SSE 文本组装成非流式的 chat.completion 响应。
+
+    Returns:
+        dict | None: 组装后的响应，流没有以 [DONE] 正常结束时返回 None。
+    """
+    completion = {"object": "chat.completion", "choices": []}
+    choices = {}
+    parser = SSEParser()
+    events = parser.feed(text) + parser.close()
+    if not parser.done:
+        return None
+    for data in events:
+        try:
+            chunk = json.loads(data)
+        except ValueError:
+            continue
+        for key in ("id", "created", "model", "system_fingerprint"):
+            if chunk.get(key) is not None:
+                completion[key] = chunk[key]
+        if chunk.get("usage"):
+            completion["usage"] = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            index = choice.get("index", 0)
+            merged = choices.setdefault(index, {"index": index, "message": {"role": "assistant", "content": None}, "finish_reason": None})
+            message = merged["message"]
+            delta = choice.get("delta") or {}
+            if delta.get("role"):
+                message["role"] = delta["role"]
+            if delta.get("content"):
+                message["content"] = (message["content"] or "") + delta["content"]
+            for tool_call in delta.get("tool_calls") or []:
+                tool_calls = message.setdefault("tool_calls", [])
+                position = tool_call.get("index", len(tool_calls))
+                while len(tool_calls) <= position:
+                    tool_calls.append({"id": None, "type": "function", "function": {"name": "", "arguments": ""}})
+                target = tool_calls[position]
+                if tool_call.get("id"):
+                    target["id"] = tool_call["id"]
+                if tool_call.get("type"):
+                    target["type"] = tool_call["type"]
+                function = tool_call.get("function") or {}
+                target["function"]["name"] += function.get("name") or ""
+                target["function"]["arguments"] += function.get("arguments") or ""
+            if choice.get("finish_reason"):
+                merged["finish_reason"] = choice["finish_reason"]
+    completion["choices"] = [choices[index] for index in sorted(choices)]
+    return completion
+
+
+def replay_stream(response):
+    """把非流式的响应按 chat.completion.chunk 的 SSE 格式回放，结尾附带 [DONE]。"""
+    base = {
+        "id": response.get("id"),
+        "object": "chat.completion.chunk",
+        "created": response.get("created", int(time.time())),
+        "model": response.get("model"),
+    }
+    for choice in response.get("choices") or []:
+        message = choice.get("message") or {}
+        delta = {"role": message.get("role", "assistant"), "content": message.get("content")}
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [dict(tool_call, index=position) for position, tool_call in enumerate(message["tool_calls"])]
+        yield _sse(dict(base, choices=[{"index": choice.get("index", 0), "delta": delta, "finish_reason": None}]))
+        yield _sse(dict(base, choices=[{"index": choice.get("index", 0), "delta": {}, "finish_reason": choice.get("finish_reason", "stop")}]))
+    if response.get("usage"):
+        yield _sse(dict(base, choices=[], usage=response["usage"]))
+    yield "data: [DONE]\n\n"
+
+
+def _sse(chunk):
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+class ResponseCache:
+    """
+    同步响应缓存。
+
+    Args:
+        maxsize (int): 进程内缓存的最大条数（LRU 淘汰）。
+        ttl (int): 缓存有效期（秒）。
+        storage (RedisStorage, optional): Redis 后端，传入时不再使用进程内缓存。
+        allow_nondeterministic (bool): temperature > 0（未传时接口默认为 1）时是否也缓存，默认跳过。
+        namespace (str): 缓存键前缀。
+    """
+
+    def __init__(self, maxsize=1000, ttl=3600, storage=None, allow_nondeterministic=False, namespace="gpts_builder:chat"):
+        self.local = LRUCache(maxsize, ttl)
+        self.ttl = ttl
+        self.storage = storage
+        self.allow_nondeterministic = allow_nondeterministic
+        self.namespace = namespace
+        self._stats_lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    def is_cacheable(self, payload):
+        if self.allow_nondeterministic:
+            return True
+        return payload.get("temperature", 1) == 0 and payload.get("n", 1) == 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bypasses": self.bypasses, "local_size": len(self.local)}
+
+    def _count(self, hits=0, misses=0, bypasses=0):
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += misses
+            self.bypasses += bypasses
+
+    def _lookup_key(self, payload):
+        """返回缓存键，不可缓存的请求返回 None 并计入 bypass。"""
+        if not self.is_cacheable(payload):
+            self._count(bypasses=1)
+            return None
+        return payload_cache_key(payload, self.namespace)
+
+    def _hit(self, data):
+        """统计命中情况；进程内缓存保存的是 json 文本（避免调用方修改缓存内容），Redis 后端已经解码。"""
+        if not data:
+            self._count(misses=1)
+            return None
+        self._count(hits=1)
+        return json.loads(data) if isinstance(data, str) else data
+
+    def get(self, payload):
+        """查询缓存，未命中或不可缓存时返回 None。"""
+        key = self._lookup_key(payload)
+        if key is None:
+            return None
+        if self.storage is not None:
+            return self._hit(self.storage.get(key))
+        return self._hit(self.local.get(key))
+
+    def set(self, payload, response):
+        if not response or not self.is_cacheable(payload):
+            return
+        key = payload_cache_key(payload, self.namespace)
+        if self.storage is not None:
+            self.storage.set(key, response, self.ttl)
+        else:
+            self.local.set(key, json.dumps(response, ensure_ascii=False))
+
+    def replay_stream(self, response):
+        return replay_stream(response)
+
+    def record_stream(self, payload, stream):
+        """透传流式响应，正常结束后把组装好的完整响应写入缓存。"""
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        self.set(payload, assemble_stream("".join(chunks)))
+
+
+class ResponseCacheAsync(ResponseCache):
+    """
+    异步响应缓存，Redis 后端使用 RedisStorageAsync。
+    """
+
+    async def get(self, payload):
+        """查询缓存，未命中或不可缓存时返回 None。"""
+        key = self._lookup_key(payload)
+        if key is None:
+            return None
+        if self.storage is not None:
+            return self._hit(await self.storage.get(key))
+        return self._hit(self.local.get(key))
+
+    async def set(self, payload, response):
+        if not response or not self.is_cacheable(payload):
+            return
+        key = payload_cache_key(payload, self.namespace)
+        if self.storage is not None:
+            await self.storage.set(key, response, self.ttl)
+        else:
+            self.local.set(key, json.dumps(response, ensure_ascii=False))
+
+    async def record_stream(self, payload, stream):
+        """透传流式响应，正常结束后把组装好的完整响应写入缓存。"""
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        await self.set(payload, assemble_stream("".join(chunks)))
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+语义响应缓存：对最后一条用户消息做 embedding，在同一命名空间（业务命名空间 + 模型 + 系统提示词等指纹）内
+查找相似度超过阈值的历史问题，命中时直接返回保存的回答，不再请求大模型。
+
+向量索引可以是进程内的 LocalVectorIndex，也可以是 pgvector 表（PgVectorSemanticIndex / PgVectorSemanticIndexAsync）。
+"""
+from collections import deque
+from threading import Lock
+import hashlib
+import inspect
+import json
+import time
+
+import numpy as np
+
+from .response_cache import assemble_stream, replay_stream
+from ..db.vector_codec import VectorParam
+from ..db.vector_index import vector_column_type
+
+SEMANTIC_CACHE_TABLE_NAME = "semantic_cache"
+
+# 参与命名空间指纹计算的请求字段：这些字段不同的请求不能共用回答
+FINGERPRINT_FIELDS = ("model", "tools", "tool_choice", "response_format", "functions")
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class LocalVectorIndex:
+    """
+    进程内向量索引，每个命名空间一份归一化后的向量矩阵，检索为一次矩阵乘法。
+    回答以 json 文本保存，避免调用方修改缓存内容。
+
+    超过 max_entries 时淘汰最久未命中的条目，ttl（秒）到期的条目在检索时跳过并清理。
+    """
+
+    def __init__(self, max_entries=10000, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._namespaces = {}
+        self._lock = Lock()
+
+    def _entries(self, namespace):
+        return self._namespaces.setdefault(namespace, {"vectors": [], "responses": [], "created": [], "last_hit": [], "matrix": None})
+
+    def search(self, namespace, vector):
+        """返回 (相似度, 回答)，命名空间为空时返回 (None, None)。"""
+        with self._lock:
+            entries = self._namespaces.get(namespace)
+            if not entries or not entries["vectors"]:
+                return None, None
+            self._expire(entries)
+            if not entries["vectors"]:
+                return None, None
+            if entries["matrix"] is None:
+                entries["matrix"] = np.vstack(entries["vectors"])
+            scores = entries["matrix"] @ _normalize(vector)
+            best = int(np.argmax(scores))
+            entries["last_hit"][best] = time.monotonic()
+            return float(scores[best]), json.loads(entries["responses"][best])
+
+    def add(self, namespace, vector, response):
+        with self._lock:
+            entries = self._entries(namespace)
+            now = time.monotonic()
+            entries["vectors"].append(_normalize(vector))
+            entries["responses"].append(json.dumps(response, ensure_ascii=False))
+            entries["created"].append(now)
+            entries["last_hit"].append(now)
+            if len(entries["vectors"]) > self.max_entries:
+                self._remove(entries, int(np.argmin(entries["last_hit"])))
+            entries["matrix"] = None
+
+    def _expire(self, entries):
+        if not self.ttl:
+            return
+        deadline = time.monotonic() - self.ttl
+        for position in range(len(entries["created"]) - 1, -1, -1):
+            if entries["created"][position] < deadline:
+                self._remove(entries, position)
+                entries["matrix"] = None
+
+    @staticmethod
+    def _remove(entries, position):
+        for field in ("vectors", "responses", "created", "last_hit"):
+            entries[field].pop(position)
+
+    def clear(self, namespace=None):
+        with self._lock:
+            if namespace is None:
+                self._namespaces.clear()
+            else:
+                self._namespaces.pop(namespace, None)
+
+
+class PgVectorSemanticIndex:
+    """
+    基于 pgvector 表的语义缓存索引（psycopg2 驱动），多个进程共享缓存。
+
+    Args:
+        db_driver (PostgresVector): 向量数据库驱动，使用其连接和向量维度。
+        max_entries (int): 每个命名空间保留的最大条数，超过时按最近命中时间淘汰。
+        ttl (int, optional): 条目有效期（秒）。
+        prune_interval (int): 每写入多少条执行一次淘汰。
+    """
+
+    def __init__(self, db_driver, max_entries=10000, ttl=None, prune_interval=100):
+        self.db_driver = db_driver
+        self.db = db_driver.db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._writes = 0
+        self.create_table()
+
+    def create_table(self):
+        with self.db.cursor() as cursor:
+            for statement in self._create_table_sql():
+                cursor.execute(statement)
+        self.db.commit()
+
+    def _create_table_sql(self):
+        return [
+            f"""
+            CREATE TABLE IF NOT EXISTS {SEMANTIC_CACHE_TABLE_NAME} (
+                id BIGSERIAL PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                vector {vector_column_type(self.db_driver.dimension)},
+                response TEXT,
+                create_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_hit_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            f"CREATE INDEX IF NOT EXISTS {SEMANTIC_CACHE_TABLE_NAME}_namespace_idx ON {SEMANTIC_CACHE_TABLE_NAME} (namespace)",
+        ]
+
+    def search(self, namespace, vector):
+        ttl_condition = f" AND create_time > CURRENT_TIMESTAMP - make_interval(secs => {float(self.ttl)})" if self.ttl else ""
+        with self.db.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT id, response, 1 - (vector <=> %(vector)s::vector) FROM {SEMANTIC_CACHE_TABLE_NAME}
+                WHERE namespace = %(namespace)s{ttl_condition}
+                ORDER BY vector <=> %(vector)s::vector LIMIT 1""", {"vector": VectorParam(vector), "namespace": namespace})
+            row = cursor.fetchone()
+            if row:
+                cursor.execute(f"UPDATE {SEMANTIC_CACHE_TABLE_NAME} SET last_hit_time = CURRENT_TIMESTAMP WHERE id = %s", (row[0],))
+        self.db.commit()
+        if not row:
+            return None, None
+        return float(row[2]), json.loads(row[1])
+
+    def add(self, namespace, vector, response):
+        with self.db.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {SEMANTIC_CACHE_TABLE_NAME} (namespace, vector, response) VALUES (%s, %s, %s)",
+                           (namespace, VectorParam(vector), json.dumps(response, ensure_ascii=False)))
+            self._writes += 1
+            if self._writes % self.prune_interval == 0:
+                cursor.execute(self._prune_sql("%(namespace)s", "%(limit)s"), {"namespace": namespace, "limit": self.max_entries})
+        self.db.commit()
+
+    def _prune_sql(self, namespace_placeholder, limit_placeholder):
+        """删除超出条数上限（按最近命中时间保留）以及过期的条目，占位符由调用方按驱动传入。"""
+        ttl_condition = f" OR create_time < CURRENT_TIMESTAMP - make_interval(secs => {float(self.ttl)})" if self.ttl else ""
+        return f"""
+            DELETE FROM {SEMANTIC_CACHE_TABLE_NAME} WHERE namespace = {namespace_placeholder} AND (id NOT IN (
+                SELECT id FROM {SEMANTIC_CACHE_TABLE_NAME} WHERE namespace = {namespace_placeholder}
+                ORDER BY last_hit_time DESC LIMIT {limit_placeholder}
+            ){ttl_condition})"""
+
+
+class PgVectorSemanticIndexAsync(PgVectorSemanticIndex):
+    """
+    基于 pgvector 表的语义缓存索引（asyncpg 驱动），表在第一次使用时创建。
+    """
+
+    def __init__(self, db_driver, max_entries=10000, ttl=None, prune_interval=100):
+        self.db_driver = db_driver
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.prune_interval = prune_interval
+        self._writes = 0
+        self._table_created = False
+
+    async def create_table(self):
+        async with (await self.db_driver.pool).acquire() as connection:
+            for statement in self._create_table_sql():
+                await connection.execute(statement)
+        self._table_created = True
+
+    async def search(self, namespace, vector):
+        if not self._table_created:
+            await self.create_table()
+        ttl_condition = f" AND create_time > CURRENT_TIMESTAMP - make_interval(secs => {float(self.ttl)})" if self.ttl else ""
+        async with (await self.db_driver.pool).acquire() as connection:
+            row = await connection.fetchrow(f"""
+                SELECT id, response, 1 - (vector <=> $1::vector) FROM {SEMANTIC_CACHE_TABLE_NAME}
+                WHERE namespace = $2{ttl_condition}
+                ORDER BY vector <=> $1::vector LIMIT 1""", vector, namespace)
+            if row:
+                await connection.execute(f"UPDATE {SEMANTIC_CACHE_TABLE_NAME} SET last_hit_time = CURRENT_TIMESTAMP WHERE id = $1", row[0])
+        if not row:
+            return None, None
+        return float(row[2]), json.loads(row[1])
+
+    async def add(self, namespace, vector, response):
+        if not self._table_created:
+            await self.create_table()
+        async with (await self.db_driver.pool).acquire() as connection:
+            await connection.execute(f"INSERT INTO {SEMANTIC_CACHE_TABLE_NAME} (namespace, vector, response) VALUES ($1, $2, $3)",
+                                     namespace, vector, json.dumps(response, ensure_ascii=False))
+            self._writes += 1
+            if self._writes % self.prune_interval == 0:
+                await connection.execute(self._prune_sql("$1", "$2"), namespace, self.max_entries)
+
+
+class SemanticCacheEntry:
+    """一次查询的上下文，未命中时用于把回答写回缓存，避免重复计算 embedding。"""
+
+    def __init__(self, namespace, vector):
+        self.namespace = namespace
+        self.vector = vector
+
+
+class SemanticCache:
+    """
+    同步语义缓存。
+
+    Args:
+        threshold (float): 命中所需的最小余弦相似度。
+        namespace (str): 业务命名空间，不同命名空间的缓存互相隔离。
+        index (LocalVectorIndex | PgVectorSemanticIndex, optional): 向量索引，默认进程内索引。
+        max_entries (int): 默认进程内索引每个命名空间的最大条数。
+        ttl (int, optional): 默认进程内索引的条目有效期（秒）。
+        latency_window (int): 统计延迟时保留的最近样本数。
+    """
+
+    def __init__(self, threshold=0.95, namespace="default", index=None, max_entries=10000, ttl=None, latency_window=1000):
+        self.threshold = threshold
+        self.namespace = namespace
+        self.index = index if index is not None else LocalVectorIndex(max_entries, ttl)
+        self._stats_lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self._latencies = deque(maxlen=latency_window)
+
+    def scoped_namespace(self, payload):
+        """业务命名空间 + 系统提示词和模型等字段的指纹。"""
+        system_prompts = [message.get("content") for message in payload.get("messages", []) if message.get("role") == "system"]
+        fingerprint = {field: payload.get(field) for field in FINGERPRINT_FIELDS if payload.get(field) is not None}
+        fingerprint["system"] = system_prompts
+        digest = hashlib.sha256(json.dumps(fingerprint, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+        return f"{self.namespace}:{digest}"
+
+    @staticmethod
+    def query_text(payload):
+        """最后一条用户消息的文本内容。"""
+        for message in reversed(payload.get("messages", [])):
+            if message.get("role") == "user":
+                content = message.get("content")
+                if isinstance(content, list):
+                    content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+                return content or None
+        return None
+
+    def _record(self, hit, started):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._latencies.append((time.monotonic() - started) * 1000)
+
+    def report(self):
+        """命中率和查询延迟（毫秒，包含 embedding 耗时）。"""
+        latencies = sorted(self._latencies)
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "latency_ms_avg": round(sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            "latency_ms_p50": round(latencies[len(latencies) // 2], 2) if latencies else 0.0,
+            "latency_ms_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2) if latencies else 0.0,
+        }
+
+    def _match(self, score, response):
+        return response if score is not None and score >= self.threshold else None
+
+    def lookup(self, payload, embed):
+        """
+        查询语义缓存。
+
+        Args:
+            payload (dict): chat completions 请求体。
+            embed (callable): 接收文本列表、返回向量列表的函数，如 LLM.embeddings。
+
+        Returns:
+            tuple: (回答, entry)。未命中时回答为 None，entry 用于之后调用 store；无法缓存时 entry 也为 None。
+        """
+        text = self.query_text(payload)
+        if not text:
+            return None, None
+        started = time.monotonic()
+        vector = embed([text])[0]
+        if vector is None:
+            return None, None
+        namespace = self.scoped_namespace(payload)
+        response = self._match(*self.index.search(namespace, vector))
+        self._record(response is not None, started)
+        return response, SemanticCacheEntry(namespace, vector)
+
+    def store(self, entry, response):
+        if entry is None or not response:
+            return
+        self.index.add(entry.namespace, entry.vector, response)
+
+    def record_stream(self, entry, stream):
+        """透传流式响应，正常结束后把组装好的完整响应写入缓存。"""
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        self.store(entry, assemble_stream("".join(chunks)))
+
+    def replay_stream(self, response):
+        return replay_stream(response)
+
+
+class SemanticCacheAsync(SemanticCache):
+    """
+    异步语义缓存，索引可以是进程内索引或 PgVectorSemanticIndexAsync。
+    """
+
+    async def lookup(self, payload, embed):
+        """
+        查询语义缓存。
+
+        Args:
+            payload (dict): chat completions 请求体。
+            embed (callable): 接收文本列表、返回向量列表的协程函数，如 LLMAsync.embeddings。
+
+        Returns:
+            tuple: (回答, entry)。未命中时回答为 None，entry 用于之后调用 store；无法缓存时 entry 也为 None。
+        """
+        text = self.query_text(payload)
+        if not text:
+            return None, None
+        started = time.monotonic()
+        vector = (await embed([text]))[0]
+        if vector is None:
+            return None, None
+        namespace = self.scoped_namespace(payload)
+        result = self.index.search(namespace, vector)
+        if inspect.isawaitable(result):
+            result = await result
+        response = self._match(*result)
+        self._record(response is not None, started)
+        return response, SemanticCacheEntry(namespace, vector)
+
+    async def store(self, entry, response):
+        if entry is None or not response:
+            return
+        result = self.index.add(entry.namespace, entry.vector, response)
+        if inspect.isawaitable(result):
+            await result
+
+    async def record_stream(self, entry, stream):
+        """透传流式响应，正常结束后把组装好的完整响应写入缓存。"""
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        await self.store(entry, assemble_stream("".join(chunks)))
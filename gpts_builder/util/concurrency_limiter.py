@@ -0,0 +1,193 @@
+"""
+自适应并发限制（AIMD）：按 (端点, 模型) 分别维护同时进行的请求数上限。
+
+延迟低于目标时加性增大上限（每完成约一个上限数量的请求加 1），超时、429、503 时乘性减小；
+超过上限的请求在有界队列中排队，队列已满或排队超过截止时间时立即抛出 OverloadError，
+上游过载时快速失败，而不是把请求越堆越多。
+"""
+from collections import deque
+from threading import Lock
+import asyncio
+import time
+import weakref
+
+import httpx
+
+from .retry import DeadlineExceeded
+
+# 说明上游过载的状态码
+OVERLOAD_STATUS = (429, 503)
+
+
+class OverloadError(Exception):
+    """并发已满且排队已满或排队超时。"""
+
+
+def is_overload(error):
+    """超时和 429/503 说明上游过载，需要降低并发；截止时间已到而没有发出的请求不算。"""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in OVERLOAD_STATUS
+    return isinstance(error, httpx.TimeoutException)
+
+
+class ConcurrencyState:
+    """一个 (端点, 模型) 的并发上限、进行中的请求数和排队的等待者。"""
+
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.queue = deque()
+        self.last_decrease = 0.0
+        self.max_in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.decreases = 0
+
+    def report(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queue": len(self.queue),
+            "max_in_flight": self.max_in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "decreases": self.decreases,
+        }
+
+
+class Permit:
+    """一次获得的并发名额，请求结束后交给 release。"""
+
+    __slots__ = ("state", "started")
+
+    def __init__(self, state):
+        self.state = state
+        self.started = time.monotonic()
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    异步请求的 AIMD 并发限制器，状态按事件循环隔离。
+
+    Args:
+        initial_limit (int): 初始并发上限。
+        min_limit (int): 并发上限的下限。
+        max_limit (int): 并发上限的上限。
+        target_latency (float, optional): 目标延迟（秒，流式请求为首个片段的到达时间），超过时不再增大上限；为 None 时只按错误调整。
+        backoff_ratio (float): 过载时上限乘以的系数。
+        max_queue (int): 每个 (端点, 模型) 最多排队的请求数。
+        queue_timeout (float, optional): 最长排队秒数，同时受请求截止时间约束。
+    """
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=500, target_latency=None, backoff_ratio=0.5, max_queue=100, queue_timeout=30):
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.backoff_ratio = backoff_ratio
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # 排队的 future 绑定在事件循环上，不同事件循环分别计数
+        self._states = weakref.WeakKeyDictionary()
+        self._lock = Lock()
+
+    @staticmethod
+    def key(url, model=None):
+        """(端点, 模型) 键：端点取 URL 的 scheme://host:port。"""
+        parsed = httpx.URL(url)
+        endpoint = f"{parsed.scheme}://{parsed.netloc.decode('ascii')}"
+        return f"{endpoint}|{model}" if model else endpoint
+
+    def _state(self, key):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            states = self._states.setdefault(loop, {})
+            state = states.get(key)
+            if state is None:
+                state = states[key] = ConcurrencyState(self.initial_limit)
+            return state
+
+    def _admit(self, state):
+        state.in_flight += 1
+        state.max_in_flight = max(state.max_in_flight, state.in_flight)
+        return Permit(state)
+
+    async def acquire(self, key, deadline=None):
+        """
+        获得一个并发名额，需要时排队等待。
+
+        Args:
+            deadline (Deadline, optional): 请求的截止时间，排队时间不会超过剩余时间。
+
+        Raises:
+            OverloadError: 队列已满或排队超时。
+        """
+        state = self._state(key)
+        if state.in_flight < int(state.limit) and not state.queue:
+            return self._admit(state)
+        if len(state.queue) >= self.max_queue:
+            state.rejected += 1
+            raise OverloadError(f"[gpts-builder] {key} overloaded: {state.in_flight} in flight, {len(state.queue)} queued")
+        timeout = self.queue_timeout
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        waiter = asyncio.get_running_loop().create_future()
+        state.queue.append(waiter)
+        state.queued += 1
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            state.rejected += 1
+            raise OverloadError(f"[gpts-builder] {key} overloaded: queued longer than {timeout:.2f}s")
+        except BaseException:
+            # 已经分配了名额但调用方被取消：归还名额
+            if waiter.done() and not waiter.cancelled():
+                state.in_flight -= 1
+                self._wake(state)
+            raise
+        finally:
+            if waiter in state.queue:
+                state.queue.remove(waiter)
+        # release 已经为这个等待者占用了名额
+        return Permit(state)
+
+    def release(self, permit, error=None, latency=None):
+        """
+        归还名额并调整上限。
+
+        Args:
+            error (Exception, optional): 请求失败的错误，超时和 429/503 会降低上限。
+            latency (float, optional): 用于比较目标延迟的耗时，默认为从获得名额到现在的时间。
+        """
+        state = permit.state
+        state.in_flight -= 1
+        if error is not None:
+            # 同一批请求的多个失败只降低一次：只有在上次降低之后开始的请求才会再次降低
+            if is_overload(error) and permit.started >= state.last_decrease:
+                state.limit = max(self.min_limit, state.limit * self.backoff_ratio)
+                state.last_decrease = time.monotonic()
+                state.decreases += 1
+        else:
+            latency = latency if latency is not None else time.monotonic() - permit.started
+            if self.target_latency is None or latency <= self.target_latency:
+                state.limit = min(self.max_limit, state.limit + 1.0 / state.limit)
+        self._wake(state)
+
+    def _wake(self, state):
+        while state.queue and state.in_flight < int(state.limit):
+            waiter = state.queue.popleft()
+            if not waiter.done():
+                self._admit(state)
+                waiter.set_result(True)
+
+    def stats(self):
+        """当前事件循环中各 (端点, 模型) 的并发上限、进行中的请求数、排队数以及被拒绝次数。"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return {}
+        with self._lock:
+            return {key: state.report() for key, state in self._states.get(loop, {}).items()}
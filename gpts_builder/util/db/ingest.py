@@ -0,0 +1,105 @@
+"""知识库批量导入的公共工具：分批读取、向量结果对齐以及吞吐量统计。"""
+import time
+
+from ..logger import logger
+
+
+def iter_batches(records, batch_size):
+    """把 (答案, 问题列表) 的可迭代对象按 batch_size 分批，按需读取，不会一次性读入内存。"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def aiter_batches(records, batch_size):
+    """iter_batches 的异步版本，records 可以是普通可迭代对象，也可以是异步可迭代对象。"""
+    if not hasattr(records, "__aiter__"):
+        for batch in iter_batches(records, batch_size):
+            yield batch
+        return
+    batch = []
+    async for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def batch_texts(batch):
+    """把一批 (答案, 问题列表) 展开成一次向量化请求的文本列表：每条记录依次是答案和它的问题。"""
+    texts = []
+    for answer_text, questions in batch:
+        texts.append(answer_text)
+        texts.extend(questions)
+    return texts
+
+
+def pair_vectors(batch, vectors):
+    """
+    把展开后的向量结果对齐回每条记录。
+
+    Returns:
+        tuple: (rows, skipped)。rows 为 [(答案, 答案向量, [(问题, 问题向量), ...]), ...]，
+            答案未成功向量化的记录被跳过，未成功向量化的问题被丢弃，skipped 为被跳过的记录数。
+    """
+    rows, skipped, offset = [], 0, 0
+    for answer_text, questions in batch:
+        answer_vector = vectors[offset]
+        question_vectors = vectors[offset + 1: offset + 1 + len(questions)]
+        offset += 1 + len(questions)
+        if answer_vector is None:
+            logger.info(f"{answer_text} 未成功向量化")
+            skipped += 1
+            continue
+        question_rows = []
+        for question_text, question_vector in zip(questions, question_vectors):
+            if question_vector is None:
+                logger.info(f"{question_text} 未成功向量化")
+                continue
+            question_rows.append((question_text, question_vector))
+        rows.append((answer_text, answer_vector, question_rows))
+    return rows, skipped
+
+
+class IngestStats:
+    """批量导入的统计信息。"""
+
+    def __init__(self, log_interval=10):
+        self.records = 0
+        self.questions = 0
+        self.failed = 0
+        self.batches = 0
+        self.log_interval = log_interval
+        self._started = time.monotonic()
+        self._last_log = self._started
+
+    def add(self, records, questions):
+        self.records += records
+        self.questions += questions
+        self.batches += 1
+        now = time.monotonic()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            logger.info(f"[gpts-builder] 批量导入进度: {self.report()}")
+
+    def add_failed(self, records):
+        self.failed += records
+
+    def report(self):
+        elapsed = time.monotonic() - self._started
+        return {
+            "records": self.records,
+            "questions": self.questions,
+            "failed": self.failed,
+            "batches": self.batches,
+            "elapsed": round(elapsed, 3),
+            "records_per_second": round(self.records / elapsed, 2) if elapsed > 0 else 0.0,
+            "questions_per_second": round(self.questions / elapsed, 2) if elapsed > 0 else 0.0,
+        }
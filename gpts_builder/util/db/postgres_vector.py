@@ -1,18 +1,39 @@
 import psycopg2
+from psycopg2.extensions import AsIs, new_type, register_adapter, register_type
+import time
 from .db_base import DbBase
+from . import vector_index
+from .vector_codec import VectorParam, decode_vector_text, encode_vector_text
+from .vector_index import VectorIndexConfig
 from ...util.db.schema import EmbbedingSchame, DatasetSchema, KB_TABLE_NAME, ANSWER_TABLE_NAME, QUESTION_TABLE_NAME
 
+# psycopg2 的适配器是进程级的：只为 VectorParam 注册，不影响其他代码传入的 NumPy 数组
+register_adapter(VectorParam, lambda param: AsIs(f"'{encode_vector_text(param.value)}'::vector"))
+
 
 class PostgresVector(DbBase):
 
 
-    def __init__(self, **args):
+    def __init__(self, dimension=vector_index.AUTO_DIMENSION, index_config: VectorIndexConfig = None, **args):
+        """
+        Args:
+            dimension (int): 向量维度，需要和 embedding 模型输出一致，默认使用 config_manager.embedding_dimensions
+                （未配置时取 embedding 模型的默认维度），为 None 时不固定维度（无法建向量索引）。
+            index_config (VectorIndexConfig, optional): 向量索引配置，默认 HNSW + cosine。
+            args: psycopg2 连接参数。
+        """
         super().__init__()
+        self.dimension = vector_index.resolve_dimension(dimension)
+        self.index_config = index_config or VectorIndexConfig()
+        self._row_estimate = None
+        self._row_estimate_at = 0
+        self._kb_row_estimates = {}
         self.db = self.connect_to_db(**args)
         self.answer_schema = EmbbedingSchame(ANSWER_TABLE_NAME)
         self.question_schema = EmbbedingSchame(QUESTION_TABLE_NAME)
         self.dataset_schema = DatasetSchema()
         self.create_tables()
+        self.register_vector_codec()
     
     def connect_to_db(self, dbname, user, password, host="localhost", port=5432):
         """使用 psycopg2 连接 PostgreSQL 数据库。"""
@@ -46,7 +67,7 @@ class PostgresVector(DbBase):
             CREATE TABLE IF NOT EXISTS {ANSWER_TABLE_NAME} (
                 {self.answer_schema.id} SERIAL PRIMARY KEY,
                 {self.answer_schema.text} TEXT,
-                {self.answer_schema.vector} vector,
+                {self.answer_schema.vector} {vector_index.vector_column_type(self.dimension)},
                 {self.answer_schema.kb_id} INTEGER,
                 {self.answer_schema.created_at} TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY ({self.answer_schema.kb_id}) REFERENCES {KB_TABLE_NAME} ({self.dataset_schema.id})
@@ -58,7 +79,7 @@ class PostgresVector(DbBase):
                 {self.question_schema.id} SERIAL PRIMARY KEY,
                 {self.answer_schema.id} INTEGER,
                 {self.question_schema.text} TEXT,
-                {self.question_schema.vector} vector,
+                {self.question_schema.vector} {vector_index.vector_column_type(self.dimension)},
                 {self.question_schema.created_at} TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY ({self.answer_schema.id}) REFERENCES {ANSWER_TABLE_NAME} ({self.answer_schema.id})
             )""")
@@ -66,6 +87,125 @@ class PostgresVector(DbBase):
             # 提交所有更改
             self.db.commit()
     
+    def register_vector_codec(self):
+        """
+        在连接上注册 vector 类型的解码：查询结果直接解析为 float32 的 NumPy 数组。
+        写入时用 VectorParam 包装向量，按 pgvector 文本格式传输，不再经过 json 和 numeric[] 转换。
+        """
+        with self.db.cursor() as cursor:
+            cursor.execute("SELECT 'vector'::regtype::oid")
+            vector_oid = cursor.fetchone()[0]
+        self.db.commit()
+        register_type(new_type((vector_oid,), "VECTOR", lambda value, cursor: decode_vector_text(value)), self.db)
+
+    def _vector_columns(self):
+        return [(ANSWER_TABLE_NAME, self.answer_schema.vector), (QUESTION_TABLE_NAME, self.question_schema.vector)]
+
+    def _execute_ddl(self, statements, concurrently=False):
+        """执行 DDL，CONCURRENTLY 不能在事务块中执行，需要临时切到自动提交。"""
+        autocommit = self.db.autocommit
+        if concurrently:
+            self.db.commit()
+            self.db.autocommit = True
+        try:
+            with self.db.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+            if not concurrently:
+                self.db.commit()
+        except Exception:
+            if not concurrently:
+                self.db.rollback()
+            raise
+        finally:
+            self.db.autocommit = autocommit
+
+    def set_dimension(self, dimension):
+        """固定答案表和问题表的向量维度（已有数据的维度必须一致），改维度后需要重建索引。"""
+        self.dimension = dimension
+        self._execute_ddl([vector_index.alter_dimension_sql(table, column, dimension) for table, column in self._vector_columns()])
+
+    def create_vector_indexes(self, index_config: VectorIndexConfig = None, concurrently=False):
+        """
+        为答案表和问题表的向量列创建 HNSW 或 IVFFlat 索引。
+
+        Args:
+            index_config (VectorIndexConfig, optional): 索引配置，传入时会替换当前配置。
+            concurrently (bool): 是否使用 CREATE INDEX CONCURRENTLY，建索引期间不阻塞写入。
+        """
+        if not self.dimension:
+            raise Exception("向量列未固定维度，无法创建向量索引，请先调用 set_dimension")
+        if index_config:
+            self.index_config = index_config
+        self._execute_ddl([vector_index.create_index_sql(table, column, self.index_config, concurrently)
+                           for table, column in self._vector_columns()], concurrently)
+
+    def drop_vector_indexes(self, concurrently=False):
+        """删除向量索引，之后的检索退化为精确扫描。"""
+        self._execute_ddl([vector_index.drop_index_sql(table, column, concurrently)
+                           for table, column in self._vector_columns()], concurrently)
+
+    def rebuild_vector_indexes(self, index_config: VectorIndexConfig = None, concurrently=False):
+        """按当前（或新传入的）配置重建向量索引，用于调整 m / ef_construction / lists 或批量导入之后。"""
+        self.drop_vector_indexes(concurrently)
+        self.create_vector_indexes(index_config, concurrently)
+
+    def set_search_params(self, ef_search=None, probes=None, exact_scan_threshold=None):
+        """调整默认的查询参数，在召回率和延迟之间取舍。"""
+        if ef_search is not None:
+            self.index_config.ef_search = int(ef_search)
+        if probes is not None:
+            self.index_config.probes = int(probes)
+        if exact_scan_threshold is not None:
+            self.index_config.exact_scan_threshold = int(exact_scan_threshold)
+            self._row_estimate = None
+            self._kb_row_estimates.clear()
+
+    def estimate_rows(self, cursor):
+        """估算问题表的行数，结果缓存 stats_ttl 秒。"""
+        now = time.monotonic()
+        if self._row_estimate is not None and now - self._row_estimate_at < self.index_config.stats_ttl:
+            return self._row_estimate
+        cursor.execute(vector_index.estimate_rows_sql(QUESTION_TABLE_NAME))
+        row = cursor.fetchone()
+        rows = row[0] if row else 0
+        if rows is None or rows < 0:
+            cursor.execute(vector_index.count_rows_sql(QUESTION_TABLE_NAME))
+            rows = cursor.fetchone()[0]
+        self._row_estimate, self._row_estimate_at = rows, now
+        return rows
+
+    def estimate_kb_rows(self, cursor, dataset_ids):
+        """统计这些知识库的问题数（最多数到 exact_scan_threshold），结果缓存 stats_ttl 秒。"""
+        key = tuple(sorted(set(dataset_ids)))
+        now = time.monotonic()
+        cached = self._kb_row_estimates.get(key)
+        if cached is not None and now - cached[1] < self.index_config.stats_ttl:
+            return cached[0]
+        cursor.execute(vector_index.count_kb_rows_sql(self.index_config.exact_scan_threshold), (list(key),))
+        rows = cursor.fetchone()[0]
+        if len(self._kb_row_estimates) >= vector_index.MAX_KB_ROW_ESTIMATES:
+            self._kb_row_estimates.clear()
+        self._kb_row_estimates[key] = (rows, now)
+        return rows
+
+    def apply_search_params(self, cursor, ef_search=None, probes=None, dataset_ids=None):
+        """
+        在当前事务内设置本次查询的 ef_search / probes，数据量低于阈值时关闭索引扫描走精确检索。
+
+        Args:
+            dataset_ids (list, optional): 检索的知识库，整表超过阈值时再按这些知识库的行数判断，
+                大表中的小知识库同样走精确扫描，不承担近似索引的召回损失。
+
+        Returns:
+            bool: 是否使用精确扫描。
+        """
+        exact = self.estimate_rows(cursor) < self.index_config.exact_scan_threshold
+        if not exact and dataset_ids:
+            exact = self.estimate_kb_rows(cursor, dataset_ids) < self.index_config.exact_scan_threshold
+        cursor.execute(vector_index.search_settings_sql(self.index_config, exact, ef_search, probes))
+        return exact
+
     def get_insert_into_str(self, table_name, columns):
         """
         Insert values into a specified table with given columns.
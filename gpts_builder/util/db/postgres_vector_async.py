@@ -1,6 +1,10 @@
-from asyncpg import create_pool
+from asyncpg import connect, create_pool
 from asyncio import get_event_loop
+import time
 from .db_base import DbBase
+from . import vector_index
+from .vector_codec import decode_vector_binary, encode_vector_binary
+from .vector_index import VectorIndexConfig
 from ...util.db.schema import EmbbedingSchame, DatasetSchema, KB_TABLE_NAME, ANSWER_TABLE_NAME, QUESTION_TABLE_NAME
 
 
@@ -12,27 +16,64 @@ class PostgresVectorAsync(DbBase):
             await self.init_db()
         return self._pool
 
-    def __init__(self, **kwargs):
+    def __init__(self, dimension=vector_index.AUTO_DIMENSION, index_config: VectorIndexConfig = None, **kwargs):
+        """
+        Args:
+            dimension (int): 向量维度，需要和 embedding 模型输出一致，默认使用 config_manager.embedding_dimensions
+                （未配置时取 embedding 模型的默认维度），为 None 时不固定维度（无法建向量索引）。
+            index_config (VectorIndexConfig, optional): 向量索引配置，默认 HNSW + cosine。
+            kwargs: 数据库连接参数。
+        """
         super().__init__()
         self.db = None  # Initialize db connection in an async way
         self._pool = None
+        self.dimension = vector_index.resolve_dimension(dimension)
+        self.index_config = index_config or VectorIndexConfig()
+        self._row_estimate = None
+        self._row_estimate_at = 0
+        self._kb_row_estimates = {}
         self.db_params = kwargs
         self.answer_schema = EmbbedingSchame(ANSWER_TABLE_NAME)
         self.question_schema = EmbbedingSchame(QUESTION_TABLE_NAME)
         self.dataset_schema = DatasetSchema()
 
-    async def init_db(self):
-        """初始化数据库连接池。"""
-        self._pool = await create_pool(
+    def _connect_params(self):
+        return dict(
             database=self.db_params['dbname'],
             user=self.db_params['user'],
             password=self.db_params['password'],
             host=self.db_params.get('host', 'localhost'),
             port=self.db_params.get('port', 5432),
+        )
+
+    async def init_db(self):
+        """初始化数据库连接池。"""
+        # 连接池中每个连接都要注册 vector 编解码，注册前扩展必须已存在
+        connection = await connect(**self._connect_params())
+        try:
+            await connection.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        finally:
+            await connection.close()
+        self._pool = await create_pool(
+            **self._connect_params(),
             min_size=1,
-            max_size=10
+            max_size=10,
+            init=self.register_vector_codec
         )
         await self.create_tables()
+
+    @staticmethod
+    async def register_vector_codec(connection):
+        """
+        在连接上注册 vector 类型的二进制编解码：写入时接受列表或 NumPy 数组，
+        查询结果直接解码为 float32 的 NumPy 数组，不再经过 json 文本。
+        """
+        await connection.set_type_codec(
+            "vector",
+            encoder=encode_vector_binary,
+            decoder=decode_vector_binary,
+            format="binary"
+        )
     
     async def create_tables(self):
         """异步创建 PostgreSQL 表格，包括知识库表以及支持 pgvector 的索引和内容表格。"""
@@ -54,7 +95,7 @@ class PostgresVectorAsync(DbBase):
                 CREATE TABLE IF NOT EXISTS {ANSWER_TABLE_NAME} (
                     {self.answer_schema.id} SERIAL PRIMARY KEY,
                     {self.answer_schema.text} TEXT,
-                    {self.answer_schema.vector} vector,
+                    {self.answer_schema.vector} {vector_index.vector_column_type(self.dimension)},
                     {self.answer_schema.kb_id} INTEGER,
                     {self.answer_schema.created_at} TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY ({self.answer_schema.kb_id}) REFERENCES {KB_TABLE_NAME} ({self.dataset_schema.id})
@@ -65,11 +106,107 @@ class PostgresVectorAsync(DbBase):
                     {self.question_schema.id} SERIAL PRIMARY KEY,
                     {self.answer_schema.id} INTEGER,
                     {self.question_schema.text} TEXT,
-                    {self.question_schema.vector} vector,
+                    {self.question_schema.vector} {vector_index.vector_column_type(self.dimension)},
                     {self.question_schema.created_at} TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY ({self.answer_schema.id}) REFERENCES {ANSWER_TABLE_NAME} ({self.answer_schema.id})
                 )""")
 
+    def _vector_columns(self):
+        return [(ANSWER_TABLE_NAME, self.answer_schema.vector), (QUESTION_TABLE_NAME, self.question_schema.vector)]
+
+    async def _execute_ddl(self, statements, concurrently=False):
+        """执行 DDL，CONCURRENTLY 不能在事务块中执行，此时逐条自动提交。"""
+        async with (await self.pool).acquire() as connection:
+            if concurrently:
+                for statement in statements:
+                    await connection.execute(statement)
+                return
+            async with connection.transaction():
+                for statement in statements:
+                    await connection.execute(statement)
+
+    async def set_dimension(self, dimension):
+        """固定答案表和问题表的向量维度（已有数据的维度必须一致），改维度后需要重建索引。"""
+        self.dimension = dimension
+        await self._execute_ddl([vector_index.alter_dimension_sql(table, column, dimension) for table, column in self._vector_columns()])
+
+    async def create_vector_indexes(self, index_config: VectorIndexConfig = None, concurrently=False):
+        """
+        为答案表和问题表的向量列创建 HNSW 或 IVFFlat 索引。
+
+        Args:
+            index_config (VectorIndexConfig, optional): 索引配置，传入时会替换当前配置。
+            concurrently (bool): 是否使用 CREATE INDEX CONCURRENTLY，建索引期间不阻塞写入。
+        """
+        if not self.dimension:
+            raise Exception("向量列未固定维度，无法创建向量索引，请先调用 set_dimension")
+        if index_config:
+            self.index_config = index_config
+        await self._execute_ddl([vector_index.create_index_sql(table, column, self.index_config, concurrently)
+                                 for table, column in self._vector_columns()], concurrently)
+
+    async def drop_vector_indexes(self, concurrently=False):
+        """删除向量索引，之后的检索退化为精确扫描。"""
+        await self._execute_ddl([vector_index.drop_index_sql(table, column, concurrently)
+                                 for table, column in self._vector_columns()], concurrently)
+
+    async def rebuild_vector_indexes(self, index_config: VectorIndexConfig = None, concurrently=False):
+        """按当前（或新传入的）配置重建向量索引，用于调整 m / ef_construction / lists 或批量导入之后。"""
+        await self.drop_vector_indexes(concurrently)
+        await self.create_vector_indexes(index_config, concurrently)
+
+    def set_search_params(self, ef_search=None, probes=None, exact_scan_threshold=None):
+        """调整默认的查询参数，在召回率和延迟之间取舍。"""
+        if ef_search is not None:
+            self.index_config.ef_search = int(ef_search)
+        if probes is not None:
+            self.index_config.probes = int(probes)
+        if exact_scan_threshold is not None:
+            self.index_config.exact_scan_threshold = int(exact_scan_threshold)
+            self._row_estimate = None
+            self._kb_row_estimates.clear()
+
+    async def estimate_rows(self, connection):
+        """估算问题表的行数，结果缓存 stats_ttl 秒。"""
+        now = time.monotonic()
+        if self._row_estimate is not None and now - self._row_estimate_at < self.index_config.stats_ttl:
+            return self._row_estimate
+        rows = await connection.fetchval(vector_index.estimate_rows_sql(QUESTION_TABLE_NAME))
+        if rows is None or rows < 0:
+            rows = await connection.fetchval(vector_index.count_rows_sql(QUESTION_TABLE_NAME))
+        self._row_estimate, self._row_estimate_at = rows, now
+        return rows
+
+    async def estimate_kb_rows(self, connection, dataset_ids):
+        """统计这些知识库的问题数（最多数到 exact_scan_threshold），结果缓存 stats_ttl 秒。"""
+        key = tuple(sorted(set(dataset_ids)))
+        now = time.monotonic()
+        cached = self._kb_row_estimates.get(key)
+        if cached is not None and now - cached[1] < self.index_config.stats_ttl:
+            return cached[0]
+        rows = await connection.fetchval(vector_index.count_kb_rows_sql(self.index_config.exact_scan_threshold, "$1"), list(key))
+        if len(self._kb_row_estimates) >= vector_index.MAX_KB_ROW_ESTIMATES:
+            self._kb_row_estimates.clear()
+        self._kb_row_estimates[key] = (rows, now)
+        return rows
+
+    async def apply_search_params(self, connection, ef_search=None, probes=None, dataset_ids=None):
+        """
+        在当前事务内设置本次查询的 ef_search / probes，数据量低于阈值时关闭索引扫描走精确检索。
+
+        Args:
+            dataset_ids (list, optional): 检索的知识库，整表超过阈值时再按这些知识库的行数判断，
+                大表中的小知识库同样走精确扫描，不承担近似索引的召回损失。
+
+        Returns:
+            bool: 是否使用精确扫描。
+        """
+        exact = await self.estimate_rows(connection) < self.index_config.exact_scan_threshold
+        if not exact and dataset_ids:
+            exact = await self.estimate_kb_rows(connection, dataset_ids) < self.index_config.exact_scan_threshold
+        await connection.execute(vector_index.search_settings_sql(self.index_config, exact, ef_search, probes))
+        return exact
+
     def get_insert_into_str(self, table_name, columns):
         """
         Construct a SQL INSERT statement dynamically based on input parameters.
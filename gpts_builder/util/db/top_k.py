@@ -0,0 +1,68 @@
+"""多知识库检索结果的 top-k 合并，用有界小顶堆保留相似度最高的数据。"""
+import heapq
+import itertools
+
+
+class BoundedTopK:
+    """
+    保留分数最高的 k 个元素的有界堆，k 为 None 时不做截断。
+
+    push 的复杂度为 O(log k)，不需要先把全部结果排序。
+    """
+
+    def __init__(self, k=None):
+        self.k = k
+        self._heap = []
+        # 分数相同时按插入顺序比较，避免去比较 item 本身
+        self._counter = itertools.count()
+
+    def push(self, score, item):
+        entry = (score, -next(self._counter), item)
+        if self.k is None or len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif score > self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        """按分数从高到低返回保留的元素。"""
+        return [item for _, _, item in sorted(self._heap, reverse=True)]
+
+    def __len__(self):
+        return len(self._heap)
+
+
+def merge_top_k(rows, dataset_ids, per_kb_top_k=None, global_top_k=None, key="similarity"):
+    """
+    把 (kb_id, item) 结果合并为以知识库ID为键的 kb_content_map。
+
+    Args:
+        rows (iterable): (kb_id, item) 序列，item 为包含 key 字段的字典。
+        dataset_ids (list): 知识库ID列表，决定返回字典的键顺序。
+        per_kb_top_k (int, optional): 每个知识库最多保留的条数。
+        global_top_k (int, optional): 所有知识库合计最多保留的条数。
+        key (str): 排序使用的分数字段。
+
+    Returns:
+        dict: 以知识库ID为键，值为按分数从高到低排列的列表，没有结果的知识库不出现。
+    """
+    per_kb = {}
+    for kb_id, item in rows:
+        if kb_id not in per_kb:
+            per_kb[kb_id] = BoundedTopK(per_kb_top_k)
+        per_kb[kb_id].push(item[key], item)
+
+    kb_content_map = {}
+    for kb_id in dataset_ids:
+        if kb_id in per_kb and kb_id not in kb_content_map:
+            kb_content_map[kb_id] = per_kb[kb_id].items()
+
+    if global_top_k:
+        selected = BoundedTopK(global_top_k)
+        for kb_id, items in kb_content_map.items():
+            for item in items:
+                selected.push(item[key], (kb_id, id(item)))
+        kept = set(selected.items())
+        kb_content_map = {kb_id: [item for item in items if (kb_id, id(item)) in kept]
+                          for kb_id, items in kb_content_map.items()}
+        kb_content_map = {kb_id: items for kb_id, items in kb_content_map.items() if items}
+    return kb_content_map
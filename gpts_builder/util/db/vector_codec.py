@@ -0,0 +1,55 @@
+"""pgvector 的 vector 类型编解码（向量统一解码为 float32 的 NumPy 数组）以及本地相似度计算。"""
+import struct
+
+import numpy as np
+
+# pgvector 二进制格式: int16 维度 + int16 保留位 + 维度个大端 float32
+_HEADER = struct.Struct(">HH")
+_BIG_ENDIAN_FLOAT32 = np.dtype(">f4")
+
+
+def encode_vector_binary(value) -> bytes:
+    """把列表或数组编码成 pgvector 的二进制格式（asyncpg 使用）。"""
+    array = np.asarray(value, dtype=_BIG_ENDIAN_FLOAT32)
+    if array.ndim != 1:
+        raise ValueError("向量必须是一维的")
+    return _HEADER.pack(array.shape[0], 0) + array.tobytes()
+
+
+def decode_vector_binary(data) -> np.ndarray:
+    """把 pgvector 的二进制格式直接解码为 float32 数组。"""
+    dimension, _ = _HEADER.unpack_from(data)
+    return np.frombuffer(data, dtype=_BIG_ENDIAN_FLOAT32, count=dimension, offset=_HEADER.size).astype(np.float32)
+
+
+class VectorParam:
+    """
+    psycopg2 查询参数中的 pgvector 向量。只有包装成 VectorParam 的数组按 vector 传输，
+    其他 NumPy 数组参数（如 float8[]、int[]）仍按 psycopg2 的默认方式适配。
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def encode_vector_text(value) -> str:
+    """把列表或数组编码成 pgvector 的文本格式 `[1,2,3]`（psycopg2 只支持文本协议）。"""
+    array = np.asarray(value, dtype=np.float32)
+    return "[" + ",".join(array.astype(str)) + "]"
+
+
+def decode_vector_text(value):
+    """把 pgvector 的文本格式 `[1,2,3]` 在 C 层解析为 float32 数组，不经过 Python float 列表。"""
+    if value is None:
+        return None
+    return np.fromstring(value[1:-1], dtype=np.float32, sep=",")
+
+
+def cosine_similarities(query, vectors) -> np.ndarray:
+    """计算 query 与一组向量的余弦相似度，返回 float32 数组。"""
+    query = np.asarray(query, dtype=np.float32)
+    matrix = np.vstack(vectors).astype(np.float32, copy=False)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    return matrix @ query / np.maximum(norms, np.finfo(np.float32).tiny)
@@ -0,0 +1,133 @@
+"""pgvector 向量索引（HNSW / IVFFlat）的配置与 SQL 生成，同步和异步驱动共用。"""
+from .schema import EmbbedingSchame, ANSWER_TABLE_NAME, QUESTION_TABLE_NAME
+
+HNSW = "hnsw"
+IVFFLAT = "ivfflat"
+
+# 向量维度取配置的默认值（见 default_dimension）
+AUTO_DIMENSION = "auto"
+# 没有配置 embedding 维度时，按 embedding 模型的默认输出维度建表
+EMBEDDING_MODEL_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+    "text-embedding-ada-002": 1536,
+}
+DEFAULT_DIMENSION = 1536
+# 按知识库统计行数的缓存最多保存多少组知识库
+MAX_KB_ROW_ESTIMATES = 1024
+
+# 距离度量对应的 pgvector 运算符类，检索 SQL 中使用的 `<=>` 对应 cosine
+OPERATOR_CLASSES = {
+    "cosine": "vector_cosine_ops",
+    "l2": "vector_l2_ops",
+    "ip": "vector_ip_ops",
+}
+
+
+class VectorIndexConfig:
+    """
+    向量索引配置。
+
+    Args:
+        method (str): 索引类型，hnsw 或 ivfflat。
+        metric (str): 距离度量，cosine | l2 | ip，需要和检索时使用的运算符一致。
+        m (int): HNSW 每个节点的最大连接数，越大召回越高、索引越大。
+        ef_construction (int): HNSW 建索引时的候选列表大小。
+        lists (int): IVFFlat 的聚类数，一般取 行数/1000（百万行以上取 sqrt(行数)）。
+        ef_search (int): HNSW 查询时的候选列表大小，越大召回越高、延迟越高。
+        probes (int): IVFFlat 查询时扫描的聚类数。
+        exact_scan_threshold (int): 表中（或被检索的知识库中）行数低于该值时不走索引，直接精确扫描。
+        stats_ttl (int): 表行数估算结果的缓存时间（秒），避免每次查询都去读统计信息。
+    """
+
+    def __init__(self, method=HNSW, metric="cosine", m=16, ef_construction=64, lists=100,
+                 ef_search=40, probes=10, exact_scan_threshold=10000, stats_ttl=60):
+        if method not in (HNSW, IVFFLAT):
+            raise Exception(f"不支持的向量索引类型: {method}")
+        if metric not in OPERATOR_CLASSES:
+            raise Exception(f"不支持的距离度量: {metric}")
+        self.method = method
+        self.metric = metric
+        self.m = int(m)
+        self.ef_construction = int(ef_construction)
+        self.lists = int(lists)
+        self.ef_search = int(ef_search)
+        self.probes = int(probes)
+        self.exact_scan_threshold = int(exact_scan_threshold)
+        self.stats_ttl = stats_ttl
+
+
+def default_dimension():
+    """默认的向量维度：config_manager.embedding_dimensions，未配置时取 embedding 模型的默认输出维度，都没有时为 1536。"""
+    # config_manager 依赖 util.logger，在这里导入避免 util 包初始化时的循环导入
+    from ...config.config_manager import config_manager
+    if config_manager.embedding_dimensions:
+        return int(config_manager.embedding_dimensions)
+    return EMBEDDING_MODEL_DIMENSIONS.get(config_manager.embedding_model, DEFAULT_DIMENSION)
+
+
+def resolve_dimension(dimension):
+    return default_dimension() if dimension == AUTO_DIMENSION else dimension
+
+
+def vector_column_type(dimension):
+    """向量列类型，固定维度后才能建立 HNSW / IVFFlat 索引。"""
+    return f"vector({int(dimension)})" if dimension else "vector"
+
+
+def index_name(table_name, column):
+    return f"{table_name}_{column}_idx"
+
+
+def create_index_sql(table_name, column, config: VectorIndexConfig, concurrently=False):
+    """生成建索引语句。"""
+    ops = OPERATOR_CLASSES[config.metric]
+    if config.method == HNSW:
+        options = f"m = {config.m}, ef_construction = {config.ef_construction}"
+    else:
+        options = f"lists = {config.lists}"
+    return (f"CREATE INDEX {'CONCURRENTLY ' if concurrently else ''}IF NOT EXISTS {index_name(table_name, column)} "
+            f"ON {table_name} USING {config.method} ({column} {ops}) WITH ({options})")
+
+
+def drop_index_sql(table_name, column, concurrently=False):
+    return f"DROP INDEX {'CONCURRENTLY ' if concurrently else ''}IF EXISTS {index_name(table_name, column)}"
+
+
+def alter_dimension_sql(table_name, column, dimension):
+    """固定已有表的向量维度，表中已有数据的维度必须一致。"""
+    return f"ALTER TABLE {table_name} ALTER COLUMN {column} TYPE {vector_column_type(dimension)}"
+
+
+def estimate_rows_sql(table_name):
+    """从统计信息估算表行数（reltuples 为 -1 表示从未 ANALYZE 过）。"""
+    return f"SELECT reltuples::bigint FROM pg_class WHERE relname = '{table_name}'"
+
+
+def count_rows_sql(table_name):
+    return f"SELECT count(*) FROM {table_name}"
+
+
+def count_kb_rows_sql(limit, placeholder="%s"):
+    """
+    统计指定知识库（placeholder 为 kb_id 数组参数）的问题数，数到 limit 行即停止，代价不随表的大小增长。
+    """
+    answer_schema = EmbbedingSchame(ANSWER_TABLE_NAME)
+    return (f"SELECT count(*) FROM (SELECT 1 FROM {ANSWER_TABLE_NAME} AS a JOIN {QUESTION_TABLE_NAME} AS q "
+            f"ON a.{answer_schema.id} = q.{answer_schema.id} WHERE a.{answer_schema.kb_id} = ANY({placeholder}::int[]) "
+            f"LIMIT {int(limit)}) AS t")
+
+
+def search_settings_sql(config: VectorIndexConfig, exact=False, ef_search=None, probes=None):
+    """
+    生成查询前执行的 SET LOCAL 语句（合并为一条，只需一次往返），必须在事务内执行。
+
+    exact 为 True 时关闭索引扫描，退化为精确的顺序扫描。
+    """
+    statements = [
+        f"SET LOCAL hnsw.ef_search = {int(ef_search or config.ef_search)}",
+        f"SET LOCAL ivfflat.probes = {int(probes or config.probes)}",
+    ]
+    if exact:
+        statements.append("SET LOCAL enable_indexscan = off")
+    return "; ".join(statements)
@@ -0,0 +1,84 @@
+"""批量 embedding 的公共逻辑：按条数和 token 数拆分请求、构造请求体、按输入顺序回填向量。"""
+import numpy as np
+
+from ..config.config_manager import config_manager
+from .logger import logger
+from .tokenizer import TokenizerUnavailable, encoder_registry
+
+# 单条输入的 token 上限（text-embedding-ada-002 / text-embedding-3-*）
+MAX_INPUT_TOKENS = 8191
+
+
+def embedding_encoding(model):
+    """embedding 模型对应的 tiktoken 编码器，由进程内的编码器注册表缓存。"""
+    return encoder_registry.get(model)
+
+
+def count_embedding_tokens(texts, model):
+    """每条文本的 token 数，编码器不可用时按 UTF-8 字节数估算（不会少于实际 token 数，拆分批次时偏保守）。"""
+    try:
+        encoding = embedding_encoding(model)
+    except TokenizerUnavailable:
+        return [len(text.encode("utf-8")) for text in texts]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(list(texts))]
+
+
+def split_embedding_batches(texts, model, max_items, max_tokens, token_counts=None):
+    """
+    把文本按顺序拆分为多个请求批次，每批不超过 max_items 条、合计不超过 max_tokens 个 token。
+
+    Args:
+        token_counts (list, optional): 已经计算好的每条文本的 token 数，不传时在这里计算。
+
+    Returns:
+        list: 每个批次对应的输入下标列表。
+    """
+    if token_counts is None:
+        token_counts = count_embedding_tokens(texts, model)
+    batches, current, current_tokens = [], [], 0
+    for index, tokens in enumerate(token_counts):
+        if tokens > MAX_INPUT_TOKENS:
+            logger.warning(f"[gpts-builder] embedding input {index} has {tokens} tokens, exceeds {MAX_INPUT_TOKENS}")
+        if current and (len(current) >= max_items or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_embedding_payload(input, model=None, dimensions=None):
+    """构造 embedding 请求体，模型和维度默认取 config_manager 中的配置。"""
+    payload = {
+        "input": input,
+        "model": model or config_manager.embedding_model
+    }
+    dimensions = dimensions or config_manager.embedding_dimensions
+    if dimensions:
+        payload["dimensions"] = dimensions
+    return payload
+
+
+def fill_vectors(vectors, indices, response):
+    """把一个批次的返回结果按 index 回填到 vectors 中对应的位置。"""
+    if not response:
+        return
+    data = response.get("data") or []
+    # 兼容代理返回的 {"data": {"data": [...]}} 结构
+    items = data.get("data", []) if isinstance(data, dict) else data
+    for position, item in enumerate(items):
+        offset = item.get("index", position)
+        if 0 <= offset < len(indices):
+            vectors[indices[offset]] = item.get("embedding")
+
+
+def vectors_to_numpy(vectors):
+    """转换为 (n, d) 的 float32 数组，未成功向量化的行为 NaN。"""
+    dimension = next((len(vector) for vector in vectors if vector is not None), 0)
+    array = np.full((len(vectors), dimension), np.nan, dtype=np.float32)
+    for row, vector in enumerate(vectors):
+        if vector is not None:
+            array[row] = vector
+    return array
@@ -0,0 +1,358 @@
+"""
+多端点故障转移：多个 base_url / API key 按权重组成端点池，每个端点一个熔断器。
+
+熔断器在最近的请求中错误率或慢请求比例超过阈值时打开（直接跳过该端点），冷却后进入半开状态放行少量探测请求，
+探测成功则恢复。请求总是发往当前最健康的可用端点，失败（连接错误、超时、408/429/5xx）时换下一个端点重试。
+只配置了一个端点时没有可以切换的端点，熔断只会让请求直接失败，因此总是使用该端点。
+"""
+from collections import deque
+from threading import Lock
+import random
+import time
+
+import httpx
+
+from ..config.config_manager import config_manager
+from .logger import logger
+from .retry import DeadlineExceeded
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 这些状态码说明端点本身有问题（或过载），值得换一个端点；其他 4xx 是请求本身的问题，换端点也不会成功
+ENDPOINT_FAILURE_STATUS = (408, 409, 429)
+# 错误率再高的端点（熔断器未打开时）也保留的最低健康系数
+MIN_HEALTH = 0.05
+
+
+class NoAvailableEndpoint(Exception):
+    """所有端点的熔断器都处于打开状态。"""
+
+
+def is_endpoint_failure(error):
+    """连接错误、超时以及 408/409/429/5xx 计为端点故障；截止时间已到而没有发出的请求（DeadlineExceeded）不算。"""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status in ENDPOINT_FAILURE_STATUS
+    return isinstance(error, (httpx.TransportError, httpx.TimeoutException))
+
+
+class CircuitBreaker:
+    """
+    基于滑动窗口的熔断器。
+
+    Args:
+        window (int): 统计最近多少次请求。
+        min_requests (int): 窗口内至少有多少次请求才会判断是否熔断。
+        failure_rate (float): 错误率阈值。
+        slow_call_seconds (float, optional): 超过该耗时的请求计为慢请求，为 None 时不统计。
+        slow_call_rate (float): 慢请求比例阈值。
+        open_seconds (float): 熔断后多久进入半开状态。
+        half_open_calls (int): 半开状态允许同时进行的探测请求数。
+    """
+
+    def __init__(self, window=20, min_requests=5, failure_rate=0.5, slow_call_seconds=None, slow_call_rate=0.8,
+                 open_seconds=30, half_open_calls=1):
+        self.window = deque(maxlen=window)
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = 0
+        # 每次进入半开状态加 1，用来识别探测名额属于哪一轮半开
+        self.half_open_round = 0
+
+    def available(self, now):
+        """是否可以向该端点发送请求（不占用探测名额）。"""
+        if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self.probing = 0
+            self.half_open_round += 1
+        if self.state == HALF_OPEN:
+            return self.probing < self.half_open_calls
+        return self.state == CLOSED
+
+    def begin(self):
+        """半开状态下占用一个探测名额，返回名额（交给 release 归还），否则返回 None。"""
+        if self.state == HALF_OPEN:
+            self.probing += 1
+            return self.half_open_round
+        return None
+
+    def release(self, probe):
+        """
+        归还 begin 占用的探测名额，不改变熔断状态。请求结束（包括被取消）时总是调用，
+        探测结果由 record 决定；请求被取消而没有 record 时，名额也不会泄漏。
+        """
+        if probe is not None and self.state == HALF_OPEN and probe == self.half_open_round:
+            self.probing = max(0, self.probing - 1)
+
+    def record(self, success, latency, now):
+        slow = self.slow_call_seconds is not None and latency >= self.slow_call_seconds
+        if self.state == HALF_OPEN:
+            if success and not slow:
+                self.state = CLOSED
+                self.window.clear()
+            else:
+                self._open(now)
+            return
+        self.window.append((success, slow))
+        if self.state == CLOSED and len(self.window) >= self.min_requests:
+            failures = sum(1 for ok, _ in self.window if not ok) / len(self.window)
+            slow_calls = sum(1 for _, is_slow in self.window if is_slow) / len(self.window)
+            if failures >= self.failure_rate or (self.slow_call_seconds is not None and slow_calls >= self.slow_call_rate):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = OPEN
+        self.opened_at = now
+        self.window.clear()
+
+    def error_rate(self):
+        return sum(1 for ok, _ in self.window if not ok) / len(self.window) if self.window else 0.0
+
+
+class Endpoint:
+    """
+    一个上游端点。
+
+    Args:
+        base_url (str): 接口地址，例如 https://api.openai.com。
+        api_key (str): 该端点使用的 API key。
+        weight (float): 路由权重。
+    """
+
+    def __init__(self, base_url, api_key, weight=1, **breaker_args):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.weight = weight
+        self.breaker = CircuitBreaker(**breaker_args)
+        # 延迟的指数移动平均（秒）
+        self.latency = None
+
+    def headers(self, headers=None):
+        return dict(headers or {}, Authorization=f"Bearer {self.api_key}")
+
+    def score(self):
+        """健康分：权重越大、错误率和平均延迟越低，分数越高；保留少量流量，错误率高的端点仍有机会恢复。"""
+        latency = self.latency if self.latency is not None else 0.0
+        return self.weight * max(1.0 - self.breaker.error_rate(), MIN_HEALTH) / (1.0 + latency)
+
+    def report(self):
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "state": self.breaker.state,
+            "error_rate": round(self.breaker.error_rate(), 4),
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+        }
+
+
+class EndpointPool:
+    """
+    端点池。
+
+    Args:
+        endpoints (list, optional): Endpoint 列表或 {"base_url", "api_key", "weight"} 字典列表。
+            不传时读取 config_manager.endpoints，未配置则只使用 config_manager.base_url / apikey。
+        latency_alpha (float): 延迟指数移动平均的平滑系数。
+        breaker_args: 传给每个端点 CircuitBreaker 的参数。
+    """
+
+    def __init__(self, endpoints=None, latency_alpha=0.2, **breaker_args):
+        self.latency_alpha = latency_alpha
+        self.breaker_args = breaker_args
+        self._lock = Lock()
+        self._configured = self._build(endpoints) if endpoints else None
+        self._config_key = None
+        self._config_endpoints = []
+
+    def _build(self, endpoints):
+        return [endpoint if isinstance(endpoint, Endpoint) else Endpoint(**dict(self.breaker_args, **endpoint)) for endpoint in endpoints]
+
+    @property
+    def endpoints(self):
+        """当前的端点列表；来自 config_manager 时配置不变则复用原有端点（保留熔断状态）。"""
+        if self._configured is not None:
+            return self._configured
+        configured = getattr(config_manager, "endpoints", None) or [{"base_url": config_manager.base_url, "api_key": config_manager.apikey}]
+        key = tuple((item["base_url"], item["api_key"], item.get("weight", 1)) for item in configured)
+        if key != self._config_key:
+            self._config_endpoints = self._build(configured)
+            self._config_key = key
+        return self._config_endpoints
+
+    def select(self, tried=(), avoid=()):
+        """按健康分加权随机选择一个可用端点并占用探测名额，没有可用端点时抛出 NoAvailableEndpoint。
+
+        Args:
+            tried (list): 本次请求已经失败的 (端点, 错误)，这些端点不再选择。
+            avoid (list): 尽量避开的端点 base_url（如对冲请求避开主请求的端点），没有其他可用端点时仍会选择。
+
+        Returns:
+            tuple: (端点, 探测名额)，请求结束后把探测名额交给 release。
+        """
+        exclude = [endpoint for endpoint, _ in tried]
+        endpoints = self.endpoints
+        if len(endpoints) == 1 and not exclude:
+            # 只有一个端点时不熔断：没有可以切换的端点，打开熔断器只会让请求在冷却期内直接失败
+            return endpoints[0], None
+        with self._lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude and endpoint.breaker.available(now)]
+            if not candidates:
+                raise NoAvailableEndpoint("[gpts-builder] no available endpoint, all circuit breakers are open")
+            candidates = [endpoint for endpoint in candidates if endpoint.base_url not in avoid] or candidates
+            scores = [endpoint.score() for endpoint in candidates]
+            endpoint = random.choices(candidates, weights=scores)[0]
+            return endpoint, endpoint.breaker.begin()
+
+    def release(self, endpoint, probe):
+        with self._lock:
+            endpoint.breaker.release(probe)
+
+    def record(self, endpoint, success, latency):
+        with self._lock:
+            if success:
+                endpoint.latency = latency if endpoint.latency is None else (
+                    self.latency_alpha * latency + (1 - self.latency_alpha) * endpoint.latency)
+            endpoint.breaker.record(success, latency, time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            return [endpoint.report() for endpoint in self.endpoints]
+
+    def _next(self, tried, avoid=()):
+        """选择下一个端点；已经失败过且没有其他可用端点时抛出最后一次的错误。"""
+        try:
+            return self.select(tried, avoid)
+        except NoAvailableEndpoint:
+            if tried and tried[-1][1] is not None:
+                raise tried[-1][1]
+            raise
+
+    def _failed(self, endpoint, error, started, tried, deadline=None):
+        """记录一次失败，返回是否应该换下一个端点重试。"""
+        if isinstance(error, DeadlineExceeded):
+            # 截止时间已到，请求没有发出：与端点无关，不记录也不再换端点
+            return False
+        failure = is_endpoint_failure(error)
+        # 请求本身的错误（如 400/401）不计入端点健康度
+        self.record(endpoint, not failure, time.monotonic() - started)
+        tried.append((endpoint, error))
+        if failure and deadline is not None and deadline.expired():
+            # 下一个端点只会因为同一个截止时间立即失败
+            return False
+        if failure and len(tried) < len(self.endpoints):
+            logger.warning(f"[gpts-builder] endpoint {endpoint.base_url} failed: {error}, failing over")
+            return True
+        return False
+
+    def call(self, path, send, headers=None, avoid=(), deadline=None):
+        """
+        同步请求，失败时换端点重试。
+
+        Args:
+            path (str): 接口路径，例如 /v1/chat/completions。
+            send (callable): 接收 (url, headers) 并发送请求的函数。
+            headers (dict, optional): 公共请求头，Authorization 由端点填充。
+            avoid (list): 尽量避开的端点 base_url。
+            deadline (Deadline, optional): send 使用的截止时间，到期后不再换端点重试。
+        """
+        tried = []
+        while True:
+            endpoint, probe = self._next(tried, avoid)
+            started = time.monotonic()
+            try:
+                result = send(endpoint.base_url + path, endpoint.headers(headers))
+            except Exception as e:
+                if self._failed(endpoint, e, started, tried, deadline):
+                    continue
+                raise
+            else:
+                self.record(endpoint, True, time.monotonic() - started)
+                return result
+            finally:
+                self.release(endpoint, probe)
+
+    async def call_async(self, path, send, headers=None, avoid=(), deadline=None):
+        """call 的异步版本，send 返回协程。"""
+        tried = []
+        while True:
+            endpoint, probe = self._next(tried, avoid)
+            started = time.monotonic()
+            try:
+                result = await send(endpoint.base_url + path, endpoint.headers(headers))
+            except Exception as e:
+                if self._failed(endpoint, e, started, tried, deadline):
+                    continue
+                raise
+            else:
+                self.record(endpoint, True, time.monotonic() - started)
+                return result
+            finally:
+                # 对冲请求的落败方会被取消（CancelledError 不是 Exception），探测名额同样要归还
+                self.release(endpoint, probe)
+
+    def stream(self, path, open_stream, headers=None, avoid=(), deadline=None):
+        """
+        同步流式请求：收到第一个片段之前失败会换端点重试，延迟按首个片段的到达时间统计。
+
+        Args:
+            open_stream (callable): 接收 (url, headers)、返回片段生成器的函数。
+            deadline (Deadline, optional): 收到首个片段之前的截止时间，到期后不再换端点重试。
+        """
+        tried = []
+        while True:
+            endpoint, probe = self._next(tried, avoid)
+            started = time.monotonic()
+            try:
+                stream = open_stream(endpoint.base_url + path, endpoint.headers(headers))
+                first = next(stream)
+            except StopIteration:
+                self.record(endpoint, True, time.monotonic() - started)
+                return
+            except Exception as e:
+                if self._failed(endpoint, e, started, tried, deadline):
+                    continue
+                raise
+            finally:
+                self.release(endpoint, probe)
+            self.record(endpoint, True, time.monotonic() - started)
+            yield first
+            yield from stream
+            return
+
+    async def stream_async(self, path, open_stream, headers=None, avoid=(), deadline=None):
+        """stream 的异步版本，open_stream 返回异步生成器。"""
+        tried = []
+        while True:
+            endpoint, probe = self._next(tried, avoid)
+            started = time.monotonic()
+            try:
+                stream = open_stream(endpoint.base_url + path, endpoint.headers(headers))
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                self.record(endpoint, True, time.monotonic() - started)
+                return
+            except Exception as e:
+                if self._failed(endpoint, e, started, tried, deadline):
+                    continue
+                raise
+            finally:
+                self.release(endpoint, probe)
+            self.record(endpoint, True, time.monotonic() - started)
+            yield first
+            async for chunk in stream:
+                yield chunk
+            return
+
+
+endpoint_pool = EndpointPool()
@@ -0,0 +1,224 @@
+"""
+对冲请求（hedged requests）：请求在最近延迟的某个分位数内没有返回时，再发送一个相同的请求（可以发往其他端点或备用模型），
+先返回的结果胜出，另一个请求被取消。流式请求以首个片段的到达时间（TTFT）为准。
+
+对冲会增加上游负载，HedgePolicy 的预算把对冲请求数限制在最近请求数的一定比例内。
+"""
+from collections import deque
+from threading import Lock
+import asyncio
+import time
+
+from .logger import logger
+
+
+class LatencyTracker:
+    """
+    最近 window 次请求的延迟，用于计算分位数。
+    """
+
+    def __init__(self, window=200):
+        self.samples = deque(maxlen=window)
+
+    def record(self, latency):
+        self.samples.append(latency)
+
+    def percentile(self, q):
+        """q 取值 0~1，没有样本时返回 None。"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgePolicy:
+    """
+    对冲策略。
+
+    Args:
+        percentile (float): 等待超过最近延迟的该分位数后发送对冲请求。
+        budget (float): 对冲请求占最近请求数的最大比例，例如 0.05 表示最多增加 5% 的请求。
+        min_samples (int): 样本数不足时不对冲（除非设置了 initial_delay）。
+        initial_delay (float, optional): 样本数不足时使用的对冲等待秒数。
+        min_delay (float): 对冲等待的最小秒数，避免延迟很低时几乎每个请求都被对冲。
+        hedge_model (str, optional): 对冲请求使用的备用模型，为 None 时使用原模型。
+        window (int): 统计延迟和预算的最近请求数。
+    """
+
+    def __init__(self, percentile=0.95, budget=0.05, min_samples=20, initial_delay=None, min_delay=0.05, hedge_model=None, window=200):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.hedge_model = hedge_model
+        self.window = window
+        self._trackers = {}
+        self._recent = deque(maxlen=window)
+        self._recent_hedges = 0
+        self._lock = Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _tracker(self, kind):
+        tracker = self._trackers.get(kind)
+        if tracker is None:
+            tracker = self._trackers[kind] = LatencyTracker(self.window)
+        return tracker
+
+    def delay(self, kind):
+        """kind（如 chat、chat_stream）类请求的对冲等待秒数，返回 None 表示不对冲。"""
+        with self._lock:
+            tracker = self._tracker(kind)
+            if len(tracker.samples) < self.min_samples:
+                return self.initial_delay
+            return max(self.min_delay, tracker.percentile(self.percentile))
+
+    def begin(self):
+        """记录一次请求。"""
+        with self._lock:
+            self.requests += 1
+            self._push(False)
+
+    def allow(self):
+        """预算内时占用一次对冲名额并返回 True。"""
+        with self._lock:
+            if self._recent_hedges + 1 > self.budget * (len(self._recent) - self._recent_hedges):
+                return False
+            self.hedges += 1
+            self._push(True)
+            return True
+
+    def _push(self, hedged):
+        if len(self._recent) == self._recent.maxlen and self._recent[0]:
+            self._recent_hedges -= 1
+        self._recent.append(hedged)
+        self._recent_hedges += hedged
+
+    def record(self, kind, latency, hedge_won=False):
+        with self._lock:
+            self._tracker(kind).record(latency)
+            self.hedge_wins += hedge_won
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "delays": {kind: tracker.percentile(self.percentile) for kind, tracker in self._trackers.items()},
+            }
+
+
+def _cancel_requested():
+    """当前任务自己是否被取消了（Python 3.11+ 使用 Task.cancelling）。"""
+    cancelling = getattr(asyncio.current_task(), "cancelling", None)
+    return bool(cancelling and cancelling())
+
+
+async def _cancel(tasks):
+    """
+    取消落败的请求并等待它们结束。只忽略子任务自己的 CancelledError 和错误；
+    当前任务被取消（调用方取消了对冲请求）时继续向外抛出，KeyboardInterrupt 等也不会被吞掉。
+    """
+    for task in tasks:
+        task.cancel()
+    cancelled = None
+    for task in tasks:
+        try:
+            await task
+        except asyncio.CancelledError as e:
+            # 子任务还没结束说明这个 CancelledError 是发给当前任务的；先把其余子任务处理完再抛出
+            if _cancel_requested() or not task.done():
+                cancelled = e
+        except Exception as e:
+            logger.debug(f"[gpts-builder] cancelled hedged request failed: {e!r}")
+    if cancelled is not None:
+        raise cancelled
+
+
+async def hedged_call(policy, kind, primary, hedge):
+    """
+    发送 primary，超过对冲等待时间仍未返回且预算允许时再发送 hedge，返回先成功的结果并取消另一个。
+
+    Args:
+        policy (HedgePolicy): 对冲策略。
+        kind (str): 请求类型，不同类型的延迟分别统计。
+        primary (callable): 返回协程的无参函数。
+        hedge (callable): 返回协程的无参函数，发送对冲请求。
+    """
+    policy.begin()
+    started = time.monotonic()
+    primary_task = asyncio.ensure_future(primary())
+    tasks = {primary_task}
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=policy.delay(kind))
+        if not done and policy.allow():
+            logger.info(f"[gpts-builder] {kind} request slower than {policy.delay(kind):.3f}s, sending hedged request")
+            tasks.add(asyncio.ensure_future(hedge()))
+        error = None
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    policy.record(kind, time.monotonic() - started, task is not primary_task)
+                    return task.result()
+                # 主请求的错误优先抛出
+                if error is None or task is primary_task:
+                    error = task.exception()
+        raise error
+    finally:
+        await _cancel(tasks)
+
+
+async def hedged_stream(policy, kind, primary, hedge):
+    """
+    流式版本：在对冲等待时间内没有收到首个片段时发送 hedge，先收到首个片段的流胜出，另一个流被关闭。
+
+    Args:
+        primary (callable): 返回片段异步生成器的无参函数。
+        hedge (callable): 返回片段异步生成器的无参函数。
+    """
+    policy.begin()
+    started = time.monotonic()
+    primary_stream = primary()
+    streams = {asyncio.ensure_future(primary_stream.__anext__()): primary_stream}
+    winner = None
+    try:
+        done, _ = await asyncio.wait(streams, timeout=policy.delay(kind))
+        if not done and policy.allow():
+            logger.info(f"[gpts-builder] {kind} first token slower than {policy.delay(kind):.3f}s, sending hedged request")
+            hedge_stream = hedge()
+            streams[asyncio.ensure_future(hedge_stream.__anext__())] = hedge_stream
+        error = None
+        pending = set(streams)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                # 空流（StopAsyncIteration）也算完成
+                if task.exception() is None or isinstance(task.exception(), StopAsyncIteration):
+                    winner = task
+                    break
+                if error is None or streams[task] is primary_stream:
+                    error = task.exception()
+        if winner is None:
+            raise error
+    finally:
+        losers = [task for task in streams if task is not winner]
+        await _cancel(losers)
+        for task in losers:
+            try:
+                await streams[task].aclose()
+            except Exception as e:
+                logger.debug(f"[gpts-builder] closing hedged stream failed: {e!r}")
+    stream = streams[winner]
+    policy.record(kind, time.monotonic() - started, stream is not primary_stream)
+    if winner.exception() is not None:
+        return
+    try:
+        yield winner.result()
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
@@ -1,29 +1,219 @@
-import requests
+from threading import Lock
+import asyncio
+import atexit
+import time
+import weakref
+
 import httpx
-import backoff
+
+from . import json_codec
+from .logger import logger
+from .rate_limiter import RateLimiter, api_key_from_headers
+from .retry import Deadline, DeadlineExceeded, RetryPolicy
+
+
+def http2_available():
+    """HTTP/2 需要安装 h2（pip install httpx[http2]）。"""
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
 
 class HTTPClient:
     
-    def __init__(self):
-        # 创建一个持久的 AsyncClient 实例
-        self.async_client = httpx.AsyncClient()
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30, http2=False, rate_limiter=None,
+                 concurrency_limiter=None):
+        """
+        Args:
+            max_connections (int): 连接池的最大连接数。
+            max_keepalive_connections (int): 连接池中保持的空闲长连接数。
+            keepalive_expiry (float): 空闲长连接的保持时间（秒）。
+            http2 (bool): 是否启用 HTTP/2，需要安装 h2，未安装时退回 HTTP/1.1。
+            rate_limiter (RateLimiter, optional): 按模型和 API key 的 RPM/TPM 限流器，默认按 config_manager 的模型配置限流。
+            concurrency_limiter (AdaptiveConcurrencyLimiter, optional): 异步请求按端点和模型的自适应并发限制，默认不限制。
+        """
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.concurrency_limiter = concurrency_limiter
+        self._client = None
+        # 每个事件循环一个 (AsyncClient, 关闭守卫)：httpx 的连接绑定在创建它的事件循环上，不能跨循环共享
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._client_lock = Lock()
+        self.configure(max_connections, max_keepalive_connections, keepalive_expiry, http2)
+        atexit.register(self.close)
+
+    def configure(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30, http2=False):
+        """修改连接池配置，已经创建的连接池（包括各事件循环的异步连接池）会被关闭，下次请求时按新配置重新创建。"""
+        if http2 and not http2_available():
+            logger.warning("[gpts-builder] h2 is not installed, falling back to HTTP/1.1")
+            http2 = False
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.http2 = http2
+        self.close()
+        self._discard_async_clients()
+
+    @property
+    def client(self):
+        """线程安全的共享同步连接池，第一次使用时创建。"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = httpx.Client(limits=self.limits, http2=self.http2)
+        return self._client
+
+    @property
+    def async_client(self):
+        """
+        当前事件循环的共享异步连接池，第一次使用时创建，只能在事件循环中访问。
+
+        连接池随事件循环一起关闭：asyncio.run 结束前会关闭所有未结束的异步生成器（shutdown_asyncgens），
+        每个连接池都挂在一个这样的守卫生成器上。事件循环没有经过 shutdown_asyncgens 就关闭时，下次访问时从注册表中移除。
+        """
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            stale = self._pop_closed_loops()
+            entry = self._async_clients.get(loop)
+            if entry is None or entry[0].is_closed:
+                client = httpx.AsyncClient(limits=self.limits, http2=self.http2)
+                guard = self._close_with_loop(loop, client)
+                self._async_clients[loop] = (client, guard)
+            else:
+                client, guard = entry[0], None
+        for closed_guard in stale:
+            self._finish_guard(closed_guard)
+        if guard is None:
+            return client
+        # 守卫在 yield 之前没有 await，同步推进到 yield 即可注册到当前事件循环
+        try:
+            guard.asend(None).send(None)
+        except StopIteration:
+            pass
+        return client
+
+    async def _close_with_loop(self, loop, client):
+        """事件循环关闭异步生成器（或 aclose / configure 主动关闭）时关闭连接池并移出注册表。"""
+        try:
+            yield
+        finally:
+            with self._client_lock:
+                entry = self._async_clients.get(loop)
+                if entry is not None and entry[0] is client:
+                    del self._async_clients[loop]
+            if not loop.is_closed():
+                await client.aclose()
+
+    def _pop_closed_loops(self):
+        """
+        移除并返回事件循环已经关闭的守卫。连接绑定的 transport 引用着事件循环，注册表不移除时事件循环、连接池和长连接都不会被回收；
+        事件循环关闭后无法再关闭连接，只能释放引用。调用方需要持有 _client_lock。
+        """
+        guards = []
+        for loop in [loop for loop in self._async_clients.keys() if loop.is_closed()]:
+            client, guard = self._async_clients.pop(loop)
+            if not client.is_closed:
+                logger.debug("[gpts-builder] event loop closed without shutting down async generators, dropping its http client")
+            guards.append(guard)
+        return guards
+
+    @staticmethod
+    def _finish_guard(guard):
+        """事件循环已经关闭时同步结束守卫（不会再 await），避免守卫被回收时把关闭操作排到已经关闭的事件循环上。"""
+        try:
+            guard.aclose().send(None)
+        except StopIteration:
+            pass
+
+    def close(self):
+        """关闭同步连接池。"""
+        with self._client_lock:
+            client, self._client = self._client, None
+        if client is not None:
+            client.close()
+
+    async def aclose(self):
+        """关闭当前事件循环的异步连接池；使用 asyncio.run 时事件循环结束前会自动关闭，不需要手动调用。"""
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            entry = self._async_clients.get(loop)
+        if entry is not None:
+            await entry[1].aclose()
+
+    def _discard_async_clients(self):
+        """移除所有事件循环的异步连接池，仍在运行的事件循环中安排关闭，已经关闭的事件循环直接丢弃。"""
+        with self._client_lock:
+            entries = list(self._async_clients.items())
+            self._async_clients.clear()
+        for loop, (client, guard) in entries:
+            if loop.is_closed():
+                self._finish_guard(guard)
+            else:
+                loop.call_soon_threadsafe(lambda guard=guard: asyncio.ensure_future(guard.aclose()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
-        # 确保在类实例不再使用时关闭 client
-        await self.async_client.aclose()
+        # 确保在类实例不再使用时关闭当前事件循环的 client
+        await self.aclose()
+
+    def _record_usage(self, data, model, headers, estimated_tokens):
+        """按响应中的 usage 修正 TPM 限流的预估值。"""
+        if model and isinstance(data, dict) and isinstance(data.get("usage"), dict):
+            self.rate_limiter.record_usage(model, api_key_from_headers(headers), estimated_tokens, data["usage"].get("total_tokens"))
+        return data
 
-    def post(self, url, json=None, headers=None, timeout=60, max_retries=3):
+    @staticmethod
+    def _encode_body(json, headers):
+        """请求体只编码一次，重试时复用同一份字节。"""
+        if json is None:
+            return None, headers
+        return json_codec.dumps_bytes(json), json_codec.json_headers(headers)
+
+    async def _acquire_slot(self, url, model, deadline):
+        """未配置并发限制器时返回 None。"""
+        if self.concurrency_limiter is None:
+            return None
+        return await self.concurrency_limiter.acquire(self.concurrency_limiter.key(url, model), deadline)
+
+    def _release_slot(self, permit, error=None, latency=None):
+        if permit is not None:
+            self.concurrency_limiter.release(permit, error, latency)
+
+    def _acquire_rate(self, model, headers, estimated_tokens, deadline):
+        """每个逻辑请求（包含所有重试）只预留一次限流额度，model 为 None 时不限流。"""
+        if model:
+            self.rate_limiter.acquire(model, api_key_from_headers(headers), estimated_tokens, deadline)
+
+    async def _acquire_rate_async(self, model, headers, estimated_tokens, deadline):
+        if model:
+            await self.rate_limiter.acquire_async(model, api_key_from_headers(headers), estimated_tokens, deadline)
+
+    def _cancel_rate(self, model, headers, estimated_tokens):
+        """请求最终失败（没有返回 usage），归还预留的 token。"""
+        if model:
+            self.rate_limiter.cancel(model, api_key_from_headers(headers), estimated_tokens)
+
+    def post(self, url, json=None, headers=None, timeout=60, max_retries=3, model=None, estimated_tokens=0, deadline=None):
         """
         执行同步的 HTTP POST请求，并支持自定义超时和重试次数。
         
         参数:
             url (str): 请求的 URL。
-            json (dict, optional): 这是要发送的数据。默认为 None。
-            timeout (int, optional): 请求超时时间（秒）。默认为 60 秒。
-            max_retries (int, optional): 失败时的最大重试次数。默认为 3。
+            json (dict, optional): 这是要发送的数据，由 json_codec 预先编码为字节。默认为 None。
+            timeout (int, optional): 单次请求超时时间（秒）。默认为 60 秒。
+            max_retries (int, optional): 最多尝试次数，只重试连接错误、超时和 408/409/429/5xx。默认为 3。
+            model (str, optional): 用于限流的模型名，为 None 时不限流。
+            estimated_tokens (int, optional): 本次请求预估消耗的 token 数，计入 TPM 限额。
+            deadline (Deadline | float, optional): 包含所有重试的截止时间（或秒数），默认为 timeout 秒。
         
         返回:
             dict: 从服务器返回的 JSON 数据。
@@ -31,54 +221,86 @@ class HTTPClient:
         异常:
             HTTPError: 如果响应状态码表示错误。
         """
-        @backoff.on_exception(backoff.expo,
-                              (requests.exceptions.RequestException, requests.exceptions.HTTPError, requests.exceptions.Timeout),
-                              max_tries=max_retries)
-        def request_with_backoff():
-            response = requests.post(url, json=json, timeout=timeout, headers=headers)
+        deadline = Deadline.coerce(deadline, timeout)
+        content, request_headers = self._encode_body(json, headers)
+        self._acquire_rate(model, headers, estimated_tokens, deadline)
+
+        def attempt():
+            response = self.client.post(url, content=content, timeout=deadline.clip(timeout), headers=request_headers)
             response.raise_for_status()
-            return response.json()
+            return self._record_usage(json_codec.loads(response.content), model, headers, estimated_tokens)
 
-        return request_with_backoff()
+        try:
+            return RetryPolicy(max_retries).call(attempt, deadline, f"POST {url}")
+        except BaseException:
+            self._cancel_rate(model, headers, estimated_tokens)
+            raise
     
-    def post_stream(self, url, json=None, headers=None, timeout=60, max_retries=3):
+    def post_stream(self, url, json=None, headers=None, timeout=60, max_retries=3, decode=True, model=None, estimated_tokens=0, deadline=None):
         """
         执行同步的 HTTP POST 请求，并支持流式响应、自定义超时和重试次数。
+
+        收到第一个片段之前失败会按重试策略重试，之后失败直接抛出（已经返回给调用方的内容无法撤回）。
         
         参数:
             url (str): 请求的 URL。
-            json (dict, optional): 这是要发送的数据。默认为 None。
-            timeout (int, optional): 请求超时时间（秒）。默认为 60 秒。
+            json (dict, optional): 这是要发送的数据，由 json_codec 预先编码为字节。默认为 None。
+            timeout (int, optional): 单次请求超时时间（秒）。默认为 60 秒。
             headers (dict, optional): 请求的头部。默认为 None。
-            max_retries (int, optional): 失败时的最大重试次数。默认为 3。
+            max_retries (int, optional): 最多尝试次数，只重试连接错误、超时和 408/409/429/5xx。默认为 3。
+            decode (bool, optional): 是否解码为文本，为 False 时直接返回原始字节（交给 SSE 解析器）。默认为 True。
+            model (str, optional): 用于限流的模型名，为 None 时不限流。
+            estimated_tokens (int, optional): 本次请求预估消耗的 token 数，计入 TPM 限额。
+            deadline (Deadline | float, optional): 收到第一个片段之前（包含所有重试）的截止时间（或秒数），默认为 timeout 秒。
         
         返回:
-            Generator[str, None, None]: 流式响应内容的生成器。
+            Generator[str | bytes, None, None]: 流式响应内容的生成器。
         
         异常:
             HTTPError: 如果响应状态码表示错误。
         """
-        
-        @backoff.on_exception(backoff.expo,
-                              (requests.exceptions.RequestException, requests.exceptions.HTTPError, requests.exceptions.Timeout),
-                              max_tries=max_retries)
-        def request_with_backoff():
-            response = requests.post(url, json=json, headers=headers, timeout=timeout, stream=True)
-            response.raise_for_status()
-            for chunk in response.iter_content(chunk_size=1024, decode_unicode=True):
-                yield chunk
-        
-        return request_with_backoff()
+        deadline = Deadline.coerce(deadline, timeout)
+        content, request_headers = self._encode_body(json, headers)
+        policy = RetryPolicy(max_retries)
+        delay = None
+        self._acquire_rate(model, headers, estimated_tokens, deadline)
+        started = False
+        try:
+            for number in range(1, policy.max_attempts + 1):
+                if deadline.expired():
+                    raise DeadlineExceeded(f"[gpts-builder] deadline exceeded before attempt {number}: POST {url}")
+                try:
+                    with self.client.stream("POST", url, content=content, headers=request_headers, timeout=deadline.clip(timeout)) as response:
+                        if response.is_error:
+                            # 读出错误响应体，调用方（如按模型降级）才能从 HTTPStatusError 中解析错误码
+                            response.read()
+                        response.raise_for_status()
+                        chunks = response.iter_text(chunk_size=1024) if decode else response.iter_bytes()
+                        for chunk in chunks:
+                            started = True
+                            yield chunk
+                    return
+                except Exception as e:
+                    if started:
+                        raise
+                    delay = policy.backoff(e, number, delay, deadline, f"POST {url}")
+                    time.sleep(delay)
+        except BaseException:
+            # 已经开始返回内容时上游已经消耗了 token，不再归还
+            if not started:
+                self._cancel_rate(model, headers, estimated_tokens)
+            raise
 
-    def get(self, url, params=None, headers=None, timeout=60, max_retries=3):
+    def get(self, url, params=None, headers=None, timeout=60, max_retries=3, deadline=None):
         """
         执行同步的 HTTP GET请求，并支持自定义超时和重试次数。
         
         参数:
             url (str): 请求的 URL。
             params (dict, optional): 要发送的数据。默认为 None。
-            timeout (int, optional): 请求超时时间（秒）。默认为 60 秒。
-            max_retries (int, optional): 失败时的最大重试次数。默认为 3。
+            timeout (int, optional): 单次请求超时时间（秒）。默认为 60 秒。
+            max_retries (int, optional): 最多尝试次数，只重试连接错误、超时和 408/409/429/5xx。默认为 3。
+            deadline (Deadline | float, optional): 包含所有重试的截止时间（或秒数），默认为 timeout 秒。
         
         返回:
             dict: 从服务器返回的 JSON 数据。
@@ -86,98 +308,150 @@ class HTTPClient:
         异常:
             HTTPError: 如果响应状态码表示错误。
         """
-        @backoff.on_exception(backoff.expo,
-                              (requests.exceptions.RequestException, requests.exceptions.HTTPError, requests.exceptions.Timeout),
-                              max_tries=max_retries)
-        def request_with_backoff():
-            response = requests.get(url, params=params, timeout=timeout, headers=headers)
+        deadline = Deadline.coerce(deadline, timeout)
+
+        def attempt():
+            response = self.client.get(url, params=params, timeout=deadline.clip(timeout), headers=headers)
             response.raise_for_status()
-            return response.json()
+            return json_codec.loads(response.content)
 
-        return request_with_backoff()
+        return RetryPolicy(max_retries).call(attempt, deadline, f"GET {url}")
 
-    async def post_async(self, url, json=None, headers=None, timeout=60, max_retries=3):
+    async def post_async(self, url, json=None, headers=None, timeout=60, max_retries=3, model=None, estimated_tokens=0, deadline=None):
         """
         执行异步的 POST 请求，并支持自定义超时和重试次数。
         
         参数:
             url (str): 请求的 URL。
-            json (dict, optional): 这是要发送的数据。默认为 None。
-            timeout (int, optional): 请求超时时间（秒）。默认为 60 秒。
-            max_retries (int, optional): 失败时的最大重试次数。默认为 3。
+            json (dict, optional): 这是要发送的数据，由 json_codec 预先编码为字节。默认为 None。
+            timeout (int, optional): 单次请求超时时间（秒）。默认为 60 秒。
+            max_retries (int, optional): 最多尝试次数，只重试连接错误、超时和 408/409/429/5xx。默认为 3。
+            model (str, optional): 用于限流的模型名，为 None 时不限流。
+            estimated_tokens (int, optional): 本次请求预估消耗的 token 数，计入 TPM 限额。
+            deadline (Deadline | float, optional): 包含所有重试的截止时间（或秒数），默认为 timeout 秒。
         
         返回:
             dict: 从服务器返回的 JSON 数据。
         
         异常:
-            ValueError: 如果提供了不支持的 HTTP 方法。
+            HTTPError: 如果响应状态码表示错误。
+            OverloadError: 配置了并发限制器且并发已满时，排队已满或排队超时。
         """
-        @backoff.on_exception(backoff.expo,
-                            (httpx.TimeoutException, httpx.RequestError, httpx.HTTPStatusError, httpx.HTTPError),
-                              max_tries=max_retries)
-        async def request_with_backoff():
-            response = await self.async_client.post(url, json=json, timeout=timeout, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        
-        return await request_with_backoff()
-        
-    async def post_stream_async(self, url, json=None, headers=None, timeout=60, max_retries=3):
+        deadline = Deadline.coerce(deadline, timeout)
+        content, request_headers = self._encode_body(json, headers)
+        await self._acquire_rate_async(model, headers, estimated_tokens, deadline)
+
+        async def attempt():
+            permit = await self._acquire_slot(url, model, deadline)
+            error = None
+            try:
+                response = await self.async_client.post(url, content=content, timeout=deadline.clip(timeout), headers=request_headers)
+                response.raise_for_status()
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self._release_slot(permit, error)
+            return self._record_usage(json_codec.loads(response.content), model, headers, estimated_tokens)
+
+        try:
+            return await RetryPolicy(max_retries).call_async(attempt, deadline, f"POST {url}")
+        except BaseException:
+            self._cancel_rate(model, headers, estimated_tokens)
+            raise
+
+    async def post_stream_async(self, url, json=None, headers=None, timeout=60, max_retries=3, decode=True, model=None, estimated_tokens=0, deadline=None):
         """
-        执行异步的 POST 请求，并支持自定义超时和重试次数。
+        执行异步的 POST 请求，并支持流式响应、自定义超时和重试次数。
+
+        收到第一个片段之前失败会按重试策略重试，之后失败直接抛出。
         
         参数:
             url (str): 请求的 URL。
-            json (dict, optional): 这是要发送的数据。默认为 None。
-            timeout (int, optional): 请求超时时间（秒）。默认为 60 秒。
-            max_retries (int, optional): 失败时的最大重试次数。默认为 3。
+            json (dict, optional): 这是要发送的数据，由 json_codec 预先编码为字节。默认为 None。
+            timeout (int, optional): 单次请求超时时间（秒）。默认为 60 秒。
+            max_retries (int, optional): 最多尝试次数，只重试连接错误、超时和 408/409/429/5xx。默认为 3。
+            decode (bool, optional): 是否解码为文本，为 False 时直接返回原始字节（交给 SSE 解析器）。默认为 True。
+            model (str, optional): 用于限流的模型名，为 None 时不限流。
+            estimated_tokens (int, optional): 本次请求预估消耗的 token 数，计入 TPM 限额。
+            deadline (Deadline | float, optional): 收到第一个片段之前（包含所有重试）的截止时间（或秒数），默认为 timeout 秒。
         
         返回:
-            dict: 从服务器返回的 JSON 数据。
+            AsyncGenerator[str | bytes, None]: 流式响应内容的异步生成器。
         
         异常:
-            ValueError: 如果提供了不支持的 HTTP 方法。
-        """
-        @backoff.on_exception(backoff.expo,
-                            (httpx.TimeoutException, httpx.RequestError, httpx.HTTPStatusError, httpx.HTTPError),
-                            max_tries=max_retries)
-        async def request_with_backoff():
-            async with httpx.AsyncClient() as client:
-                # Properly using the async with statement with client.stream
-                async with client.stream("POST", url=url, headers=headers, json=json, timeout=timeout) as response:
-                    response.raise_for_status()  # Ensure the response status is OK
-                    async for chunk in response.aiter_text(chunk_size=1024):
-                        yield chunk
-        # 返回生成器
-        async for item in request_with_backoff():
-            yield item
+            HTTPError: 如果响应状态码表示错误。
+            OverloadError: 配置了并发限制器且并发已满时，排队已满或排队超时。
+        """
+        deadline = Deadline.coerce(deadline, timeout)
+        content, request_headers = self._encode_body(json, headers)
+        policy = RetryPolicy(max_retries)
+        delay = None
+        await self._acquire_rate_async(model, headers, estimated_tokens, deadline)
+        started = False
+        try:
+            for number in range(1, policy.max_attempts + 1):
+                if deadline.expired():
+                    raise DeadlineExceeded(f"[gpts-builder] deadline exceeded before attempt {number}: POST {url}")
+                try:
+                    permit = await self._acquire_slot(url, model, deadline)
+                    # 并发名额一直占用到流结束，延迟按首个片段的到达时间计算
+                    opened, first_chunk_latency, error = time.monotonic(), None, None
+                    try:
+                        # 与非流式请求共用当前事件循环的连接池
+                        async with self.async_client.stream("POST", url=url, headers=request_headers, content=content, timeout=deadline.clip(timeout)) as response:
+                            if response.is_error:
+                                # 读出错误响应体，调用方（如按模型降级）才能从 HTTPStatusError 中解析错误码
+                                await response.aread()
+                            response.raise_for_status()  # Ensure the response status is OK
+                            chunks = response.aiter_text(chunk_size=1024) if decode else response.aiter_bytes()
+                            async for chunk in chunks:
+                                if not started:
+                                    started = True
+                                    first_chunk_latency = time.monotonic() - opened
+                                yield chunk
+                    except BaseException as e:
+                        error = e
+                        raise
+                    finally:
+                        self._release_slot(permit, error, first_chunk_latency)
+                    return
+                except Exception as e:
+                    if started:
+                        raise
+                    delay = policy.backoff(e, number, delay, deadline, f"POST {url}")
+                    await asyncio.sleep(delay)
+        except BaseException:
+            # 已经开始返回内容时上游已经消耗了 token，不再归还
+            if not started:
+                self._cancel_rate(model, headers, estimated_tokens)
+            raise
     
-    async def get_async(self, url, params=None, headers=None, timeout=60, max_retries=3):
+    async def get_async(self, url, params=None, headers=None, timeout=60, max_retries=3, deadline=None):
         """
-        执行异步的 HTTP GET 或 POST 请求，并支持自定义超时和重试次数。
+        执行异步的 HTTP GET 请求，并支持自定义超时和重试次数。
         
         参数:
             url (str): 请求的 URL。
             params (dict, optional): 这是要发送的数据。默认为 None。
-            timeout (int, optional): 请求超时时间（秒）。默认为 60 秒。
-            max_retries (int, optional): 失败时的最大重试次数。默认为 3。
+            timeout (int, optional): 单次请求超时时间（秒）。默认为 60 秒。
+            max_retries (int, optional): 最多尝试次数，只重试连接错误、超时和 408/409/429/5xx。默认为 3。
+            deadline (Deadline | float, optional): 包含所有重试的截止时间（或秒数），默认为 timeout 秒。
         
         返回:
             dict: 从服务器返回的 JSON 数据。
         
         异常:
             HTTPError: 如果响应状态码表示错误。
-            ValueError: 如果提供了不支持的 HTTP 方法。
         """
-        @backoff.on_exception(backoff.expo,
-                            (httpx.TimeoutException, httpx.RequestError, httpx.HTTPStatusError, httpx.HTTPError),
-                              max_tries=max_retries)
-        async def request_with_backoff():
-            response = await self.async_client.get(url, params=params, timeout=timeout, headers=headers)
+        deadline = Deadline.coerce(deadline, timeout)
+
+        async def attempt():
+            response = await self.async_client.get(url, params=params, timeout=deadline.clip(timeout), headers=headers)
             response.raise_for_status()
-            return response.json()
+            return json_codec.loads(response.content)
 
-        return await request_with_backoff()
+        return await RetryPolicy(max_retries).call_async(attempt, deadline, f"GET {url}")
     
     
 
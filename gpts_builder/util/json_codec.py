@@ -0,0 +1,79 @@
+"""
+JSON 编解码：安装了 orjson 或 msgspec 时使用它们，否则回退到标准库 json。
+
+请求体、会话和存储都经过这里编码，dumps_bytes 直接得到可以发送的 UTF-8 字节，省去一次 str 到 bytes 的转换。
+快速实现不支持的对象（如超出 64 位的整数）会回退到标准库重新编码。
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 可选依赖
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - 可选依赖
+    msgspec = None
+
+JSON_CONTENT_TYPE = "application/json"
+
+
+def _stdlib_dumps_bytes(obj):
+    # 与 orjson/msgspec 一致：不转义非 ASCII 字符、不输出多余空格
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+if orjson is not None:
+    backend = "orjson"
+    _OPTIONS = orjson.OPT_NON_STR_KEYS
+
+    def _fast_dumps_bytes(obj):
+        return orjson.dumps(obj, option=_OPTIONS)
+
+    _fast_loads = orjson.loads
+    _fast_errors = (orjson.JSONEncodeError,)
+elif msgspec is not None:
+    backend = "msgspec"
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+    _fast_dumps_bytes = _encoder.encode
+    _fast_loads = _decoder.decode
+    _fast_errors = (TypeError, OverflowError)
+else:
+    backend = "json"
+    _fast_dumps_bytes = _stdlib_dumps_bytes
+    _fast_loads = json.loads
+    _fast_errors = ()
+
+
+def dumps_bytes(obj) -> bytes:
+    """把 obj 编码为 UTF-8 JSON 字节。"""
+    try:
+        return _fast_dumps_bytes(obj)
+    except _fast_errors:
+        return _stdlib_dumps_bytes(obj)
+
+
+def dumps(obj) -> str:
+    """把 obj 编码为 JSON 字符串。"""
+    return dumps_bytes(obj).decode("utf-8")
+
+
+def loads(data):
+    """解码 JSON，data 可以是 str、bytes 或 bytearray；格式错误时抛出 ValueError。"""
+    try:
+        return _fast_loads(data)
+    except ValueError:
+        raise
+    except Exception as e:
+        # msgspec 的解码错误不是 ValueError 的子类，统一成 ValueError 方便调用方处理
+        raise ValueError(str(e)) from e
+
+
+def json_headers(headers=None) -> dict:
+    """补上 Content-Type: application/json，用于发送预先编码好的请求体。"""
+    headers = dict(headers or {})
+    if not any(name.lower() == "content-type" for name in headers):
+        headers["Content-Type"] = JSON_CONTENT_TYPE
+    return headers
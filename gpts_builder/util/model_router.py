@@ -0,0 +1,282 @@
+"""
+模型路由：按请求选择模型。
+
+先按提示词的 token 数（加上 max_tokens）过滤掉上下文放不下的模型（调用方传入会话已经维护好的 token 数时直接使用，不再重新编码），再综合价格、最近的延迟和错误率打分，
+选出得分最低（最便宜、最快、最稳定）的模型；请求超时或上下文超长时自动降级到下一个模型重试。
+
+模型的上下文长度来自 config_manager 模型配置的 max_tokens，价格来自可选的 input_cost / output_cost 字段
+（每 1000 个 token 的价格），也可以通过 costs 参数传入。
+"""
+from collections import deque
+from threading import Lock
+import time
+
+import httpx
+
+from ..config.config_manager import config_manager
+from .endpoint_pool import is_endpoint_failure
+from .logger import logger
+
+# 上游返回的上下文超长错误码
+CONTEXT_OVERFLOW_CODES = ("context_length_exceeded",)
+# 错误率再高也保留的最低成功率，避免得分无穷大
+MIN_SUCCESS_RATE = 0.05
+
+
+class NoAvailableModel(Exception):
+    """没有上下文足够且未尝试过的模型。"""
+
+
+def is_context_overflow(error):
+    """上游返回 400 且错误码为 context_length_exceeded。"""
+    if not isinstance(error, httpx.HTTPStatusError) or error.response.status_code != 400:
+        return False
+    try:
+        body = error.response.json()
+    except Exception:
+        return False
+    error_info = body.get("error") if isinstance(body, dict) else None
+    return isinstance(error_info, dict) and error_info.get("code") in CONTEXT_OVERFLOW_CODES
+
+
+def should_cascade(error):
+    """超时和上下文超长时换模型重试。"""
+    return isinstance(error, httpx.TimeoutException) or is_context_overflow(error)
+
+
+class ModelStats:
+    """一个模型最近的成功率和各类请求延迟（指数移动平均）。"""
+
+    def __init__(self, window=50):
+        self.window = deque(maxlen=window)
+        self.latency = {}
+        self.requests = 0
+        self.errors = 0
+
+    def error_rate(self):
+        return sum(1 for ok in self.window if not ok) / len(self.window) if self.window else 0.0
+
+    def report(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate(), 4),
+            "latency": {kind: round(latency, 3) for kind, latency in self.latency.items()},
+        }
+
+
+class ModelRouter:
+    """
+    Args:
+        models (list, optional): 候选模型，默认使用 config_manager 中配置的全部模型。
+        costs (dict, optional): {模型: {"input": 价格, "output": 价格}}，每 1000 个 token 的价格，覆盖模型配置中的 input_cost / output_cost。
+        fallbacks (dict, optional): {模型: 降级模型}，未配置时降级到剩余模型中得分最低的一个。
+        latency_weight (float): 每秒延迟折算的价格，越大越偏向快的模型。
+        latency_alpha (float): 延迟指数移动平均的平滑系数。
+        window (int): 统计错误率的最近请求数。
+    """
+
+    def __init__(self, models=None, costs=None, fallbacks=None, latency_weight=0.001, latency_alpha=0.2, window=50):
+        self.models = list(models) if models else None
+        self.costs = costs or {}
+        self.fallbacks = fallbacks or {}
+        self.latency_weight = latency_weight
+        self.latency_alpha = latency_alpha
+        self.window = window
+        self._stats = {}
+        self._lock = Lock()
+
+    def candidates(self):
+        return self.models or [config["model"] for config in config_manager.model_settings]
+
+    def _model_stats(self, model):
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelStats(self.window)
+        return stats
+
+    def cost(self, model, prompt_tokens, output_tokens):
+        """一次请求的预估价格，未配置价格的模型为 0。"""
+        model_config = config_manager.get_model_config(model) or {}
+        prices = self.costs.get(model) or {}
+        input_cost = prices.get("input", model_config.get("input_cost", 0))
+        output_cost = prices.get("output", model_config.get("output_cost", 0))
+        return (prompt_tokens * input_cost + output_tokens * output_cost) / 1000
+
+    @staticmethod
+    def prompt_tokens(messages, model):
+        """按模型的 token 配置计算提示词 token 数，tiktoken 不可用时按字符数估算。"""
+        # 只在调用方没有传入 token 数时需要，导入 session_manager 包会连带导入 Redis 存储
+        from ..session_manager.base_session import Session
+        try:
+            return Session.num_tokens_from_messages(messages, model)
+        except Exception as e:
+            logger.debug(f"[gpts-builder] Exception when counting tokens precisely for routing: {e}")
+            return Session.num_tokens_by_character(messages)
+
+    def score(self, model, prompt_tokens, output_tokens, kind="chat"):
+        """得分越低越好：(价格 + 延迟 × latency_weight) / 成功率；没有延迟样本的模型按 0 计，会优先被探索。"""
+        with self._lock:
+            stats = self._model_stats(model)
+            latency = stats.latency.get(kind, 0.0)
+            success_rate = max(1.0 - stats.error_rate(), MIN_SUCCESS_RATE)
+        return (self.cost(model, prompt_tokens, output_tokens) + latency * self.latency_weight) / success_rate
+
+    def select(self, messages, output_tokens=0, kind="chat", tried=(), min_context=0, prompt_tokens=None):
+        """
+        选择模型。
+
+        Args:
+            messages (list): 请求的消息列表。
+            output_tokens (int): 请求的 max_tokens，计入上下文长度。
+            kind (str): 请求类型（chat、chat_stream），延迟分别统计。
+            tried (list): 已经失败的模型，不再选择。
+            min_context (int): 模型上下文长度的下限（上下文超长后降级时使用）。
+            prompt_tokens (int, optional): 提示词的 token 数（如会话的 calc_tokens），为 None 时按各模型的 token 配置计算。
+
+        Raises:
+            NoAvailableModel: 没有上下文足够的模型。
+        """
+        counted = {}
+        best, best_score = None, None
+        for model in self.candidates():
+            model_config = config_manager.get_model_config(model)
+            if model in tried or not model_config or model_config.get("max_tokens", 0) < min_context:
+                continue
+            tokens = prompt_tokens
+            if tokens is None:
+                token_setting = model_config.get("token_setting", model)
+                if token_setting not in counted:
+                    counted[token_setting] = self.prompt_tokens(messages, model)
+                tokens = counted[token_setting]
+            if tokens + output_tokens > model_config.get("max_tokens", 0):
+                continue
+            score = self.score(model, tokens, output_tokens, kind)
+            if best_score is None or score < best_score:
+                best, best_score = model, score
+        if best is None:
+            raise NoAvailableModel(f"[gpts-builder] no model can hold this request, tried: {list(tried)}")
+        return best
+
+    def record(self, model, success, latency, kind="chat"):
+        with self._lock:
+            stats = self._model_stats(model)
+            stats.requests += 1
+            stats.window.append(success)
+            if success:
+                previous = stats.latency.get(kind)
+                stats.latency[kind] = latency if previous is None else self.latency_alpha * latency + (1 - self.latency_alpha) * previous
+            else:
+                stats.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {model: stats.report() for model, stats in self._stats.items()}
+
+    def _failed(self, model, error, started, messages, output_tokens, kind, tried, prompt_tokens=None):
+        """记录一次失败并选择降级模型；不该降级或没有可用模型时返回 None。"""
+        # 请求本身的错误（如 400/401、上下文超长）不计入模型的错误率
+        if is_endpoint_failure(error):
+            self.record(model, False, time.monotonic() - started, kind)
+        tried.append(model)
+        if not should_cascade(error):
+            return None
+        min_context = 0
+        if is_context_overflow(error):
+            min_context = (config_manager.get_model_config(model) or {}).get("max_tokens", 0) + 1
+        fallback = self.fallbacks.get(model)
+        if not fallback or fallback in tried:
+            try:
+                fallback = self.select(messages, output_tokens, kind, tried, min_context, prompt_tokens)
+            except NoAvailableModel:
+                return None
+        logger.warning(f"[gpts-builder] model {model} failed: {error!r}, cascading to {fallback}")
+        return fallback
+
+    def route(self, messages, send, output_tokens=0, prompt_tokens=None):
+        """
+        选择模型并发送请求，超时或上下文超长时降级重试。
+
+        Args:
+            send (callable): 接收模型名、发送请求并返回结果的函数。
+            prompt_tokens (int, optional): 提示词的 token 数，见 select。
+        """
+        tried = []
+        model = self.select(messages, output_tokens, "chat", prompt_tokens=prompt_tokens)
+        while True:
+            started = time.monotonic()
+            try:
+                result = send(model)
+            except Exception as e:
+                model = self._failed(model, e, started, messages, output_tokens, "chat", tried, prompt_tokens)
+                if model is None:
+                    raise
+                continue
+            self.record(model, True, time.monotonic() - started)
+            return result
+
+    async def route_async(self, messages, send, output_tokens=0, prompt_tokens=None):
+        """route 的异步版本，send 返回协程。"""
+        tried = []
+        model = self.select(messages, output_tokens, "chat", prompt_tokens=prompt_tokens)
+        while True:
+            started = time.monotonic()
+            try:
+                result = await send(model)
+            except Exception as e:
+                model = self._failed(model, e, started, messages, output_tokens, "chat", tried, prompt_tokens)
+                if model is None:
+                    raise
+                continue
+            self.record(model, True, time.monotonic() - started)
+            return result
+
+    def route_stream(self, messages, open_stream, output_tokens=0, prompt_tokens=None):
+        """
+        流式版本：收到第一个片段之前失败时降级重试，延迟按首个片段的到达时间统计。
+
+        Args:
+            open_stream (callable): 接收模型名、返回片段生成器的函数。
+        """
+        tried = []
+        model = self.select(messages, output_tokens, "chat_stream", prompt_tokens=prompt_tokens)
+        while True:
+            started = time.monotonic()
+            stream = open_stream(model)
+            try:
+                first = next(stream)
+            except StopIteration:
+                self.record(model, True, time.monotonic() - started, "chat_stream")
+                return
+            except Exception as e:
+                model = self._failed(model, e, started, messages, output_tokens, "chat_stream", tried, prompt_tokens)
+                if model is None:
+                    raise
+                continue
+            self.record(model, True, time.monotonic() - started, "chat_stream")
+            yield first
+            yield from stream
+            return
+
+    async def route_stream_async(self, messages, open_stream, output_tokens=0, prompt_tokens=None):
+        """route_stream 的异步版本，open_stream 返回异步生成器。"""
+        tried = []
+        model = self.select(messages, output_tokens, "chat_stream", prompt_tokens=prompt_tokens)
+        while True:
+            started = time.monotonic()
+            stream = open_stream(model)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                self.record(model, True, time.monotonic() - started, "chat_stream")
+                return
+            except Exception as e:
+                model = self._failed(model, e, started, messages, output_tokens, "chat_stream", tried, prompt_tokens)
+                if model is None:
+                    raise
+                continue
+            self.record(model, True, time.monotonic() - started, "chat_stream")
+            yield first
+            async for chunk in stream:
+                yield chunk
+            return
@@ -0,0 +1,198 @@
+"""
+客户端限流：按 (模型, API key) 分别维护每分钟请求数（RPM）和每分钟 token 数（TPM）两个令牌桶，
+在请求发出前等待，避免突发流量打满上游配额后引发 429 重试风暴。
+
+限额来自 config_manager 中模型配置的 rpm / tpm 字段，未配置时不限流。
+"""
+from threading import Lock
+import asyncio
+import hashlib
+import time
+
+from .retry import DeadlineExceeded
+
+
+def model_rate_limits(model):
+    """从 config_manager 读取模型的 (rpm, tpm)，未配置的项为 None。"""
+    # config_manager 依赖 util.logger，在这里导入避免 util 包初始化时的循环导入
+    from ..config.config_manager import config_manager
+    model_config = config_manager.get_model_config(model) or {}
+    return model_config.get("rpm"), model_config.get("tpm")
+
+
+def api_key_from_headers(headers):
+    """从 Authorization 头中取出 API key。"""
+    authorization = (headers or {}).get("Authorization", "")
+    return authorization[len("Bearer "):] if authorization.startswith("Bearer ") else authorization
+
+
+class TokenBucket:
+    """
+    每分钟补满 limit 个令牌的令牌桶，桶容量为 limit。
+
+    reserve 采用预留方式：令牌可以被扣成负数，返回需要等待的秒数，先到的请求先获得令牌。
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.rate = limit / 60.0
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        """扣除 amount 个令牌（超过桶容量时按容量计算），返回需要等待的秒数。"""
+        self._refill(now)
+        self.tokens -= min(amount, self.limit)
+        return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount, now):
+        """归还（amount 为负时补扣）令牌，用于按实际用量修正预估。"""
+        self._refill(now)
+        self.tokens = min(self.limit, self.tokens + amount)
+
+
+class RateLimitState:
+    """一个 (模型, API key) 的令牌桶和排队统计。"""
+
+    def __init__(self, rpm, tpm):
+        self.limits = (rpm, tpm)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.waiting = 0
+        self.max_waiting = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+        self.rejected = 0
+
+    def report(self):
+        return {
+            "rpm": self.limits[0],
+            "tpm": self.limits[1],
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "acquired": self.acquired,
+            "throttled": self.throttled,
+            "waited_seconds": round(self.waited_seconds, 3),
+            "rejected": self.rejected,
+        }
+
+
+class RateLimiter:
+    """
+    按 (模型, API key) 限流，同步调用阻塞等待，异步调用让出事件循环等待。
+
+    Args:
+        limits (callable, optional): 接收模型名、返回 (rpm, tpm) 的函数，默认读取 config_manager 的模型配置。
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits or model_rate_limits
+        self._states = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(model, api_key):
+        # 统计中不暴露 API key 原文
+        return f"{model}:{hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:8]}"
+
+    def _state(self, model, api_key):
+        """返回当前限额对应的状态，配置变化后重新创建令牌桶；未配置限额时返回 None。"""
+        rpm, tpm = self.limits(model)
+        if not rpm and not tpm:
+            return None
+        key = self._key(model, api_key)
+        state = self._states.get(key)
+        if state is None or state.limits != (rpm, tpm):
+            state = self._states[key] = RateLimitState(rpm, tpm)
+        return state
+
+    def _reserve(self, model, api_key, tokens, deadline=None):
+        """
+        预留一次请求和 tokens 个 token，返回 (state, 等待秒数)。
+
+        Raises:
+            DeadlineExceeded: 需要等待的时间超过 deadline 的剩余时间，此时不预留任何额度。
+        """
+        with self._lock:
+            state = self._state(model, api_key)
+            if state is None:
+                return None, 0.0
+            now = time.monotonic()
+            wait = 0.0
+            if state.requests is not None:
+                wait = state.requests.reserve(1, now)
+            if state.tokens is not None and tokens:
+                wait = max(wait, state.tokens.reserve(tokens, now))
+            remaining = deadline.remaining() if deadline is not None else None
+            if remaining is not None and wait > remaining:
+                # 等到额度时请求已经超时，撤销预留，不占用后面请求的额度
+                if state.requests is not None:
+                    state.requests.refund(1, now)
+                if state.tokens is not None and tokens:
+                    state.tokens.refund(min(tokens, state.tokens.limit), now)
+                state.rejected += 1
+                raise DeadlineExceeded(f"[gpts-builder] rate limit wait {wait:.3f}s exceeds the deadline for {model}")
+            state.acquired += 1
+            if wait > 0:
+                state.throttled += 1
+                state.waited_seconds += wait
+                state.waiting += 1
+                state.max_waiting = max(state.max_waiting, state.waiting)
+            return state, wait
+
+    def _release(self, state):
+        with self._lock:
+            state.waiting -= 1
+
+    def acquire(self, model, api_key=None, tokens=0, deadline=None):
+        """
+        阻塞直到可以发送一次预估消耗 tokens 个 token 的请求，返回等待的秒数。
+
+        Raises:
+            DeadlineExceeded: 需要等待的时间超过 deadline（Deadline）的剩余时间，不等待直接抛出。
+        """
+        state, wait = self._reserve(model, api_key, tokens, deadline)
+        if wait > 0:
+            try:
+                time.sleep(wait)
+            finally:
+                self._release(state)
+        return wait
+
+    async def acquire_async(self, model, api_key=None, tokens=0, deadline=None):
+        """acquire 的异步版本。"""
+        state, wait = self._reserve(model, api_key, tokens, deadline)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._release(state)
+        return wait
+
+    def cancel(self, model, api_key, tokens):
+        """请求最终失败，归还 acquire 预留的 tokens 个 token；请求数不归还，失败的请求同样计入上游的 RPM。"""
+        if not tokens:
+            return
+        with self._lock:
+            state = self._state(model, api_key)
+            if state is not None and state.tokens is not None:
+                state.tokens.refund(min(tokens, state.tokens.limit), time.monotonic())
+
+    def record_usage(self, model, api_key, estimated_tokens, used_tokens):
+        """按响应中的实际用量修正 TPM 令牌桶：多扣的归还，少扣的补扣。"""
+        if used_tokens is None:
+            return
+        with self._lock:
+            state = self._state(model, api_key)
+            if state is not None and state.tokens is not None:
+                state.tokens.refund(estimated_tokens - used_tokens, time.monotonic())
+
+    def stats(self):
+        """各 (模型, API key) 的限额、当前排队数、最大排队数、被限流次数和累计等待时间。"""
+        with self._lock:
+            return {key: state.report() for key, state in self._states.items()}
@@ -0,0 +1,147 @@
+"""
+HTTP 重试策略：只重试可能成功的错误（连接错误、超时、408/409/429/5xx），优先使用服务端返回的 Retry-After，
+否则使用 decorrelated jitter 退避；所有重试共享一个端到端的截止时间。
+"""
+from email.utils import parsedate_to_datetime
+import asyncio
+import datetime
+import random
+import time
+
+import httpx
+
+from .logger import logger
+
+# 除 5xx 外值得重试的状态码：请求超时、冲突、限流
+RETRYABLE_STATUS = (408, 409, 429)
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """
+    端到端的截止时间已到，请求没有发出。
+
+    继承 TimeoutException，按超时处理的调用方（如按模型降级）不受影响；但它不说明端点或上游有问题，
+    熔断器和并发限制都不计入，端点池也不会因此换端点。
+    """
+
+
+def is_retryable(error):
+    """连接错误、超时以及 408/409/429/5xx 可以重试，其他 4xx（如 400/401）重试也不会成功。"""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status in RETRYABLE_STATUS
+    return isinstance(error, httpx.TransportError)
+
+
+def retry_after(error):
+    """从响应头 retry-after-ms / Retry-After（秒数或 HTTP 日期）中读取建议的等待秒数。"""
+    response = getattr(error, "response", None) if isinstance(error, httpx.HTTPStatusError) else None
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class Deadline:
+    """
+    端到端的截止时间，由调用方创建后在重试、故障转移之间传递。
+
+    Args:
+        seconds (float, optional): 从现在起的剩余秒数，为 None 时不限制。
+    """
+
+    def __init__(self, seconds=None):
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+
+    @classmethod
+    def coerce(cls, deadline, default=None):
+        """接受 Deadline 或秒数，为 None 时使用 default 秒。"""
+        if isinstance(deadline, Deadline):
+            return deadline
+        return cls(deadline if deadline is not None else default)
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+    def clip(self, timeout):
+        """单次请求的超时：不超过剩余时间。"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+
+class RetryPolicy:
+    """
+    Args:
+        max_attempts (int): 最多尝试次数（包含第一次）。
+        base_delay (float): 退避的最小等待秒数。
+        max_delay (float): 退避的最大等待秒数。
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=20):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, error, attempt, previous_delay, deadline, description=""):
+        """
+        第 attempt 次尝试失败后计算等待秒数；不应该再重试时直接抛出 error。
+
+        Args:
+            previous_delay (float, optional): 上一次的等待秒数，用于 decorrelated jitter。
+        """
+        if attempt >= self.max_attempts or not is_retryable(error):
+            raise error
+        delay = retry_after(error)
+        if delay is None:
+            # decorrelated jitter: sleep = min(cap, random(base, previous * 3))
+            delay = min(self.max_delay, random.uniform(self.base_delay, (previous_delay or self.base_delay) * 3))
+        remaining = deadline.remaining()
+        if remaining is not None and delay >= remaining:
+            raise error
+        logger.warning(f"[gpts-builder] retrying {description} in {delay:.2f}s (attempt {attempt}/{self.max_attempts}): {error!r}")
+        return delay
+
+    def call(self, attempt, deadline, description=""):
+        """同步执行 attempt（无参函数），按策略重试。"""
+        delay = None
+        for number in range(1, self.max_attempts + 1):
+            if deadline.expired():
+                raise DeadlineExceeded(f"[gpts-builder] deadline exceeded before attempt {number}: {description}")
+            try:
+                return attempt()
+            except Exception as e:
+                delay = self.backoff(e, number, delay, deadline, description)
+                time.sleep(delay)
+
+    async def call_async(self, attempt, deadline, description=""):
+        """异步执行 attempt（返回协程的无参函数），按策略重试。"""
+        delay = None
+        for number in range(1, self.max_attempts + 1):
+            if deadline.expired():
+                raise DeadlineExceeded(f"[gpts-builder] deadline exceeded before attempt {number}: {description}")
+            try:
+                return await attempt()
+            except Exception as e:
+                delay = self.backoff(e, number, delay, deadline, description)
+                await asyncio.sleep(delay)
@@ -0,0 +1,328 @@
+"""
+请求合并（singleflight）：同一时刻规范化请求体相同的多个请求只向上游发送一次，所有等待者共享结果。
+
+流式请求由后台任务读取上游，每个等待者从头回放已经收到的片段并继续接收后续片段，
+因此中途加入的等待者也能拿到完整的流；某个等待者提前停止读取不会影响其他等待者。
+
+SingleFlight 用于同步调用（多线程），SingleFlightAsync 用于同一个事件循环内的协程，
+RedisSingleFlightAsync 在此基础上通过 RedisStorageAsync 的锁在多个进程间选出领导者，
+领导者把结果（或流式片段）写入 Redis Stream，其他进程从中读取。
+"""
+from threading import Condition, Event, Lock, Thread
+import asyncio
+import copy
+import time
+
+from . import json_codec
+from .cache.response_cache import payload_cache_key
+from .logger import logger
+
+
+class SingleFlightError(Exception):
+    """其他进程中的领导者请求失败或中途退出。"""
+
+
+class _Flight:
+    """一次进行中的非流式请求。"""
+
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+
+class _StreamFlight:
+    """一次进行中的流式请求：已收到的片段和结束状态，由 Condition 通知等待者。"""
+
+    def __init__(self, condition):
+        self.condition = condition
+        self.chunks = []
+        self.done = False
+        self.error = None
+        # 异步版本中读取上游的任务（保留引用，避免被回收）
+        self.task = None
+
+
+class SingleFlight:
+    """
+    同步请求合并。
+
+    Args:
+        namespace (str): 合并键前缀。
+    """
+
+    def __init__(self, namespace="gpts_builder:singleflight"):
+        self.namespace = namespace
+        self._flights = {}
+        self._lock = Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def key(self, payload, kind="chat"):
+        """请求体的规范化哈希，kind 区分请求类型（如 chat、chat_stream、embedding），流式与非流式不会互相合并。"""
+        return payload_cache_key(payload, f"{self.namespace}:{kind}")
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._flights)}
+
+    def _join(self, key, factory):
+        """返回 (flight, 是否为领导者)。"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = factory()
+                self.leaders += 1
+                return flight, True
+            self.coalesced += 1
+            return flight, False
+
+    def _leave(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def do(self, key, fn):
+        """
+        执行 fn（无参函数），相同 key 的并发调用只执行一次。
+
+        Returns:
+            领导者返回 fn 的结果，其他等待者返回结果的副本（避免调用方互相修改）；fn 抛出的异常会传给所有等待者。
+        """
+        flight, leader = self._join(key, _Flight)
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                self._leave(key, flight)
+                flight.event.set()
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return copy.deepcopy(flight.result)
+
+    def stream(self, key, open_stream):
+        """
+        open_stream（无参函数，返回片段生成器）对相同 key 的并发调用只执行一次，所有调用方收到相同的片段。
+        """
+        flight, leader = self._join(key, lambda: _StreamFlight(Condition()))
+        if leader:
+            Thread(target=self._pump, args=(key, flight, open_stream), daemon=True).start()
+        return self._replay(flight)
+
+    def _pump(self, key, flight, open_stream):
+        try:
+            for chunk in open_stream():
+                with flight.condition:
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            self._leave(key, flight)
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    @staticmethod
+    def _replay(flight):
+        position = 0
+        while True:
+            with flight.condition:
+                flight.condition.wait_for(lambda: position < len(flight.chunks) or flight.done)
+                chunks = flight.chunks[position:]
+                done = flight.done
+            position += len(chunks)
+            yield from chunks
+            if done and position >= len(flight.chunks):
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+
+class SingleFlightAsync(SingleFlight):
+    """
+    异步请求合并，合并范围为同一个事件循环内的协程。领导者的调用方被取消时，上游请求继续完成并交给其他等待者。
+    """
+
+    def _task(self, key, coroutine):
+        """在当前事件循环中创建（或加入）key 对应的任务，返回 (task, 是否为领导者)。"""
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        flight, leader = self._join(flight_key, lambda: loop.create_task(coroutine()))
+
+        if leader:
+            def finish(task):
+                self._leave(flight_key, task)
+                # 所有等待者都被取消时避免 "exception was never retrieved" 警告
+                if not task.cancelled():
+                    task.exception()
+            flight.add_done_callback(finish)
+        return flight, leader
+
+    async def do(self, key, fn):
+        """
+        执行 fn（返回协程的无参函数），相同 key 的并发调用只执行一次。
+        """
+        task, leader = self._task(key, fn)
+        result = await asyncio.shield(task)
+        return result if leader else copy.deepcopy(result)
+
+    async def stream(self, key, open_stream):
+        """
+        open_stream（无参函数，返回片段异步生成器）对相同 key 的并发调用只执行一次，所有调用方收到相同的片段。
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        flight, leader = self._join(flight_key, lambda: _StreamFlight(asyncio.Condition()))
+        if leader:
+            flight.task = loop.create_task(self._pump_async(flight_key, flight, open_stream))
+        position = 0
+        while True:
+            async with flight.condition:
+                await flight.condition.wait_for(lambda: position < len(flight.chunks) or flight.done)
+                chunks = flight.chunks[position:]
+                done = flight.done
+            position += len(chunks)
+            for chunk in chunks:
+                yield chunk
+            if done and position >= len(flight.chunks):
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    async def _pump_async(self, flight_key, flight, open_stream):
+        try:
+            async for chunk in open_stream():
+                async with flight.condition:
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except Exception as e:
+            flight.error = e
+        finally:
+            self._leave(flight_key, flight)
+            async with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+
+class RedisSingleFlightAsync(SingleFlightAsync):
+    """
+    跨进程的异步请求合并：进程内先合并，再通过 Redis 锁选出一个进程发送请求。
+
+    领导者把结果写入 Redis Stream（流式请求逐个写入片段），其他进程阻塞读取；
+    领导者进程退出或锁过期而没有写入结果时，等待者重新竞争锁。
+
+    Args:
+        storage (RedisStorageAsync): Redis 存储。
+        lock_timeout (int): 领导者锁的过期时间（秒），流式请求期间会自动续期。
+        result_ttl (int): 结果 Stream 的保留时间（秒），足够等待者读取即可。
+        poll_interval (float): 等待者单次阻塞读取的最长秒数，超时后检查领导者是否还在。
+    """
+
+    def __init__(self, storage, lock_timeout=120, result_ttl=60, poll_interval=1.0, namespace="gpts_builder:singleflight"):
+        super().__init__(namespace)
+        self.storage = storage
+        self.lock_timeout = lock_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def _redis_keys(key):
+        return f"{key}:lock", f"{key}:result"
+
+    async def _elect(self, lock_key, channel):
+        """竞争领导者锁，成功时清理上一次请求留下的结果并返回锁的令牌，否则返回 None。"""
+        token = await self.storage.acquire_lock(lock_key, self.lock_timeout)
+        if token:
+            await self.storage.delete(channel)
+        return token
+
+    async def _publish(self, channel, fields):
+        await self.storage.append_stream(channel, fields, self.result_ttl)
+
+    async def _follow(self, lock_key, channel):
+        """依次返回领导者写入的消息，领导者没有写完就退出时结束。"""
+        last_id = "0"
+        block = max(1, int(self.poll_interval * 1000))
+        while True:
+            entries = await self.storage.read_stream(channel, last_id, block)
+            if not entries and not await self.storage.exists(lock_key):
+                # 锁已释放：再读一次，避免错过领导者释放锁之前刚写入的结果
+                entries = await self.storage.read_stream(channel, last_id)
+                if not entries:
+                    return
+            for entry_id, fields in entries:
+                last_id = entry_id
+                yield fields
+
+    async def do(self, key, fn):
+        return await super().do(key, lambda: self._remote_do(key, fn))
+
+    async def _remote_do(self, key, fn):
+        lock_key, channel = self._redis_keys(key)
+        while True:
+            token = await self._elect(lock_key, channel)
+            if token:
+                # 先写入结果再释放锁，等待者看到锁释放时结果一定已经可读
+                try:
+                    result = await fn()
+                except Exception as e:
+                    await self._publish(channel, {"error": repr(e)})
+                    raise
+                else:
+                    await self._publish(channel, {"result": json_codec.dumps(result)})
+                    return result
+                finally:
+                    # 只释放自己持有的锁：锁过期后可能已经被其他进程拿到
+                    await self.storage.release_lock(lock_key, token)
+            async for fields in self._follow(lock_key, channel):
+                if "result" in fields:
+                    return json_codec.loads(fields["result"])
+                if "error" in fields:
+                    raise SingleFlightError(f"[gpts-builder] coalesced request failed in leader: {fields['error']}")
+            logger.warning(f"[gpts-builder] singleflight leader of {key} exited without result, re-electing")
+
+    async def stream(self, key, open_stream):
+        async for chunk in super().stream(key, lambda: self._remote_stream(key, open_stream)):
+            yield chunk
+
+    async def _remote_stream(self, key, open_stream):
+        lock_key, channel = self._redis_keys(key)
+        while True:
+            token = await self._elect(lock_key, channel)
+            if token:
+                try:
+                    refreshed, owned = time.monotonic(), True
+                    async for chunk in open_stream():
+                        await self._publish(channel, {"chunk": chunk})
+                        if owned and time.monotonic() - refreshed > self.lock_timeout / 3:
+                            owned = await self.storage.extend_lock(lock_key, token, self.lock_timeout)
+                            refreshed = time.monotonic()
+                            if not owned:
+                                logger.warning(f"[gpts-builder] singleflight lock of {key} expired mid-stream, another leader may be running")
+                        yield chunk
+                    await self._publish(channel, {"done": "1"})
+                except Exception as e:
+                    await self._publish(channel, {"error": repr(e)})
+                    raise
+                finally:
+                    await self.storage.release_lock(lock_key, token)
+                return
+            started = False
+            async for fields in self._follow(lock_key, channel):
+                if "chunk" in fields:
+                    started = True
+                    yield fields["chunk"]
+                elif "error" in fields:
+                    raise SingleFlightError(f"[gpts-builder] coalesced stream failed in leader: {fields['error']}")
+                elif "done" in fields:
+                    return
+            if started:
+                # 已经返回的片段无法撤回，不能换一个领导者从头开始
+                raise SingleFlightError(f"[gpts-builder] singleflight leader of {key} exited mid-stream")
+            logger.warning(f"[gpts-builder] singleflight leader of {key} exited without result, re-electing")
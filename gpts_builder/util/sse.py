@@ -0,0 +1,170 @@
+"""
+Server-Sent Events 增量解析：在字节缓冲区上按行切分事件，不做反复的字符串拼接，
+并把 chat.completion.chunk 解析成带类型的增量对象。
+"""
+from . import json_codec
+
+DONE = "[DONE]"
+
+
+class SSEParser:
+    """
+    增量 SSE 解析器，feed 任意切分的字节或文本片段，返回其中已经完整的事件数据。
+
+    只关心 data 字段（多行 data 以换行连接），注释行和 event/id/retry 字段被忽略。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data = []
+        self.done = False
+
+    def feed(self, chunk):
+        """
+        Returns:
+            list: 本次片段中完整事件的 data 文本，遇到 [DONE] 后不再返回新的事件。
+        """
+        if self.done:
+            return []
+        self._buffer += chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+        events = []
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(self._buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            if self._feed_line(line, events):
+                break
+        # bytearray 从头部删除是均摊 O(1) 的，不会复制剩余数据
+        del self._buffer[:start]
+        return events
+
+    def close(self):
+        """流结束时调用，返回最后一个没有以空行结尾的事件。"""
+        events = []
+        if not self.done and self._buffer:
+            self._feed_line(bytes(self._buffer).rstrip(b"\r"), events)
+        self._buffer.clear()
+        if not self.done:
+            self._dispatch(events)
+        return events
+
+    def _feed_line(self, line, events):
+        """处理一行，返回是否遇到了 [DONE]。"""
+        if not line:
+            return self._dispatch(events)
+        if line.startswith(b":"):
+            return False
+        field, _, value = line.partition(b":")
+        if field == b"data":
+            self._data.append(value[1:] if value.startswith(b" ") else value)
+        return False
+
+    def _dispatch(self, events):
+        if not self._data:
+            return False
+        data = b"\n".join(self._data).decode("utf-8")
+        self._data = []
+        if data.strip() == DONE:
+            self.done = True
+            return True
+        events.append(data)
+        return False
+
+
+def iter_sse_data(chunks):
+    """从字节或文本片段的可迭代对象中逐个返回事件 data，遇到 [DONE] 结束。"""
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    yield from parser.close()
+
+
+async def aiter_sse_data(chunks):
+    """iter_sse_data 的异步版本。"""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for data in parser.feed(chunk):
+            yield data
+        if parser.done:
+            return
+    for data in parser.close():
+        yield data
+
+
+class ToolCallDelta:
+    """工具调用的增量片段，arguments 需要按 index 依次拼接。"""
+
+    __slots__ = ("index", "id", "type", "name", "arguments")
+
+    def __init__(self, index, id=None, type=None, name=None, arguments=None):
+        self.index = index
+        self.id = id
+        self.type = type
+        self.name = name
+        self.arguments = arguments
+
+    def __repr__(self):
+        return f"ToolCallDelta(index={self.index}, id={self.id}, name={self.name}, arguments={self.arguments!r})"
+
+
+class ChatDelta:
+    """
+    chat.completion.chunk 中一个 choice 的增量。
+
+    只携带 usage 的结尾片段（stream_options.include_usage）以 index 为 None 的 ChatDelta 返回。
+    """
+
+    __slots__ = ("index", "role", "content", "tool_calls", "finish_reason", "usage", "id", "model")
+
+    def __init__(self, index=None, role=None, content=None, tool_calls=None, finish_reason=None, usage=None, id=None, model=None):
+        self.index = index
+        self.role = role
+        self.content = content
+        self.tool_calls = tool_calls or []
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.id = id
+        self.model = model
+
+    def __repr__(self):
+        return (f"ChatDelta(index={self.index}, role={self.role}, content={self.content!r}, "
+                f"tool_calls={self.tool_calls}, finish_reason={self.finish_reason}, usage={self.usage})")
+
+
+def parse_chat_chunk(data):
+    """把一个 chat.completion.chunk 事件解析成 ChatDelta 列表，无法解析的事件返回空列表。"""
+    try:
+        chunk = json_codec.loads(data)
+    except ValueError:
+        return []
+    deltas = []
+    for choice in chunk.get("choices") or []:
+        delta = choice.get("delta") or {}
+        tool_calls = [
+            ToolCallDelta(tool_call.get("index", position), tool_call.get("id"), tool_call.get("type"),
+                          (tool_call.get("function") or {}).get("name"), (tool_call.get("function") or {}).get("arguments"))
+            for position, tool_call in enumerate(delta.get("tool_calls") or [])
+        ]
+        deltas.append(ChatDelta(choice.get("index", 0), delta.get("role"), delta.get("content"), tool_calls,
+                                choice.get("finish_reason"), chunk.get("usage"), chunk.get("id"), chunk.get("model")))
+    if not deltas and chunk.get("usage"):
+        deltas.append(ChatDelta(usage=chunk["usage"], id=chunk.get("id"), model=chunk.get("model")))
+    return deltas
+
+
+def iter_chat_deltas(chunks):
+    """把流式响应的字节或文本片段解析为 ChatDelta，遇到 [DONE] 结束。"""
+    for data in iter_sse_data(chunks):
+        yield from parse_chat_chunk(data)
+
+
+async def aiter_chat_deltas(chunks):
+    """iter_chat_deltas 的异步版本。"""
+    async for data in aiter_sse_data(chunks):
+        for delta in parse_chat_chunk(data):
+            yield delta
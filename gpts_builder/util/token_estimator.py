@@ -0,0 +1,170 @@
+"""
+分级 token 计数：先按字符类别快速估算，只有估算值接近模型上下文上限时才用 tiktoken 精确计数。
+
+估算公式为 CJK 字符数 × 系数 + 其他字符数 × 系数（再加上每条消息的固定开销），系数按模型的 token_setting
+分别学习：样本来自精确计数（tiktoken）和上游返回的 usage.prompt_tokens，用带先验的最小二乘在线更新。
+每个模型同时记录最近的低估比例，取高分位数作为误差上界，判断估算值是否离上限足够远。
+"""
+from collections import deque
+from threading import Lock
+import re
+
+from ..config.config_manager import config_manager
+
+# 中日韩文字、假名、谚文以及全角符号，每个字符通常是 1~2 个 token
+CJK_PATTERN = re.compile(r"[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+# 没有样本时每个字符的 token 数（偏大，宁可提前精确计数）
+DEFAULT_CJK_RATIO = 1.5
+DEFAULT_LATIN_RATIO = 0.3
+
+
+def char_features(text):
+    """(CJK 字符数, 其他字符数)。"""
+    if not text:
+        return 0, 0
+    if not isinstance(text, str):
+        text = str(text)
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk, len(text) - cjk
+
+
+def message_overhead(model, message):
+    """一条消息除内容之外的固定 token 数（与 Session.num_tokens_from_messages 的算法一致）。"""
+    model_config = config_manager.get_model_config(model) or {}
+    token_setting = config_manager.token_settings.get(model_config.get("token_setting", model), {})
+    # role（user、assistant 等）编码后是 1 个 token
+    overhead = token_setting.get("tokens_per_message", 3) + 1
+    if "name" in message:
+        overhead += token_setting.get("tokens_per_name", 1)
+    return overhead
+
+
+class Calibration:
+    """一个 token_setting 的估算系数和误差统计。"""
+
+    def __init__(self, prior_weight, window):
+        # 带先验（相当于 prior_weight 个字符的默认系数样本）的最小二乘：tokens ≈ a × cjk + b × latin
+        self.saa = self.sbb = prior_weight
+        self.sab = 0.0
+        self.say = prior_weight * DEFAULT_CJK_RATIO
+        self.sby = prior_weight * DEFAULT_LATIN_RATIO
+        self.cjk_ratio = DEFAULT_CJK_RATIO
+        self.latin_ratio = DEFAULT_LATIN_RATIO
+        self.errors = deque(maxlen=window)
+        self.samples = 0
+
+    def estimate(self, cjk, latin):
+        return cjk * self.cjk_ratio + latin * self.latin_ratio
+
+    def observe(self, cjk, latin, tokens, decay):
+        if cjk + latin == 0:
+            return
+        estimate = self.estimate(cjk, latin)
+        # 只关心低估：高估只会让精确计数提前发生
+        self.errors.append(max(0.0, (tokens - estimate) / max(tokens, 1)))
+        self.samples += 1
+        self.saa = self.saa * decay + cjk * cjk
+        self.sab = self.sab * decay + cjk * latin
+        self.sbb = self.sbb * decay + latin * latin
+        self.say = self.say * decay + cjk * tokens
+        self.sby = self.sby * decay + latin * tokens
+        det = self.saa * self.sbb - self.sab * self.sab
+        if det > 0:
+            self.cjk_ratio = max(0.0, (self.say * self.sbb - self.sby * self.sab) / det)
+            self.latin_ratio = max(0.0, (self.sby * self.saa - self.say * self.sab) / det)
+
+    def error_bound(self, quantile, min_samples, default):
+        if self.samples < min_samples:
+            return default
+        ordered = sorted(self.errors)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+class TokenEstimator:
+    """
+    Args:
+        margin (float): 安全余量，估算值（加上误差上界）超过上限的 1 - margin 时改为精确计数。
+        quantile (float): 误差上界取最近低估比例的该分位数。
+        default_error (float): 样本不足时使用的误差上界。
+        min_samples (int): 使用学到的误差上界所需的最少样本数。
+        prior_weight (float): 默认系数的先验权重（字符数），越大系数变化越慢。
+        decay (float): 旧样本的衰减系数，让系数跟随最近的文本分布。
+        window (int): 统计误差的最近样本数。
+    """
+
+    def __init__(self, margin=0.05, quantile=0.99, default_error=0.3, min_samples=20, prior_weight=200.0, decay=0.999, window=500):
+        self.margin = margin
+        self.quantile = quantile
+        self.default_error = default_error
+        self.min_samples = min_samples
+        self.prior_weight = prior_weight
+        self.decay = decay
+        self.window = window
+        self._calibrations = {}
+        self._lock = Lock()
+
+    @staticmethod
+    def _key(model):
+        model_config = config_manager.get_model_config(model) or {}
+        return model_config.get("token_setting", model)
+
+    def _calibration(self, model):
+        key = self._key(model)
+        calibration = self._calibrations.get(key)
+        if calibration is None:
+            calibration = self._calibrations[key] = Calibration(self.prior_weight, self.window)
+        return calibration
+
+    def estimate_text(self, model, text):
+        with self._lock:
+            return self._calibration(model).estimate(*char_features(text))
+
+    def estimate_message(self, model, message):
+        """一条消息的估算 token 数（向上取整）。"""
+        return message_overhead(model, message) + int(self.estimate_text(model, message.get("content")) + 0.999)
+
+    def error_bound(self, model):
+        with self._lock:
+            return self._calibration(model).error_bound(self.quantile, self.min_samples, self.default_error)
+
+    def is_safe(self, model, estimated_tokens, limit):
+        """估算值加上误差上界仍在上限的安全余量之内时返回 True，此时不需要精确计数。"""
+        if not limit:
+            return True
+        return estimated_tokens * (1 + self.error_bound(model)) <= limit * (1 - self.margin)
+
+    def observe_message(self, model, message, exact_tokens):
+        """用一条消息的精确 token 数校准。"""
+        with self._lock:
+            cjk, latin = char_features(message.get("content"))
+            self._calibration(model).observe(cjk, latin, exact_tokens - message_overhead(model, message), self.decay)
+
+    def observe_usage(self, model, messages, usage):
+        """用上游返回的 usage.prompt_tokens 校准（整个请求的消息作为一个样本）。"""
+        prompt_tokens = (usage or {}).get("prompt_tokens")
+        if not prompt_tokens or not messages:
+            return
+        cjk = latin = overhead = 0
+        for message in messages:
+            message_cjk, message_latin = char_features(message.get("content"))
+            cjk += message_cjk
+            latin += message_latin
+            overhead += message_overhead(model, message)
+        with self._lock:
+            # 回复前缀占 3 个 token；带工具定义的请求 prompt_tokens 偏大，调用方不应传入
+            self._calibration(model).observe(cjk, latin, prompt_tokens - overhead - 3, self.decay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                key: {
+                    "cjk_ratio": round(calibration.cjk_ratio, 4),
+                    "latin_ratio": round(calibration.latin_ratio, 4),
+                    "samples": calibration.samples,
+                    "error_bound": round(calibration.error_bound(self.quantile, self.min_samples, self.default_error), 4),
+                }
+                for key, calibration in self._calibrations.items()
+            }
+
+
+token_estimator = TokenEstimator()
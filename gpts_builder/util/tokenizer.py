@@ -0,0 +1,152 @@
+"""
+tiktoken 编码器注册表：每个模型的编码器只解析一次，进程内共享。
+
+tiktoken 第一次使用某个编码时会从网络下载 BPE 文件。配置了本地目录（config_manager.tiktoken_cache_dir 或
+TIKTOKEN_CACHE_DIR 环境变量）时，目录中按编码命名的文件（如 cl100k_base.tiktoken）直接用 load_tiktoken_bpe 读取并构造编码器，
+不修改环境变量，也不改动目录里的文件，离线环境不需要访问网络。加载失败的模型在 retry_interval 秒内直接按字符数估算，
+之后再重新尝试，不会每次请求都重新下载，也不会因为一次网络故障永久放弃。
+服务启动时调用 warm_up() 预先加载编码器，第一个请求不再承担加载时间。
+"""
+from threading import Lock
+import os
+import time
+
+import tiktoken
+from tiktoken.load import load_tiktoken_bpe
+from tiktoken.model import encoding_name_for_model
+
+from ..config.config_manager import config_manager
+from .logger import logger
+
+DEFAULT_ENCODING = "cl100k_base"
+# 加载失败后多久重新尝试（秒）
+DEFAULT_RETRY_INTERVAL = 60.0
+
+ENDOFTEXT = "<|endoftext|>"
+FIM_PREFIX = "<|fim_prefix|>"
+FIM_MIDDLE = "<|fim_middle|>"
+FIM_SUFFIX = "<|fim_suffix|>"
+ENDOFPROMPT = "<|endofprompt|>"
+
+R50K_PAT_STR = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}++| ?\p{N}++| ?[^\s\p{L}\p{N}]++|\s++$|\s+(?!\S)|\s"""
+CL100K_PAT_STR = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+|\s++$|\s*[\r\n]|\s+(?!\S)|\s"""
+O200K_PAT_STR = "|".join([
+    r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+    r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+    r"""\p{N}{1,3}""",
+    r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+    r"""\s*[\r\n]+""",
+    r"""\s+(?!\S)""",
+    r"""\s+""",
+])
+
+# 可以从本地 BPE 文件构造的编码：{编码名: (pat_str, special_tokens)}，与 tiktoken_ext.openai_public 中的定义一致
+BPE_ENCODINGS = {
+    "r50k_base": (R50K_PAT_STR, {ENDOFTEXT: 50256}),
+    "p50k_base": (R50K_PAT_STR, {ENDOFTEXT: 50256}),
+    "cl100k_base": (CL100K_PAT_STR, {ENDOFTEXT: 100257, FIM_PREFIX: 100258, FIM_MIDDLE: 100259, FIM_SUFFIX: 100260, ENDOFPROMPT: 100276}),
+    "o200k_base": (O200K_PAT_STR, {ENDOFTEXT: 199999, ENDOFPROMPT: 200018}),
+}
+
+
+class TokenizerUnavailable(Exception):
+    """编码器无法加载（离线且本地没有 BPE 文件）。"""
+
+
+class EncoderRegistry:
+    """
+    Args:
+        cache_dir (str, optional): BPE 文件目录，默认使用 config_manager.tiktoken_cache_dir，其次是 TIKTOKEN_CACHE_DIR 环境变量。
+        retry_interval (float): 加载失败后多久重新尝试（秒）。
+    """
+
+    def __init__(self, cache_dir=None, retry_interval=DEFAULT_RETRY_INTERVAL):
+        self.cache_dir = cache_dir
+        self.retry_interval = retry_interval
+        self._encoders = {}
+        self._encodings = {}
+        self._retry_at = {}
+        self._lock = Lock()
+
+    def configure(self, cache_dir):
+        """更换 BPE 文件目录，之前加载失败的模型会立即重新尝试。"""
+        with self._lock:
+            self.cache_dir = cache_dir
+            self._encodings.clear()
+            self._retry_at.clear()
+
+    def _cache_dir(self):
+        return self.cache_dir or getattr(config_manager, "tiktoken_cache_dir", None) or os.environ.get("TIKTOKEN_CACHE_DIR")
+
+    def _encoding(self, name):
+        """编码名对应的编码器：本地目录有同名 BPE 文件时直接读取，否则交给 tiktoken（可能需要下载）。"""
+        encoding = self._encodings.get(name)
+        if encoding is not None:
+            return encoding
+        cache_dir = self._cache_dir()
+        path = os.path.join(cache_dir, f"{name}.tiktoken") if cache_dir else None
+        if name in BPE_ENCODINGS and path and os.path.exists(path):
+            pat_str, special_tokens = BPE_ENCODINGS[name]
+            encoding = tiktoken.Encoding(name, pat_str=pat_str, mergeable_ranks=load_tiktoken_bpe(path), special_tokens=special_tokens)
+        else:
+            encoding = tiktoken.get_encoding(name)
+        self._encodings[name] = encoding
+        return encoding
+
+    def _load(self, model):
+        try:
+            name = encoding_name_for_model(model)
+        except KeyError:
+            logger.debug(f"Warning: model {model} not found. Using {DEFAULT_ENCODING} encoding.")
+            name = DEFAULT_ENCODING
+        return self._encoding(name)
+
+    def get(self, model):
+        """
+        模型（或 token_setting）对应的编码器。
+
+        Raises:
+            TokenizerUnavailable: 编码器加载失败（retry_interval 秒内不会重复尝试，configure 或 warm_up 会立即重试）。
+        """
+        encoder = self._encoders.get(model)
+        if encoder is not None:
+            return encoder
+        with self._lock:
+            encoder = self._encoders.get(model)
+            if encoder is not None:
+                return encoder
+            retry_at = self._retry_at.get(model)
+            if retry_at is not None and time.monotonic() < retry_at:
+                raise TokenizerUnavailable(f"[gpts-builder] tiktoken encoding for {model} is unavailable")
+            try:
+                encoder = self._encoders[model] = self._load(model)
+            except Exception as e:
+                self._retry_at[model] = time.monotonic() + self.retry_interval
+                logger.warning(f"[gpts-builder] failed to load tiktoken encoding for {model}, falling back to character counts for {self.retry_interval}s: {e}")
+                raise TokenizerUnavailable(f"[gpts-builder] tiktoken encoding for {model} is unavailable") from e
+            self._retry_at.pop(model, None)
+            return encoder
+
+    def warm_up(self, models=None):
+        """
+        预先加载编码器，默认加载所有已配置模型的 token_setting 和 embedding 模型。
+
+        Returns:
+            dict: {模型: 编码名}，加载失败的模型为 None。
+        """
+        if models is None:
+            models = [config.get("token_setting", config["model"]) for config in config_manager.model_settings]
+            models.append(config_manager.embedding_model)
+        with self._lock:
+            for model in models:
+                self._retry_at.pop(model, None)
+        loaded = {}
+        for model in dict.fromkeys(models):
+            try:
+                loaded[model] = self.get(model).name
+            except TokenizerUnavailable:
+                loaded[model] = None
+        return loaded
+
+
+encoder_registry = EncoderRegistry()
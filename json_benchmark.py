@@ -0,0 +1,44 @@
+import json
+import timeit
+
+from gpts_builder.util import json_codec
+
+"""
+JSON 编解码的微基准：对比标准库 json 和 json_codec 当前使用的实现（安装 orjson 或 msgspec 后生效）
+"""
+
+# 一次 20 轮对话的 chat/completions 请求体
+messages = [{"role": "system", "content": "你是一个AI助理"}]
+for turn in range(20):
+    messages.append({"role": "user", "content": f"第 {turn} 个问题：请解释一下 HTTP 连接池为什么能降低延迟？" * 4})
+    messages.append({"role": "assistant", "content": f"第 {turn} 个回答：复用 TCP/TLS 连接可以省去握手的往返时间。" * 8})
+payload = {"model": "gpt-3.5-turbo", "messages": messages, "temperature": 0.7, "top_p": 0.9, "max_tokens": 1024, "stream": False}
+# 一个典型的响应
+response = {
+    "id": "chatcmpl-123", "object": "chat.completion", "created": 1700000000, "model": "gpt-3.5-turbo",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "复用连接可以省去握手。" * 50}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 1800, "completion_tokens": 300, "total_tokens": 2100},
+}
+# 一个流式片段
+chunk = '{"id":"chatcmpl-123","object":"chat.completion.chunk","created":1700000000,"model":"gpt-3.5-turbo","choices":[{"index":0,"delta":{"content":"你好"},"finish_reason":null}]}'
+
+
+def bench(name, stdlib, codec, number):
+    stdlib_time = timeit.timeit(stdlib, number=number) / number * 1e6
+    codec_time = timeit.timeit(codec, number=number) / number * 1e6
+    print(f"{name:<28} json {stdlib_time:8.2f}us   {json_codec.backend} {codec_time:8.2f}us   x{stdlib_time / codec_time:.1f}")
+
+
+if __name__ == "__main__":
+    encoded_response = json.dumps(response, ensure_ascii=False).encode("utf-8")
+    session = {"session_id": "s1", "system_prompt": "你是一个AI助理", "messages": messages}
+    # 旧的会话存储：to_json 之后存储后端再 json.dumps 一次，读取时 json.loads 两次
+    stored_session = json.dumps(json.dumps(session))
+    encoded_session = json_codec.dumps_bytes(session)
+    print(f"backend: {json_codec.backend}")
+    # httpx 的 json= 参数等价于 json.dumps(...).encode()
+    bench("encode request body", lambda: json.dumps(payload).encode("utf-8"), lambda: json_codec.dumps_bytes(payload), 2000)
+    bench("decode response", lambda: json.loads(encoded_response), lambda: json_codec.loads(encoded_response), 5000)
+    bench("decode stream chunk", lambda: json.loads(chunk), lambda: json_codec.loads(chunk), 50000)
+    bench("session save (per turn)", lambda: json.dumps(json.dumps(session)), lambda: json_codec.dumps_bytes(session), 2000)
+    bench("session load (per turn)", lambda: json.loads(json.loads(stored_session)), lambda: json_codec.loads(encoded_session), 2000)
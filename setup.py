@@ -15,18 +15,23 @@ setup(
         'aioredis>=1.3,<3',
         'anyio==4.3.0',
         'async-timeout==4.0.3',
-        'backoff==2.2.1',
         'certifi==2024.2.2',
         'charset-normalizer==3.3.2',
         'httpx==0.27.0',
+        'numpy>=1.21',
         'redis==5.0.4',
         'regex==2024.4.28',
-        'requests==2.31.0',
         'sniffio==1.3.1',
         'tiktoken==0.6.0',
         'typing_extensions==4.11.0',
         'urllib3==2.2.1',
     ],
+    extras_require={
+        'http2': ['h2>=3,<5'],
+        'orjson': ['orjson>=3.9'],
+        'msgspec': ['msgspec>=0.18'],
+        'test': ['pytest>=7', 'fakeredis[lua]>=2.20'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
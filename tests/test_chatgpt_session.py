@@ -0,0 +1,62 @@
+import unittest
+from unittest import mock
+
+from gpts_builder.session_manager import chatgpt_session
+from gpts_builder.session_manager.chatgpt_session import ChatGPTSession
+
+
+class CharacterSession(ChatGPTSession):
+    """按字符数计数，不依赖 tiktoken 和估算系数。"""
+
+    def count_message_tokens(self, message):
+        return len(message.get("content") or "")
+
+    def estimate_message_tokens(self, message):
+        return None
+
+
+def make_session(*replies):
+    session = CharacterSession("s1", "sssss", "gpt-test")
+    for i, content in enumerate(replies):
+        (session.add_query if i % 2 == 0 else session.add_reply)(content)
+    return session
+
+
+class DiscardExceedingTest(unittest.TestCase):
+
+    def discard(self, session, max_tokens):
+        with mock.patch.object(chatgpt_session.config_manager, "get_model_config", return_value={"max_tokens": max_tokens}):
+            return session.discard_exceeding()
+
+    def test_within_limit_keeps_everything(self):
+        session = make_session("a" * 10, "b" * 10)
+        self.assertEqual(self.discard(session, 100), 28)
+        self.assertEqual(len(session.messages), 3)
+
+    def test_removes_shortest_prefix_that_fits(self):
+        session = make_session("a" * 10, "b" * 10, "c" * 10, "d" * 4)
+        # 5 + 34 + 3 = 42，超出 12：前缀和 [10, 20, 30] 中第一个不小于 12 的是 20，删除两条
+        self.assertEqual(self.discard(session, 30), 22)
+        self.assertEqual([m["content"] for m in session.messages], ["sssss", "c" * 10, "d" * 4])
+        self.assertEqual(session.message_tokens, [5, 10, 4])
+        self.assertEqual(session.calc_tokens(), 22)
+
+    def test_excess_equal_to_prefix_sum(self):
+        session = make_session("a" * 10, "b" * 10, "c" * 10, "d" * 4)
+        # 超出 10，恰好等于第一条的 token 数，只删除一条
+        self.assertEqual(self.discard(session, 32), 32)
+        self.assertEqual([m["content"] for m in session.messages], ["sssss", "b" * 10, "c" * 10, "d" * 4])
+
+    def test_keeps_last_message(self):
+        session = make_session("a" * 10, "b" * 10, "c" * 40)
+        self.assertEqual(self.discard(session, 30), 48)
+        self.assertEqual([m["content"] for m in session.messages], ["sssss", "c" * 40])
+
+    def test_drops_oversized_last_reply(self):
+        session = make_session("a" * 10, "b" * 40)
+        self.assertEqual(self.discard(session, 30), 8)
+        self.assertEqual([m["content"] for m in session.messages], ["sssss"])
+
+
+if __name__ == "__main__":
+    unittest.main()
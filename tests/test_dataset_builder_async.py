@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+
+from gpts_builder.builder_async.rag.dataset_builder_async import DatasetBuilderAsync
+
+
+def make_builder(generate_vectors, write_rows):
+    builder = DatasetBuilderAsync.__new__(DatasetBuilderAsync)
+    builder.generate_vectors = generate_vectors
+    builder._write_rows = write_rows
+    return builder
+
+
+class CreateDatasBulkTest(unittest.TestCase):
+
+    def run_bulk(self, builder, records, **kwargs):
+        # 流水线卡住时 wait_for 超时，测试失败而不是挂起
+        return asyncio.run(asyncio.wait_for(builder.create_datas_bulk(1, records, **kwargs), 5))
+
+    def test_imports_all_records(self):
+        written = []
+
+        async def generate_vectors(texts):
+            return [[1.0] for _ in texts]
+
+        async def write_rows(id, rows):
+            written.extend(rows)
+
+        records = [(f"a{i}", [f"q{i}"]) for i in range(10)]
+        report = self.run_bulk(make_builder(generate_vectors, write_rows), records, batch_size=3, concurrency=2, queue_size=1)
+        self.assertEqual(len(written), 10)
+        self.assertEqual(report["failed"], 0)
+
+    def test_malformed_batch_is_counted_as_failed(self):
+        async def generate_vectors(texts):
+            # 向量条数少于文本条数，pair_vectors 会抛出 IndexError
+            return [[1.0]]
+
+        async def write_rows(id, rows):
+            pass
+
+        records = [(f"a{i}", [f"q{i}"]) for i in range(20)]
+        report = self.run_bulk(make_builder(generate_vectors, write_rows), records, batch_size=2, concurrency=2,
+                               write_concurrency=1, queue_size=1)
+        self.assertEqual(report["failed"], 20)
+
+    def test_failing_stage_cancels_pipeline(self):
+        started = []
+
+        async def generate_vectors(texts):
+            started.append(texts)
+            await asyncio.sleep(10)
+
+        async def write_rows(id, rows):
+            pass
+
+        def records():
+            yield ("a", ["q"])
+            yield ("b", ["q"])
+            raise ValueError("broken source")
+
+        with self.assertRaises(ValueError):
+            self.run_bulk(make_builder(generate_vectors, write_rows), records(), batch_size=1, concurrency=2)
+        self.assertTrue(started)
+
+
+if __name__ == "__main__":
+    unittest.main()
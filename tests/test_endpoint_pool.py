@@ -0,0 +1,168 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from gpts_builder.util.endpoint_pool import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, EndpointPool, NoAvailableEndpoint
+
+
+def status_error(status):
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def make_breaker(self, **kwargs):
+        return CircuitBreaker(**dict(dict(window=4, min_requests=4, failure_rate=0.5, open_seconds=10, half_open_calls=1), **kwargs))
+
+    def open_breaker(self, breaker, now=0.0):
+        for success in (True, True, False, False):
+            breaker.record(success, 0.1, now)
+
+    def test_opens_when_failure_rate_reaches_threshold(self):
+        breaker = self.make_breaker()
+        breaker.record(False, 0.1, 0.0)
+        breaker.record(False, 0.1, 0.0)
+        # 请求数不足 min_requests 时不熔断
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record(True, 0.1, 0.0)
+        breaker.record(True, 0.1, 0.0)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.available(5.0))
+
+    def test_opens_on_slow_calls(self):
+        breaker = self.make_breaker(slow_call_seconds=1.0, slow_call_rate=0.5)
+        for latency in (0.1, 0.1, 2.0, 2.0):
+            breaker.record(True, latency, 0.0)
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_half_open_probe_success_closes(self):
+        breaker = self.make_breaker()
+        self.open_breaker(breaker)
+        self.assertTrue(breaker.available(10.0))
+        self.assertEqual(breaker.state, HALF_OPEN)
+        probe = breaker.begin()
+        # 探测名额用完后不再放行
+        self.assertFalse(breaker.available(10.0))
+        breaker.record(True, 0.1, 10.0)
+        breaker.release(probe)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertTrue(breaker.available(10.0))
+
+    def test_half_open_probe_failure_reopens(self):
+        breaker = self.make_breaker()
+        self.open_breaker(breaker)
+        breaker.available(10.0)
+        probe = breaker.begin()
+        breaker.record(False, 0.1, 10.0)
+        breaker.release(probe)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.available(15.0))
+        self.assertTrue(breaker.available(20.0))
+
+    def test_release_without_record_frees_probe(self):
+        breaker = self.make_breaker()
+        self.open_breaker(breaker)
+        breaker.available(10.0)
+        probe = breaker.begin()
+        self.assertFalse(breaker.available(10.0))
+        # 请求被取消：没有 record，只归还名额，熔断状态不变
+        breaker.release(probe)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        self.assertTrue(breaker.available(10.0))
+
+    def test_stale_probe_does_not_free_new_round(self):
+        breaker = self.make_breaker()
+        self.open_breaker(breaker)
+        breaker.available(10.0)
+        stale = breaker.begin()
+        other = breaker.begin()
+        breaker.record(False, 0.1, 10.0)
+        breaker.release(other)
+        breaker.available(20.0)
+        breaker.begin()
+        # 上一轮半开的名额不会归还到这一轮
+        breaker.release(stale)
+        self.assertFalse(breaker.available(20.0))
+
+
+class EndpointPoolTest(unittest.TestCase):
+
+    def test_single_endpoint_is_never_short_circuited(self):
+        pool = EndpointPool([{"base_url": "http://a", "api_key": "a"}], min_requests=2, failure_rate=0.5, open_seconds=60)
+        calls = []
+
+        def send(url, headers):
+            calls.append(url)
+            raise status_error(503)
+
+        for _ in range(5):
+            with self.assertRaises(httpx.HTTPStatusError):
+                pool.call("/v1/chat/completions", send)
+        self.assertEqual(len(calls), 5)
+
+    def test_fails_over_and_opens_breaker(self):
+        pool = EndpointPool([{"base_url": "http://bad", "api_key": "a", "weight": 100}, {"base_url": "http://good", "api_key": "b"}],
+                            min_requests=1, failure_rate=0.5, open_seconds=60)
+
+        def send(url, headers):
+            if url.startswith("http://bad"):
+                raise status_error(503)
+            return url
+
+        results = {pool.call("/v1/chat/completions", send) for _ in range(5)}
+        self.assertEqual(results, {"http://good/v1/chat/completions"})
+        self.assertEqual([endpoint["state"] for endpoint in pool.stats()], [OPEN, CLOSED])
+
+    def test_request_errors_do_not_fail_over(self):
+        pool = EndpointPool([{"base_url": "http://a", "api_key": "a"}, {"base_url": "http://b", "api_key": "b"}])
+        calls = []
+
+        def send(url, headers):
+            calls.append(url)
+            raise status_error(400)
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            pool.call("/v1/chat/completions", send)
+        self.assertEqual(len(calls), 1)
+
+    def test_cancelled_probe_is_released(self):
+        pool = EndpointPool([{"base_url": "http://a", "api_key": "a"}, {"base_url": "http://b", "api_key": "b"}],
+                            min_requests=1, failure_rate=0.5, open_seconds=0)
+        for endpoint in pool.endpoints:
+            endpoint.breaker.record(False, 0.1, 0.0)
+            self.assertEqual(endpoint.breaker.state, OPEN)
+
+        async def hang(url, headers):
+            await asyncio.sleep(10)
+
+        async def cancel_probes():
+            tasks = [asyncio.ensure_future(pool.call_async("/v1/chat/completions", hang)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run(cancel_probes())
+        for endpoint in pool.endpoints:
+            self.assertEqual(endpoint.breaker.state, HALF_OPEN)
+            self.assertEqual(endpoint.breaker.probing, 0)
+
+        async def ok(url, headers):
+            return url
+
+        asyncio.run(pool.call_async("/v1/chat/completions", ok))
+
+    def test_all_open_raises(self):
+        pool = EndpointPool([{"base_url": "http://a", "api_key": "a"}, {"base_url": "http://b", "api_key": "b"}],
+                            min_requests=1, failure_rate=0.5, open_seconds=60)
+        for endpoint in pool.endpoints:
+            endpoint.breaker.record(False, 0.1, time.monotonic())
+        with self.assertRaises(NoAvailableEndpoint):
+            pool.call("/v1/chat/completions", lambda url, headers: url)
+
+
+if __name__ == "__main__":
+    unittest.main()
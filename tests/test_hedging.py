@@ -0,0 +1,127 @@
+import asyncio
+import unittest
+
+from gpts_builder.util.endpoint_pool import HALF_OPEN, EndpointPool
+from gpts_builder.util.hedging import HedgePolicy, hedged_call, hedged_stream
+
+
+def make_policy():
+    # 没有延迟样本时 10ms 后对冲，预算不限制
+    return HedgePolicy(initial_delay=0.01, min_delay=0.0, budget=1.0)
+
+
+class HedgedCallTest(unittest.TestCase):
+
+    def test_fast_primary_is_not_hedged(self):
+        policy = make_policy()
+        hedges = []
+
+        async def primary():
+            return "primary"
+
+        async def hedge():
+            hedges.append(1)
+            return "hedge"
+
+        self.assertEqual(asyncio.run(hedged_call(policy, "chat", primary, hedge)), "primary")
+        self.assertEqual(hedges, [])
+        self.assertEqual(policy.stats()["hedges"], 0)
+
+    def test_slow_primary_loses_and_is_cancelled(self):
+        policy = make_policy()
+        cancelled = []
+
+        async def primary():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(1)
+                raise
+
+        async def hedge():
+            return "hedge"
+
+        self.assertEqual(asyncio.run(hedged_call(policy, "chat", primary, hedge)), "hedge")
+        self.assertEqual(cancelled, [1])
+        self.assertEqual(policy.stats()["hedge_wins"], 1)
+
+    def test_primary_error_wins_over_hedge_error(self):
+        async def primary():
+            await asyncio.sleep(0.02)
+            raise ValueError("primary")
+
+        async def hedge():
+            raise KeyError("hedge")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(hedged_call(make_policy(), "chat", primary, hedge))
+
+    def test_outer_cancellation_during_cleanup_propagates(self):
+        async def primary():
+            try:
+                await asyncio.sleep(10)
+            finally:
+                # 落败请求的清理需要一点时间，调用方在这期间取消
+                await asyncio.sleep(0.1)
+
+        async def hedge():
+            return "hedge"
+
+        async def main():
+            task = asyncio.ensure_future(hedged_call(make_policy(), "chat", primary, hedge))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertTrue(task.cancelled())
+
+        asyncio.run(main())
+
+    def test_cancelled_loser_releases_probe(self):
+        pool = EndpointPool([{"base_url": "http://a", "api_key": "a"}, {"base_url": "http://b", "api_key": "b"}],
+                            min_requests=1, failure_rate=0.5, open_seconds=0)
+        for endpoint in pool.endpoints:
+            endpoint.breaker.record(False, 0.1, 0.0)
+        urls = []
+
+        async def send(url, headers):
+            urls.append(url)
+            if len(urls) == 1:
+                await asyncio.sleep(10)
+            return url
+
+        async def main():
+            return await hedged_call(make_policy(), "chat",
+                                     lambda: pool.call_async("/v1/chat/completions", send),
+                                     lambda: pool.call_async("/v1/chat/completions", send))
+
+        winner = asyncio.run(main())
+        loser = next(endpoint for endpoint in pool.endpoints if not winner.startswith(endpoint.base_url))
+        self.assertEqual(loser.breaker.state, HALF_OPEN)
+        self.assertEqual(loser.breaker.probing, 0)
+        self.assertTrue(loser.breaker.available(0.0))
+
+
+class HedgedStreamTest(unittest.TestCase):
+
+    def test_first_chunk_wins_and_loser_is_closed(self):
+        closed = []
+
+        async def stream(name, delay):
+            try:
+                await asyncio.sleep(delay)
+                for i in range(3):
+                    yield f"{name}{i}"
+            finally:
+                closed.append(name)
+
+        async def main():
+            return [chunk async for chunk in hedged_stream(make_policy(), "chat_stream",
+                                                           lambda: stream("p", 10), lambda: stream("h", 0))]
+
+        self.assertEqual(asyncio.run(main()), ["h0", "h1", "h2"])
+        self.assertEqual(sorted(closed), ["h", "p"])
+
+
+if __name__ == "__main__":
+    unittest.main()
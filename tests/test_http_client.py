@@ -0,0 +1,94 @@
+import asyncio
+import gc
+import threading
+import unittest
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from gpts_builder.util.http_client import HTTPClient
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AsyncClientRegistryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), JsonHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/v1"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.client = HTTPClient()
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_clients_close_with_their_loops(self):
+        clients = []
+
+        async def request():
+            self.assertEqual(await self.client.post_async(self.url, json={"a": 1}), {"ok": True})
+            clients.append(self.client.async_client)
+
+        for _ in range(3):
+            asyncio.run(request())
+        gc.collect()
+        self.assertEqual(len(self.client._async_clients), 0)
+        self.assertEqual(len(set(map(id, clients))), 3)
+        self.assertTrue(all(client.is_closed for client in clients))
+
+    def test_one_client_per_loop(self):
+        async def request():
+            await self.client.post_async(self.url, json={})
+            first = self.client.async_client
+            await self.client.post_async(self.url, json={})
+            self.assertIs(self.client.async_client, first)
+            await self.client.aclose()
+            self.assertTrue(first.is_closed)
+            self.assertEqual(len(self.client._async_clients), 0)
+
+        asyncio.run(request())
+
+    def test_loop_closed_without_shutdown_is_pruned(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.client.post_async(self.url, json={}))
+        finally:
+            loop.close()
+        self.assertEqual(len(self.client._async_clients), 1)
+
+        async def request():
+            await self.client.post_async(self.url, json={})
+            # 已经关闭的事件循环被移除，只剩当前事件循环的连接池
+            self.assertEqual(list(self.client._async_clients.keys()), [asyncio.get_running_loop()])
+
+        asyncio.run(request())
+        self.assertEqual(len(self.client._async_clients), 0)
+        # 没有经过 shutdown_asyncgens 的事件循环上的连接已经无法关闭，回收时只会产生 ResourceWarning
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", ResourceWarning)
+            gc.collect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import httpx
+
+from gpts_builder.util import model_router
+from gpts_builder.util.http_client import HTTPClient
+from gpts_builder.util.model_router import ModelRouter, is_context_overflow
+
+OVERFLOW_BODY = b'{"error": {"message": "too long", "type": "invalid_request_error", "code": "context_length_exceeded"}}'
+
+CONFIGS = {
+    "small": {"model": "small", "max_tokens": 1000, "input_cost": 0.001},
+    "large": {"model": "large", "max_tokens": 8000, "input_cost": 0.01},
+}
+
+
+class OverflowHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(400)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(OVERFLOW_BODY)))
+        self.end_headers()
+        self.wfile.write(OVERFLOW_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamErrorBodyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), OverflowHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/v1/chat/completions"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.client = HTTPClient()
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_post_and_post_stream_see_the_error_code(self):
+        with self.assertRaises(httpx.HTTPStatusError) as post_error:
+            self.client.post(self.url, json={})
+        with self.assertRaises(httpx.HTTPStatusError) as stream_error:
+            list(self.client.post_stream(self.url, json={}))
+        self.assertTrue(is_context_overflow(post_error.exception))
+        self.assertTrue(is_context_overflow(stream_error.exception))
+
+    def test_post_stream_async_sees_the_error_code(self):
+        async def run():
+            async for _ in self.client.post_stream_async(self.url, json={}):
+                pass
+
+        with self.assertRaises(httpx.HTTPStatusError) as error:
+            asyncio.run(run())
+        self.assertTrue(is_context_overflow(error.exception))
+
+
+def overflow_error():
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return httpx.HTTPStatusError("400", request=request, response=httpx.Response(400, content=OVERFLOW_BODY, request=request))
+
+
+class RouterPromptTokensTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(model_router.config_manager, "get_model_config", side_effect=CONFIGS.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = ModelRouter(models=["small", "large"])
+
+    def test_given_prompt_tokens_are_not_recounted(self):
+        with mock.patch.object(ModelRouter, "prompt_tokens", side_effect=AssertionError("must not re-encode")):
+            self.assertEqual(self.router.select([], prompt_tokens=500), "small")
+            self.assertEqual(self.router.select([], prompt_tokens=2000), "large")
+
+    def test_counts_when_prompt_tokens_missing(self):
+        with mock.patch.object(ModelRouter, "prompt_tokens", return_value=2000) as prompt_tokens:
+            self.assertEqual(self.router.select([{"role": "user", "content": "hi"}]), "large")
+        self.assertTrue(prompt_tokens.called)
+
+    def test_stream_cascades_on_context_overflow(self):
+        opened = []
+
+        def open_stream(model):
+            opened.append(model)
+            if model == "small":
+                raise overflow_error()
+            yield "chunk"
+
+        with mock.patch.object(ModelRouter, "prompt_tokens", side_effect=AssertionError("must not re-encode")):
+            self.assertEqual(list(self.router.route_stream([], open_stream, prompt_tokens=500)), ["chunk"])
+        self.assertEqual(opened, ["small", "large"])
+
+    def test_async_stream_cascades_on_context_overflow(self):
+        opened = []
+
+        async def open_stream(model):
+            opened.append(model)
+            if model == "small":
+                raise overflow_error()
+            yield "chunk"
+
+        async def run():
+            return [chunk async for chunk in self.router.route_stream_async([], open_stream, prompt_tokens=500)]
+
+        self.assertEqual(asyncio.run(run()), ["chunk"])
+        self.assertEqual(opened, ["small", "large"])
+
+
+if __name__ == "__main__":
+    unittest.main()
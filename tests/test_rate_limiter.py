@@ -0,0 +1,117 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import httpx
+
+from gpts_builder.util.http_client import HTTPClient
+from gpts_builder.util.rate_limiter import RateLimiter
+from gpts_builder.util.retry import Deadline, DeadlineExceeded
+
+
+def only_state(limiter):
+    states = list(limiter._states.values())
+    assert len(states) == 1
+    return states[0]
+
+
+class RateLimiterDeadlineTest(unittest.TestCase):
+
+    def test_wait_beyond_deadline_raises_without_reserving(self):
+        limiter = RateLimiter(limits=lambda model: (None, 600))
+        self.assertEqual(limiter.acquire("gpt", "key", 600), 0.0)
+        state = only_state(limiter)
+        before = state.tokens.tokens
+        # 令牌每秒补充 10 个，预留 100 个需要等待约 10 秒
+        with self.assertRaises(DeadlineExceeded):
+            limiter.acquire("gpt", "key", 100, Deadline(1))
+        self.assertLess(state.tokens.tokens - before, 1)
+        self.assertGreaterEqual(state.tokens.tokens, before)
+        self.assertEqual(limiter.stats()[limiter._key("gpt", "key")]["rejected"], 1)
+        self.assertEqual(state.waiting, 0)
+
+    def test_async_wait_beyond_deadline(self):
+        limiter = RateLimiter(limits=lambda model: (60, None))
+        for _ in range(60):
+            limiter.acquire("gpt", "key")
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(limiter.acquire_async("gpt", "key", 0, Deadline(0.5)))
+
+    def test_cancel_refunds_tokens_only(self):
+        limiter = RateLimiter(limits=lambda model: (100, 1000))
+        limiter.acquire("gpt", "key", 400)
+        limiter.cancel("gpt", "key", 400)
+        state = only_state(limiter)
+        self.assertAlmostEqual(state.tokens.tokens, 1000, delta=1)
+        self.assertAlmostEqual(state.requests.tokens, 99, delta=0.1)
+
+
+class HTTPClientRateLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter(limits=lambda model: (100, 1000))
+        self.client = HTTPClient(rate_limiter=self.limiter)
+        self.requests = 0
+
+    def tearDown(self):
+        self.client.close()
+
+    def use(self, status, body=b'{"usage": {"total_tokens": 100}}'):
+        def handler(request):
+            self.requests += 1
+            return httpx.Response(status, content=body, headers={"Retry-After": "0"})
+
+        self.client._client = httpx.Client(transport=httpx.MockTransport(handler))
+        return handler
+
+    def assert_buckets(self, tokens, requests):
+        state = only_state(self.limiter)
+        self.assertAlmostEqual(state.tokens.tokens, tokens, delta=1)
+        self.assertAlmostEqual(state.requests.tokens, requests, delta=0.1)
+
+    def test_failed_retries_reserve_once_and_refund(self):
+        self.use(500)
+        with self.assertRaises(httpx.HTTPStatusError):
+            self.client.post("http://upstream/v1", json={}, max_retries=3, model="gpt", estimated_tokens=400)
+        self.assertEqual(self.requests, 3)
+        self.assert_buckets(1000, 99)
+
+    def test_success_records_usage(self):
+        self.use(200)
+        self.client.post("http://upstream/v1", json={}, model="gpt", estimated_tokens=400)
+        self.assert_buckets(900, 99)
+
+    def test_failed_stream_refunds(self):
+        self.use(503, b"")
+        with self.assertRaises(httpx.HTTPStatusError):
+            list(self.client.post_stream("http://upstream/v1", json={}, max_retries=2, model="gpt", estimated_tokens=400))
+        self.assertEqual(self.requests, 2)
+        self.assert_buckets(1000, 99)
+
+    def test_started_stream_keeps_reservation(self):
+        self.use(200, b"data: a\n\n")
+        self.assertEqual(list(self.client.post_stream("http://upstream/v1", json={}, model="gpt", estimated_tokens=400)), ["data: a\n\n"])
+        self.assert_buckets(600, 99)
+
+    def test_async_failed_retries_reserve_once_and_refund(self):
+        def handler(request):
+            self.requests += 1
+            return httpx.Response(429, headers={"Retry-After": "0"})
+
+        async def run():
+            async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+                with mock.patch.object(HTTPClient, "async_client", new_callable=mock.PropertyMock, return_value=client):
+                    with self.assertRaises(httpx.HTTPStatusError):
+                        await self.client.post_async("http://upstream/v1", json={}, max_retries=3, model="gpt", estimated_tokens=400)
+                    with self.assertRaises(httpx.HTTPStatusError):
+                        async for _ in self.client.post_stream_async("http://upstream/v1", json={}, max_retries=2, model="gpt",
+                                                                     estimated_tokens=400):
+                            pass
+
+        asyncio.run(run())
+        self.assertEqual(self.requests, 5)
+        self.assert_buckets(1000, 98)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401  fakeredis 执行 Lua 脚本需要 lupa
+except ImportError as e:
+    raise unittest.SkipTest(f"fakeredis with lua support is not installed: {e}")
+
+from gpts_builder.session_manager.storage.redis_session_storage import RedisSessionStorage, SAVE_SESSION_SCRIPT
+
+
+def make_storage():
+    # 绕过单例和 from_url，直接换成 fakeredis
+    storage = RedisSessionStorage.__new__(RedisSessionStorage)
+    storage._redis = fakeredis.FakeRedis(decode_responses=True)
+    storage._save = storage._redis.register_script(SAVE_SESSION_SCRIPT)
+    return storage
+
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+
+class SaveSessionScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = make_storage()
+        self.assertEqual(self.storage.save_messages("s1", [message("user", "hi")], [5], 0, system_prompt="sys", system_tokens=8,
+                                                    replace=True), (0, 13))
+
+    def test_append_bumps_version(self):
+        session, version = self.storage.get_versioned("s1")
+        self.assertEqual(version, 1)
+        self.assertEqual(session["messages"], [message("system", "sys"), message("user", "hi")])
+        self.assertEqual(self.storage.save_messages("s1", [message("assistant", "hello")], [4], version), (0, 17))
+        session, version = self.storage.get_versioned("s1")
+        self.assertEqual(version, 2)
+        self.assertEqual(session["message_tokens"], [5, 5, 4])
+
+    def test_stale_version_is_rejected(self):
+        self.assertIsNotNone(self.storage.save_messages("s1", [message("assistant", "first")], [4], 1))
+        # 另一个请求基于同一个版本号写入：冲突，不写入任何消息
+        self.assertIsNone(self.storage.save_messages("s1", [message("assistant", "second")], [4], 1))
+        session, version = self.storage.get_versioned("s1")
+        self.assertEqual(version, 2)
+        self.assertEqual([m["content"] for m in session["messages"]], ["sys", "hi", "first"])
+
+    def test_unchecked_version_always_writes(self):
+        self.assertIsNotNone(self.storage.save_messages("s1", [message("assistant", "x")], [4], -1))
+        self.assertEqual(self.storage.get_versioned("s1")[1], 2)
+
+    def test_trims_oldest_but_keeps_last_message(self):
+        self.storage.save_messages("s1", [message("assistant", "a"), message("user", "b")], [10, 20], 1)
+        # 8 + 5 + 10 + 20 = 43 > 30：弹出前两条，只剩最后一条
+        self.assertEqual(self.storage.save_messages("s1", [], [], 2, max_tokens=30), (2, 28))
+        session, _ = self.storage.get_versioned("s1")
+        self.assertEqual([m["content"] for m in session["messages"]], ["sys", "b"])
+        # 最后一条消息本身超出上限也保留
+        self.assertEqual(self.storage.save_messages("s1", [], [], 3, max_tokens=10), (0, 28))
+
+    def test_check_system_only_session(self):
+        self.storage.set("s2", {"session_id": "s2", "system_prompt": "sys", "messages": [message("system", "sys")]})
+        # 只有系统消息时没有消息和 token 数列表，会话仍然存在
+        self.assertTrue(self.storage.check("s2"))
+        self.assertGreater(self.storage._redis.ttl("{s2}:meta"), 7200)
+        self.assertFalse(self.storage.check("missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
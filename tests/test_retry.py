@@ -0,0 +1,128 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from gpts_builder.util.concurrency_limiter import is_overload
+from gpts_builder.util.endpoint_pool import CLOSED, EndpointPool, is_endpoint_failure
+from gpts_builder.util.retry import Deadline, DeadlineExceeded, RetryPolicy, is_retryable, retry_after
+
+
+def status_error(status, headers=None):
+    request = httpx.Request("POST", "http://upstream/v1/chat/completions")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, headers=headers, request=request))
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_clip_and_expiry(self):
+        deadline = Deadline(0.5)
+        self.assertLessEqual(deadline.clip(60), 0.5)
+        self.assertFalse(deadline.expired())
+        self.assertEqual(Deadline(None).clip(60), 60)
+        self.assertTrue(Deadline(0).expired())
+
+    def test_deadline_exceeded_is_not_an_endpoint_failure(self):
+        error = DeadlineExceeded("deadline exceeded")
+        # 按超时处理的调用方仍然能捕获
+        self.assertIsInstance(error, httpx.TimeoutException)
+        self.assertFalse(is_retryable(error))
+        self.assertFalse(is_endpoint_failure(error))
+        self.assertFalse(is_overload(error))
+        self.assertTrue(is_endpoint_failure(httpx.ReadTimeout("slow")))
+        self.assertTrue(is_overload(httpx.ReadTimeout("slow")))
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_retries_retryable_errors(self):
+        attempts = []
+
+        def attempt():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise status_error(503, {"retry-after-ms": "1"})
+            return "ok"
+
+        self.assertEqual(RetryPolicy(max_attempts=3).call(attempt, Deadline(5)), "ok")
+        self.assertEqual(len(attempts), 3)
+
+    def test_does_not_retry_client_errors(self):
+        attempts = []
+
+        def attempt():
+            attempts.append(1)
+            raise status_error(400)
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            RetryPolicy(max_attempts=3).call(attempt, Deadline(5))
+        self.assertEqual(len(attempts), 1)
+
+    def test_expired_deadline_raises_before_sending(self):
+        attempts = []
+        with self.assertRaises(DeadlineExceeded):
+            RetryPolicy().call(lambda: attempts.append(1), Deadline(0))
+        with self.assertRaises(DeadlineExceeded):
+            asyncio.run(RetryPolicy().call_async(lambda: asyncio.sleep(0, attempts.append(1)), Deadline(0)))
+        self.assertEqual(attempts, [])
+
+    def test_retry_after_beyond_deadline_gives_up(self):
+        attempts = []
+
+        def attempt():
+            attempts.append(1)
+            raise status_error(429, {"retry-after": "30"})
+
+        started = time.monotonic()
+        with self.assertRaises(httpx.HTTPStatusError):
+            RetryPolicy(max_attempts=3).call(attempt, Deadline(1))
+        self.assertEqual(len(attempts), 1)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_retry_after_header(self):
+        self.assertEqual(retry_after(status_error(429, {"retry-after-ms": "1500"})), 1.5)
+        self.assertEqual(retry_after(status_error(429, {"retry-after": "2"})), 2.0)
+        self.assertIsNone(retry_after(status_error(429)))
+
+
+class EndpointPoolDeadlineTest(unittest.TestCase):
+
+    def make_pool(self):
+        return EndpointPool([{"base_url": "http://a", "api_key": "a"}, {"base_url": "http://b", "api_key": "b"}],
+                            min_requests=1, failure_rate=0.5, open_seconds=60)
+
+    def test_expired_deadline_does_not_open_breakers(self):
+        pool = self.make_pool()
+        deadline = Deadline(0)
+        sent = []
+
+        def send(url, headers):
+            return RetryPolicy().call(lambda: sent.append(url), deadline, url)
+
+        for _ in range(3):
+            with self.assertRaises(DeadlineExceeded):
+                pool.call("/v1/chat/completions", send, deadline=deadline)
+        self.assertEqual(sent, [])
+        self.assertEqual([endpoint["state"] for endpoint in pool.stats()], [CLOSED, CLOSED])
+
+    def test_no_failover_after_deadline(self):
+        pool = self.make_pool()
+        deadline = Deadline(0.05)
+        sent = []
+
+        async def send(url, headers):
+            sent.append(url)
+            # 慢请求耗尽了截止时间
+            await asyncio.sleep(0.1)
+            raise httpx.ReadTimeout("slow upstream")
+
+        with self.assertRaises(httpx.ReadTimeout):
+            asyncio.run(pool.call_async("/v1/chat/completions", send, deadline=deadline))
+        # 只有慢的端点被记为失败，另一个端点没有被尝试
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sorted(endpoint["state"] for endpoint in pool.stats()), [CLOSED, "open"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import unittest
+from unittest import mock
+
+from gpts_builder.session_manager.chatgpt_session import ChatGPTSession
+from gpts_builder.session_manager.session_manager import SessionConflict, SessionManager
+from gpts_builder.session_manager.storage.global_storage import global_storage
+
+
+class CharacterSession(ChatGPTSession):
+    """按字符数计数，不依赖 tiktoken 和估算系数。"""
+
+    def count_message_tokens(self, message):
+        return len(message.get("content") or "")
+
+    def estimate_message_tokens(self, message):
+        return None
+
+
+class LegacyWriteConflictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = SessionManager(CharacterSession, global_storage, "gpt-test")
+        self.addCleanup(global_storage.delete, "sid")
+
+    def test_reply_between_load_and_save_is_not_lost(self):
+        session, version = self.manager.load_session("sid")
+        session.add_query("q1")
+        self.manager.session_reply("sid", "REPLY-1")
+        with self.assertRaises(SessionConflict):
+            self.manager.save_session(session, version)
+        # 冲突后重新读取即可看到 session_reply 写入的回复
+        session, version = self.manager.load_session("sid")
+        session.add_query("q2")
+        self.manager.save_session(session, version)
+        contents = [message["content"] for message in global_storage.get("sid")["messages"]]
+        self.assertEqual(contents[-2:], ["REPLY-1", "q2"])
+
+
+class RedisStorageSetVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import fakeredis
+            import lupa  # noqa: F401  fakeredis 执行 Lua 脚本需要 lupa
+        except ImportError as e:
+            self.skipTest(f"fakeredis with lua support is not installed: {e}")
+        from gpts_builder.session_manager.storage.redis_storage import SET_IF_VERSION_SCRIPT, RedisStorage
+        # 绕过单例和 from_url，直接换成 fakeredis
+        self.storage = RedisStorage.__new__(RedisStorage)
+        self.storage._redis = fakeredis.FakeRedis()
+        self.storage._set_if_version = self.storage._redis.register_script(SET_IF_VERSION_SCRIPT)
+
+    def test_set_invalidates_loaded_version(self):
+        _, version = self.storage.get_versioned("sid")
+        self.assertTrue(self.storage.set("sid", {"messages": []}))
+        self.assertFalse(self.storage.set_versioned("sid", {"messages": ["stale"]}, version))
+        data, version = self.storage.get_versioned("sid")
+        self.assertEqual(data, {"messages": []})
+        self.assertTrue(self.storage.set_versioned("sid", {"messages": ["fresh"]}, version))
+        self.assertGreater(self.storage._redis.ttl("sid"), 0)
+
+
+class AppendOnlyReplyTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import fakeredis
+            import lupa  # noqa: F401  fakeredis 执行 Lua 脚本需要 lupa
+        except ImportError as e:
+            self.skipTest(f"fakeredis with lua support is not installed: {e}")
+        from gpts_builder.session_manager.storage.redis_session_storage import SAVE_SESSION_SCRIPT, RedisSessionStorage
+        self.storage = RedisSessionStorage.__new__(RedisSessionStorage)
+        self.storage._redis = fakeredis.FakeRedis(decode_responses=True)
+        self.storage._save = self.storage._redis.register_script(SAVE_SESSION_SCRIPT)
+        self.manager = SessionManager(CharacterSession, self.storage, "gpt-test")
+
+    def test_query_and_reply_append_one_message(self):
+        self.manager.session_query("sid", "q1")
+        with mock.patch.object(self.storage, "save_messages", wraps=self.storage.save_messages) as save_messages:
+            self.manager.session_reply("sid", "r1")
+            self.manager.session_query("sid", "q2")
+        self.assertEqual([call.args[1] for call in save_messages.call_args_list],
+                         [[{"role": "assistant", "content": "r1"}], [{"role": "user", "content": "q2"}]])
+        # 没有整体重写
+        self.assertEqual([call.args[7] for call in save_messages.call_args_list], [False, False])
+        session, version = self.storage.get_versioned("sid")
+        self.assertEqual([message["content"] for message in session["messages"][1:]], ["q1", "r1", "q2"])
+        self.assertEqual(version, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,332 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from gpts_builder.util.singleflight import RedisSingleFlightAsync, SingleFlight, SingleFlightAsync, SingleFlightError
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_leader_and_waiters_share_one_call(self):
+        flight = SingleFlight()
+        release, calls, results = threading.Event(), [], []
+
+        def fn():
+            calls.append(1)
+            release.wait(5)
+            return {"answer": [1, 2]}
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do("k", fn))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()["coalesced"] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"answer": [1, 2]}] * 5)
+        # 等待者拿到的是副本
+        self.assertEqual(len({id(result) for result in results}), 5)
+        self.assertEqual(flight.stats(), {"leaders": 1, "coalesced": 4, "in_flight": 0})
+
+    def test_error_reaches_every_waiter(self):
+        flight = SingleFlight()
+        release, errors = threading.Event(), []
+
+        def fn():
+            release.wait(5)
+            raise ValueError("upstream failed")
+
+        def call():
+            try:
+                flight.do("k", fn)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()["coalesced"] < 2:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flight.stats()["in_flight"], 0)
+
+    def test_late_stream_waiter_replays_from_start(self):
+        flight = SingleFlight()
+        first_sent, resume = threading.Event(), threading.Event()
+
+        def open_stream():
+            yield "a"
+            first_sent.set()
+            resume.wait(5)
+            yield "b"
+            yield "c"
+
+        early = flight.stream("k", open_stream)
+        self.assertEqual(next(early), "a")
+        first_sent.wait(5)
+        late = flight.stream("k", open_stream)
+        resume.set()
+        self.assertEqual(list(early), ["b", "c"])
+        self.assertEqual(list(late), ["a", "b", "c"])
+        self.assertEqual(flight.stats()["leaders"], 1)
+
+
+class SingleFlightAsyncTest(unittest.TestCase):
+
+    def test_leader_and_waiters(self):
+        async def run():
+            flight, calls = SingleFlightAsync(), []
+
+            async def fn():
+                calls.append(1)
+                await asyncio.sleep(0.05)
+                return {"answer": 1}
+
+            results = await asyncio.gather(*(flight.do("k", fn) for _ in range(5)))
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(results, [{"answer": 1}] * 5)
+            self.assertEqual(flight.stats()["in_flight"], 0)
+
+        asyncio.run(run())
+
+    def test_error_path(self):
+        async def run():
+            flight = SingleFlightAsync()
+
+            async def fn():
+                await asyncio.sleep(0.01)
+                raise ValueError("upstream failed")
+
+            results = await asyncio.gather(*(flight.do("k", fn) for _ in range(3)), return_exceptions=True)
+            self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+        asyncio.run(run())
+
+    def test_cancelled_leader_does_not_cancel_waiters(self):
+        async def run():
+            flight, calls = SingleFlightAsync(), []
+
+            async def fn():
+                calls.append(1)
+                await asyncio.sleep(0.05)
+                return "done"
+
+            leader = asyncio.ensure_future(flight.do("k", fn))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(flight.do("k", fn))
+            await asyncio.sleep(0)
+            leader.cancel()
+            self.assertEqual(await waiter, "done")
+            self.assertEqual(len(calls), 1)
+
+        asyncio.run(run())
+
+    def test_late_stream_waiter_and_early_exit(self):
+        async def run():
+            flight, resume = SingleFlightAsync(), asyncio.Event()
+
+            async def open_stream():
+                yield "a"
+                await resume.wait()
+                yield "b"
+                yield "c"
+
+            early = flight.stream("k", open_stream)
+            self.assertEqual(await early.__anext__(), "a")
+            # 异步生成器第一次迭代时才加入，中途加入的等待者从头回放
+            late = flight.stream("k", open_stream)
+            self.assertEqual(await late.__anext__(), "a")
+            quitter = flight.stream("k", open_stream)
+            self.assertEqual(await quitter.__anext__(), "a")
+            # 某个等待者提前停止读取不影响其他等待者
+            await quitter.aclose()
+            resume.set()
+            self.assertEqual([chunk async for chunk in early], ["b", "c"])
+            self.assertEqual([chunk async for chunk in late], ["b", "c"])
+            self.assertEqual(flight.stats(), {"leaders": 1, "coalesced": 2, "in_flight": 0})
+
+        asyncio.run(run())
+
+    def test_stream_error_reaches_waiters(self):
+        async def run():
+            flight = SingleFlightAsync()
+
+            async def open_stream():
+                yield "a"
+                raise ValueError("broken stream")
+
+            async def consume():
+                return [chunk async for chunk in flight.stream("k", open_stream)]
+
+            results = await asyncio.gather(consume(), consume(), return_exceptions=True)
+            self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+        asyncio.run(run())
+
+
+class MemoryStorage:
+    """RedisStorageAsync 中 singleflight 用到的接口的内存实现，锁按令牌释放和续期。"""
+
+    def __init__(self):
+        self.locks = {}
+        self.streams = {}
+        self.sequence = 0
+
+    async def acquire_lock(self, lock_name, lock_timeout=60):
+        if lock_name in self.locks:
+            return None
+        self.sequence += 1
+        token = f"token-{self.sequence}"
+        self.locks[lock_name] = token
+        return token
+
+    async def release_lock(self, lock_name, token=None):
+        if token is not None and self.locks.get(lock_name) != token:
+            return False
+        return self.locks.pop(lock_name, None) is not None
+
+    async def extend_lock(self, lock_name, token, lock_timeout=60):
+        return self.locks.get(lock_name) == token
+
+    async def exists(self, key):
+        return key in self.locks or key in self.streams
+
+    async def delete(self, key):
+        self.streams.pop(key, None)
+
+    async def append_stream(self, key, fields, expired=None):
+        self.sequence += 1
+        self.streams.setdefault(key, []).append((f"{self.sequence:010d}", dict(fields)))
+
+    async def read_stream(self, key, last_id="0", block=None):
+        expires = time.monotonic() + (block or 0) / 1000
+        while True:
+            entries = [(entry_id, fields) for entry_id, fields in self.streams.get(key, []) if entry_id > last_id]
+            if entries or block is None or time.monotonic() >= expires:
+                return entries
+            await asyncio.sleep(0.005)
+
+
+class RedisSingleFlightAsyncTest(unittest.TestCase):
+
+    def test_processes_share_leader_result(self):
+        async def run():
+            storage, release, calls = MemoryStorage(), asyncio.Event(), []
+            # 两个实例模拟两个进程
+            first, second = (RedisSingleFlightAsync(storage, poll_interval=0.01) for _ in range(2))
+
+            async def fn():
+                calls.append(1)
+                await release.wait()
+                return {"content": "你好", "tokens": [1, 2]}
+
+            leader = asyncio.ensure_future(first.do("k", fn))
+            await asyncio.sleep(0.02)
+            follower = asyncio.ensure_future(second.do("k", fn))
+            await asyncio.sleep(0.02)
+            release.set()
+            self.assertEqual(await leader, {"content": "你好", "tokens": [1, 2]})
+            self.assertEqual(await follower, {"content": "你好", "tokens": [1, 2]})
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(storage.locks, {})
+
+        asyncio.run(run())
+
+    def test_leader_error_reaches_other_process(self):
+        async def run():
+            storage, release = MemoryStorage(), asyncio.Event()
+            first, second = (RedisSingleFlightAsync(storage, poll_interval=0.01) for _ in range(2))
+
+            async def fn():
+                await release.wait()
+                raise ValueError("upstream failed")
+
+            leader = asyncio.ensure_future(first.do("k", fn))
+            await asyncio.sleep(0.02)
+            follower = asyncio.ensure_future(second.do("k", fn))
+            await asyncio.sleep(0.02)
+            release.set()
+            with self.assertRaises(ValueError):
+                await leader
+            with self.assertRaises(SingleFlightError):
+                await follower
+
+        asyncio.run(run())
+
+    def test_expired_leader_does_not_release_new_leaders_lock(self):
+        async def run():
+            storage = MemoryStorage()
+            flight = RedisSingleFlightAsync(storage, poll_interval=0.01)
+            lock_key = flight._redis_keys("k")[0]
+
+            async def fn():
+                # 领导者的锁过期后被其他进程拿到
+                storage.locks[lock_key] = "other-leader"
+                return "done"
+
+            self.assertEqual(await flight.do("k", fn), "done")
+            self.assertEqual(storage.locks, {lock_key: "other-leader"})
+
+        asyncio.run(run())
+
+    def test_stream_follower_in_other_process(self):
+        async def run():
+            storage, resume = MemoryStorage(), asyncio.Event()
+            first, second = (RedisSingleFlightAsync(storage, poll_interval=0.01) for _ in range(2))
+
+            async def open_stream():
+                yield "a"
+                await resume.wait()
+                yield "b"
+
+            leader = first.stream("k", open_stream)
+            self.assertEqual(await leader.__anext__(), "a")
+
+            async def follow():
+                return [chunk async for chunk in second.stream("k", open_stream)]
+
+            follower = asyncio.ensure_future(follow())
+            await asyncio.sleep(0.02)
+            resume.set()
+            self.assertEqual([chunk async for chunk in leader], ["b"])
+            self.assertEqual(await follower, ["a", "b"])
+            self.assertEqual(storage.locks, {})
+
+        asyncio.run(run())
+
+
+class RedisLockScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import fakeredis
+            import lupa  # noqa: F401  fakeredis 执行 Lua 脚本需要 lupa
+        except ImportError as e:
+            self.skipTest(f"fakeredis with lua support is not installed: {e}")
+        from gpts_builder.session_manager.storage.redis_storage import EXTEND_LOCK_SCRIPT, RELEASE_LOCK_SCRIPT, RedisStorage
+        # 绕过单例和 from_url，直接换成 fakeredis
+        self.storage = RedisStorage.__new__(RedisStorage)
+        self.storage._redis = fakeredis.FakeRedis()
+        self.storage._release_lock = self.storage._redis.register_script(RELEASE_LOCK_SCRIPT)
+        self.storage._extend_lock = self.storage._redis.register_script(EXTEND_LOCK_SCRIPT)
+
+    def test_release_and_extend_only_with_own_token(self):
+        token = self.storage.acquire_lock("lock", 60)
+        self.assertTrue(token)
+        self.assertIsNone(self.storage.acquire_lock("lock", 60))
+        self.assertFalse(self.storage.release_lock("lock", "stale-token"))
+        self.assertFalse(self.storage.extend_lock("lock", "stale-token", 120))
+        self.assertTrue(self.storage.extend_lock("lock", token, 120))
+        self.assertGreater(self.storage._redis.ttl("lock"), 60)
+        self.assertTrue(self.storage.release_lock("lock", token))
+        self.assertFalse(self.storage._redis.exists("lock"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import asyncio
+import unittest
+
+from gpts_builder.util.sse import SSEParser, aiter_sse_data, iter_chat_deltas, iter_sse_data
+
+STREAM = (
+    b": keep-alive\r\n\r\n"
+    b'data: {"id":"c1","choices":[{"index":0,"delta":{"role":"assistant","content":"\xe4\xbd\xa0\xe5\xa5\xbd"}}]}\r\n\r\n'
+    b"event: message\r\n"
+    b"data: line one\r\n"
+    b"data: line two\r\n\r\n"
+    b'data: {"id":"c1","choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}\r\n\r\n'
+    b"data: [DONE]\r\n\r\n"
+    b"data: after done\r\n\r\n"
+)
+
+EXPECTED = [
+    '{"id":"c1","choices":[{"index":0,"delta":{"role":"assistant","content":"你好"}}]}',
+    "line one\nline two",
+    '{"id":"c1","choices":[{"index":0,"delta":{},"finish_reason":"stop"}]}',
+]
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class SSEParserTest(unittest.TestCase):
+
+    def test_events_split_across_chunks(self):
+        # 每种切分方式都会把行、\r\n 和多字节字符切到不同片段里
+        for size in (1, 2, 3, 7, 64, len(STREAM)):
+            with self.subTest(size=size):
+                self.assertEqual(list(iter_sse_data(split(STREAM, size))), EXPECTED)
+
+    def test_feed_returns_only_complete_events(self):
+        parser = SSEParser()
+        self.assertEqual(parser.feed(b"data: par"), [])
+        self.assertEqual(parser.feed("tial\n"), [])
+        self.assertEqual(parser.feed("\ndata: next"), ["partial"])
+        self.assertEqual(parser.close(), ["next"])
+
+    def test_stops_at_done(self):
+        parser = SSEParser()
+        self.assertEqual(parser.feed(b"data: a\n\ndata: [DONE]\n\ndata: b\n\n"), ["a"])
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.feed(b"data: c\n\n"), [])
+        self.assertEqual(parser.close(), [])
+
+    def test_async_split_chunks(self):
+        async def chunks():
+            for chunk in split(STREAM, 5):
+                yield chunk
+
+        async def collect():
+            return [data async for data in aiter_sse_data(chunks())]
+
+        self.assertEqual(asyncio.run(collect()), EXPECTED)
+
+    def test_chat_deltas(self):
+        deltas = list(iter_chat_deltas(split(STREAM, 4)))
+        self.assertEqual([delta.content for delta in deltas], ["你好", None])
+        self.assertEqual(deltas[0].role, "assistant")
+        self.assertEqual(deltas[1].finish_reason, "stop")
+
+
+if __name__ == "__main__":
+    unittest.main()
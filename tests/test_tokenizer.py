@@ -0,0 +1,65 @@
+import base64
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from gpts_builder.util import tokenizer
+from gpts_builder.util.tokenizer import EncoderRegistry, TokenizerUnavailable
+
+
+def write_bpe_file(cache_dir, name):
+    """只包含 256 个单字节 token 的 BPE 文件，格式与 tiktoken 的 .tiktoken 文件相同。"""
+    with open(os.path.join(cache_dir, f"{name}.tiktoken"), "w") as f:
+        for rank in range(256):
+            f.write(f"{base64.b64encode(bytes([rank])).decode()} {rank}\n")
+
+
+class LocalBpeFileTest(unittest.TestCase):
+
+    def test_builds_encoding_from_local_file_without_side_effects(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            write_bpe_file(cache_dir, "cl100k_base")
+            before = sorted(os.listdir(cache_dir))
+            environ = os.environ.get("TIKTOKEN_CACHE_DIR")
+            registry = EncoderRegistry(cache_dir=cache_dir)
+            with mock.patch.object(tokenizer.tiktoken, "get_encoding", side_effect=AssertionError("must not download")):
+                encoder = registry.get("gpt-4")
+                # 未知模型回退到默认编码，共用同一个编码器
+                self.assertIs(registry.get("some-unknown-model"), encoder)
+            self.assertEqual(encoder.name, "cl100k_base")
+            self.assertEqual(encoder.encode("hi"), [104, 105])
+            self.assertEqual(os.environ.get("TIKTOKEN_CACHE_DIR"), environ)
+            self.assertEqual(sorted(os.listdir(cache_dir)), before)
+
+
+class RetryAfterFailureTest(unittest.TestCase):
+
+    def test_failed_model_is_retried_after_interval(self):
+        registry = EncoderRegistry(retry_interval=60)
+        now = [1000.0]
+        encoding = object()
+        with mock.patch.object(tokenizer.time, "monotonic", side_effect=lambda: now[0]), \
+                mock.patch.object(registry, "_load", side_effect=[OSError("offline"), encoding]) as load:
+            with self.assertRaises(TokenizerUnavailable):
+                registry.get("gpt-4")
+            # 间隔内不再尝试加载
+            now[0] += 30
+            with self.assertRaises(TokenizerUnavailable):
+                registry.get("gpt-4")
+            self.assertEqual(load.call_count, 1)
+            now[0] += 31
+            self.assertIs(registry.get("gpt-4"), encoding)
+            self.assertEqual(load.call_count, 2)
+
+    def test_warm_up_retries_immediately(self):
+        registry = EncoderRegistry(retry_interval=60)
+        encoding = mock.Mock()
+        encoding.name = "cl100k_base"
+        with mock.patch.object(registry, "_load", side_effect=[OSError("offline"), encoding]):
+            self.assertEqual(registry.warm_up(["gpt-4"]), {"gpt-4": None})
+            self.assertEqual(registry.warm_up(["gpt-4"]), {"gpt-4": "cl100k_base"})
+
+
+if __name__ == "__main__":
+    unittest.main()
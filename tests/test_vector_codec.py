@@ -0,0 +1,34 @@
+import unittest
+
+import numpy as np
+
+from gpts_builder.util.db.vector_codec import (VectorParam, decode_vector_binary, decode_vector_text, encode_vector_binary,
+                                               encode_vector_text)
+
+try:
+    from psycopg2.extensions import adapt
+    import gpts_builder.util.db.postgres_vector  # noqa: F401  注册 VectorParam 的适配器
+except ImportError:
+    adapt = None
+
+
+class VectorCodecTest(unittest.TestCase):
+
+    def test_text_round_trip(self):
+        vector = np.array([0.5, -1.25, 3.0], dtype=np.float32)
+        np.testing.assert_array_equal(decode_vector_text(encode_vector_text(vector)), vector)
+
+    def test_binary_round_trip(self):
+        vector = np.array([0.5, -1.25, 3.0], dtype=np.float32)
+        np.testing.assert_array_equal(decode_vector_binary(encode_vector_binary(vector)), vector)
+
+    @unittest.skipIf(adapt is None, "psycopg2 is not installed")
+    def test_only_vector_param_is_adapted_as_vector(self):
+        self.assertEqual(adapt(VectorParam([1.0, 2.5])).getquoted(), b"'[1.0,2.5]'::vector")
+        # 普通 NumPy 数组不会被当成 vector
+        with self.assertRaises(Exception):
+            adapt(np.array([1.0, 2.0])).getquoted()
+
+
+if __name__ == "__main__":
+    unittest.main()
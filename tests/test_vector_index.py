@@ -0,0 +1,36 @@
+import unittest
+
+from gpts_builder.config.config_manager import config_manager
+from gpts_builder.util.db import vector_index
+
+
+class DefaultDimensionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = config_manager.embedding_model, config_manager.embedding_dimensions
+
+    def tearDown(self):
+        config_manager.embedding_model, config_manager.embedding_dimensions = self.saved
+
+    def test_configured_dimensions_win(self):
+        config_manager.embedding_model, config_manager.embedding_dimensions = "text-embedding-3-large", 256
+        self.assertEqual(vector_index.resolve_dimension(vector_index.AUTO_DIMENSION), 256)
+
+    def test_model_default_dimension(self):
+        config_manager.embedding_model, config_manager.embedding_dimensions = "text-embedding-3-large", None
+        self.assertEqual(vector_index.resolve_dimension(vector_index.AUTO_DIMENSION), 3072)
+        config_manager.embedding_model = "unknown-embedding"
+        self.assertEqual(vector_index.resolve_dimension(vector_index.AUTO_DIMENSION), vector_index.DEFAULT_DIMENSION)
+
+    def test_explicit_dimension(self):
+        self.assertEqual(vector_index.resolve_dimension(768), 768)
+        self.assertIsNone(vector_index.resolve_dimension(None))
+
+    def test_count_kb_rows_is_capped(self):
+        sql = vector_index.count_kb_rows_sql(10000, "$1")
+        self.assertIn("ANY($1::int[])", sql)
+        self.assertIn("LIMIT 10000", sql)
+
+
+if __name__ == "__main__":
+    unittest.main()